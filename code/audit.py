@@ -0,0 +1,400 @@
+import argparse
+import atexit
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+
+import metrics
+from file_lock import atomic_write
+
+# Authentication events (failed logins, lockouts, recoveries, password changes, ...) are written as
+# JSON lines to VERIFY_ME_AUDIT_DIR (default Database_txt/audit; empty turns the log off). Each
+# process buffers its events and writes them every FLUSH_INTERVAL seconds on a background thread,
+# to its own file, which is rotated after ROTATE_BYTES or ROTATE_SECONDS. A rotated file is
+# compressed as independent gzip blocks (zcat still reads it) and gets an index of which blocks
+# hold each identifier and event type, so queries only decompress the blocks they need.
+AUDIT_DIR = os.environ.get("VERIFY_ME_AUDIT_DIR", os.path.join("Database_txt", "audit"))
+FLUSH_INTERVAL = 1.0
+FLUSH_EVENTS = 1000
+MAX_PENDING = 100000
+ROTATE_BYTES = 16 << 20
+ROTATE_SECONDS = 3600
+BLOCK_BYTES = 64 << 10
+
+LOG_SUFFIX = ".log"
+COMPRESSED_SUFFIX = ".log.gz"
+INDEX_SUFFIX = ".idx"
+INDEX_MAGIC = b"VMAUDIT1"
+INDEX_HEADER = struct.Struct("<Q")  # length of the JSON header, padded to 8 bytes
+
+
+def _key_hash(kind, value):
+    return zlib.crc32(f"{kind}\0{value}".encode())
+
+
+def _log_name(started, pid, number):
+    return f"audit-{time.strftime('%Y%m%dT%H%M%S', time.gmtime(started))}-{pid}-{number}{LOG_SUFFIX}"
+
+
+def _pid_of(path):
+    try:
+        return int(os.path.basename(path)[:-len(LOG_SUFFIX)].rsplit("-", 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write_index(path, blocks, keys):
+    """keys: (hash << 32 | block number) for every identifier and event type of every block."""
+    entries = array("Q", sorted(set(keys)))
+    header = json.dumps({
+        "blocks": blocks,
+        "min_time": min((block[2] for block in blocks), default=None),
+        "max_time": max((block[3] for block in blocks), default=None),
+    }).encode()
+    header += b" " * (-len(header) % 8)
+    with atomic_write(path, "wb") as file:
+        file.write(INDEX_MAGIC + INDEX_HEADER.pack(len(header)) + header)
+        file.write(entries.tobytes())
+
+
+def _block_keys(number, events):
+    for event in events:
+        if event.get("identifier") is not None:
+            yield _key_hash("identifier", event["identifier"]) << 32 | number
+        yield _key_hash("event", event.get("event")) << 32 | number
+
+
+def compress(log_file):
+    """Turns a finished log into gzip blocks plus their index, then removes it. Returns the new path."""
+    compressed_file = log_file[:-len(LOG_SUFFIX)] + COMPRESSED_SUFFIX
+    blocks = []
+    keys = []
+    with open(log_file, "rb") as source, atomic_write(compressed_file, "wb") as target:
+        lines = []
+        size = 0
+        for raw in source:
+            if raw.endswith(b"\n"):
+                lines.append(raw)
+                size += len(raw)
+            if size >= BLOCK_BYTES or not raw.endswith(b"\n"):
+                _write_block(target, lines, blocks, keys)
+                lines, size = [], 0
+        _write_block(target, lines, blocks, keys)
+    _write_index(compressed_file + INDEX_SUFFIX, blocks, keys)
+    os.remove(log_file)
+    return compressed_file
+
+
+def _parse(lines):
+    """Yields the events on lines, skipping those torn by a crash."""
+    for raw in lines:
+        try:
+            yield json.loads(raw)
+        except ValueError:
+            pass
+
+
+def _write_block(target, lines, blocks, keys):
+    events = list(_parse(lines))
+    if not events:
+        return
+    offset = target.tell()
+    # A gzip member per block: the file stays a valid .gz, and each block decompresses alone.
+    target.write(zlib.compress(b"".join(lines), 6, wbits=31))
+    times = [event.get("time", 0) for event in events]
+    keys.extend(_block_keys(len(blocks), events))
+    blocks.append([offset, target.tell() - offset, min(times), max(times)])
+
+
+def index(compressed_file):
+    """(Re)builds the index of a compressed log, e.g. one whose writer crashed before indexing it."""
+    with open(compressed_file, "rb") as file:
+        data = file.read()
+    blocks = []
+    keys = []
+    offset = 0
+    while offset < len(data):
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            lines = decompressor.decompress(data[offset:]).splitlines()
+        except zlib.error:
+            break  # a block torn by a crash; the ones before it are still indexed
+        end = len(data) - len(decompressor.unused_data)
+        events = list(_parse(line for line in lines if line.strip()))
+        if events:
+            times = [event.get("time", 0) for event in events]
+            keys.extend(_block_keys(len(blocks), events))
+            blocks.append([offset, end - offset, min(times), max(times)])
+        offset = end
+    _write_index(compressed_file + INDEX_SUFFIX, blocks, keys)
+
+
+class AuditLog:
+    """Buffers audit events in memory and writes them to this process's log on a background thread.
+
+    record() only appends to a list, so a login never waits for the disk. Events still
+    buffered when the process is killed are lost; a normal exit flushes them.
+    """
+
+    def __init__(self, directory, flush_interval=FLUSH_INTERVAL, rotate_bytes=ROTATE_BYTES,
+                 rotate_seconds=ROTATE_SECONDS):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._file = None
+        self._path = None
+        self._opened_at = 0.0
+        self._files_opened = 0
+        self._thread = threading.Thread(target=self._run, name="verify-me-audit", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, event, identifier=None, source=None, **detail):
+        """Queues one event, e.g. record("login_failed", "someone@gmail.com", error="bad_credentials")."""
+        entry = {"time": time.time(), "event": event, "identifier": identifier, "source": source, **detail}
+        with self._lock:
+            if len(self._pending) >= MAX_PENDING:
+                metrics.count("verify_me_audit_dropped_total")
+                return
+            self._pending.append(entry)
+            if len(self._pending) >= FLUSH_EVENTS:
+                self._wakeup.set()
+
+    def _run(self):
+        try:
+            compress_finished(self.directory)
+        except (OSError, ValueError):
+            pass  # left for the next process or python code/audit.py index
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except (OSError, ValueError):
+                metrics.count("verify_me_audit_write_errors_total")
+
+    @metrics.instrumented("audit_flush")
+    def flush(self):
+        """Writes every buffered event now, rotating the file if it is due."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+            if pending:
+                if self._file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self._opened_at = time.time()
+                    self._files_opened += 1
+                    self._path = os.path.join(self.directory,
+                                              _log_name(self._opened_at, os.getpid(), self._files_opened))
+                    self._file = open(self._path, "ab")
+                self._file.write("".join(json.dumps(entry) + "\n" for entry in pending).encode())
+                self._file.flush()
+            if self._file is not None and (self._file.tell() >= self.rotate_bytes
+                                           or time.time() - self._opened_at >= self.rotate_seconds):
+                self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        compress(self._path)
+
+    def close(self):
+        """Flushes and compresses this process's log; called at exit."""
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        with self._flush_lock:
+            if self._file is not None:
+                self._rotate()
+
+
+def compress_finished(directory):
+    """Compresses the logs of processes that are gone and indexes compressed logs without an index."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(LOG_SUFFIX):
+            pid = _pid_of(path)
+            if pid is not None and pid != os.getpid() and not _alive(pid):
+                compress(path)
+        elif name.endswith(COMPRESSED_SUFFIX) and name + INDEX_SUFFIX not in names:
+            index(path)
+
+
+class _Index:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            data = file.read(len(INDEX_MAGIC) + INDEX_HEADER.size)
+            if data[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+                raise ValueError(f"{path} is not an audit index.")
+            (header_size,) = INDEX_HEADER.unpack_from(data, len(INDEX_MAGIC))
+            header = json.loads(file.read(header_size))
+            self.blocks = header["blocks"]
+            self.min_time = header["min_time"]
+            self.max_time = header["max_time"]
+            start = len(INDEX_MAGIC) + INDEX_HEADER.size + header_size
+            size = os.fstat(file.fileno()).st_size - start
+            if size:
+                self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._entries = memoryview(self._map)[start:].cast("Q")
+            else:
+                self._entries = ()
+
+    def blocks_with(self, kind, value):
+        value_hash = _key_hash(kind, value)
+        low = bisect_left(self._entries, value_hash << 32)
+        high = bisect_left(self._entries, (value_hash + 1) << 32)
+        return {self._entries[i] & 0xFFFFFFFF for i in range(low, high)}
+
+
+def _overlaps(min_time, max_time, since, until):
+    return (since is None or max_time >= since) and (until is None or min_time <= until)
+
+
+def _scan(lines, identifier, event_type, since, until):
+    """Yields the events on lines that match."""
+    # Cheap byte tests first: most lines are skipped without being parsed.
+    needles = [json.dumps(value).encode() for value in (identifier, event_type) if value is not None]
+    for event in _parse(raw for raw in lines if all(needle in raw for needle in needles)):
+        if ((identifier is None or event.get("identifier") == identifier)
+                and (event_type is None or event.get("event") == event_type)
+                and (since is None or event.get("time", 0) >= since)
+                and (until is None or event.get("time", 0) <= until)):
+            yield event
+
+
+def query(directory, identifier=None, event_type=None, since=None, until=None):
+    """Returns the matching events of every log in directory, oldest first.
+
+    Compressed logs are narrowed down to the blocks their index lists for the identifier,
+    event type and time range; only the logs still being written are read in full.
+    """
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+    events = []
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(COMPRESSED_SUFFIX):
+            if name + INDEX_SUFFIX not in names:
+                index(path)
+            events += _query_compressed(path, identifier, event_type, since, until)
+        elif name.endswith(LOG_SUFFIX) and name[:-len(LOG_SUFFIX)] + COMPRESSED_SUFFIX not in names:
+            events += _query_log(path, identifier, event_type, since, until)
+    events.sort(key=lambda event: event.get("time", 0))
+    return events
+
+
+def _query_compressed(path, identifier, event_type, since, until):
+    file_index = _Index(path + INDEX_SUFFIX)
+    if file_index.min_time is None or not _overlaps(file_index.min_time, file_index.max_time, since, until):
+        return []
+    candidates = set(range(len(file_index.blocks)))
+    if identifier is not None:
+        candidates &= file_index.blocks_with("identifier", identifier)
+    if event_type is not None:
+        candidates &= file_index.blocks_with("event", event_type)
+    events = []
+    with open(path, "rb") as file:
+        for number in sorted(candidates):
+            offset, length, min_time, max_time = file_index.blocks[number]
+            if not _overlaps(min_time, max_time, since, until):
+                continue
+            file.seek(offset)
+            lines = zlib.decompress(file.read(length), wbits=31).splitlines()
+            events += _scan(lines, identifier, event_type, since, until)
+    return events
+
+
+def _query_log(path, identifier, event_type, since, until):
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return []  # compressed meanwhile; a new query finds it in the compressed file
+    with file:
+        complete = (raw for raw in file if raw.endswith(b"\n"))
+        return list(_scan(complete, identifier, event_type, since, until))
+
+
+def parse_time(text, now=None):
+    """Parses "24h", "30m", "7d" or "90s" (that long ago) or a Unix timestamp."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if text and text[-1] in units:
+        return (now or time.time()) - float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+_lock = threading.Lock()
+_audit_log = None
+
+
+def get_audit_log():
+    """Returns the process-wide AuditLog, or None while VERIFY_ME_AUDIT_DIR is empty."""
+    global _audit_log
+    if not AUDIT_DIR:
+        return None
+    with _lock:
+        if _audit_log is None:
+            _audit_log = AuditLog(AUDIT_DIR)
+        return _audit_log
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query or maintain the authentication audit log.")
+    parser.add_argument("--dir", default=AUDIT_DIR or os.path.join("Database_txt", "audit"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    query_parser = commands.add_parser("query", help="print matching events as JSON lines, oldest first")
+    query_parser.add_argument("--identifier", help="email or phone number")
+    query_parser.add_argument("--event", help="e.g. login_failed, login_lockout, recover_ok, password_changed")
+    query_parser.add_argument("--since", help="24h, 30m, 7d or a Unix timestamp")
+    query_parser.add_argument("--until", help="same forms as --since")
+    query_parser.add_argument("--limit", type=int, help="only the newest N events")
+    commands.add_parser("index", help="compress the logs of finished processes and index them")
+    args = parser.parse_args()
+
+    if args.command == "index":
+        compress_finished(args.dir)
+        print(f"\033[1;32m[Success] Logs in {args.dir} are compressed and indexed.\033[0m")
+        return
+
+    started = time.perf_counter()
+    events = query(args.dir, args.identifier, args.event,
+                   parse_time(args.since) if args.since else None, parse_time(args.until) if args.until else None)
+    if args.limit is not None:
+        events = events[-args.limit:] if args.limit else []
+    elapsed = time.perf_counter() - started
+    for event in events:
+        print(json.dumps(event))
+    print(f"\033[1;32m{len(events)} event(s) in {elapsed * 1000:.1f} ms\033[0m", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
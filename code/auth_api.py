@@ -0,0 +1,439 @@
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+
+import backup_codes
+import metrics
+import password_hasher
+from audit import get_audit_log
+from change_feed import CONSUME, codes_event, get_change_feed, register_event, update_event
+from journal import codes_op, get_journal, user_op
+from password_policy import CHANGE_PASSWORD_POLICY, REGISTER_POLICY, RESET_PASSWORD_POLICY
+from rate_limiter import get_rate_limiter
+from record_log import TOMBSTONE_PREFIX
+from sessions import get_session_store
+from storage import get_backup_code_store, get_uniqueness_index, get_user_store
+from user_store import UserRecord
+
+# AuthResult.error values
+INVALID_INPUT = "invalid_input"
+ALREADY_EXISTS = "already_exists"
+NOT_FOUND = "not_found"
+BAD_CREDENTIALS = "bad_credentials"
+LOCKED_OUT = "locked_out"
+SESSION_EXPIRED = "session_expired"
+
+# ok: bool; error: one of the values above or None; message: text for the user;
+# retry_after: seconds to wait when locked out; data: dict with the call's results.
+AuthResult = namedtuple("AuthResult", ["ok", "error", "message", "retry_after", "data"])
+
+
+def success(message="", **data):
+    return AuthResult(True, None, message, 0, data)
+
+
+def failure(error, message, retry_after=0, **data):
+    return AuthResult(False, error, message, retry_after, data)
+
+
+def hash_password(password, salt):
+    """Hashes the password with the configured hasher, as algorithm$params$salt$hash."""
+    return password_hasher.encode(password_hasher.get_password_hasher(), password, salt)
+
+
+def verify_password(password, user):
+    """Tells whether password matches a UserRecord's stored hash."""
+    return password_hasher.verify(password, user.salt_hex, user.hashed_password)
+
+
+def generate_backup_codes(count=1):
+    """Generates multiple 8-digit unique backup codes."""
+    return backup_codes.generate_codes(count)
+
+
+def validate_email(email):
+    """Validates if the email ends with '@gmail.com'."""
+    return email.endswith("@gmail.com")
+
+
+def validate_phone(phone):
+    """Validates if the phone starts with '0' and contains 9-10 digits."""
+    return phone.startswith("0") and phone[1:].isdigit() and 9 <= len(phone) <= 10
+
+
+def _has_separator(value):
+    """Tells whether value holds a character the CSV data files use as a separator."""
+    return "," in value or "\n" in value or "\r" in value
+
+
+def validate_identifier(email_or_phone):
+    """Returns (is_valid, error_message) for an email or phone number."""
+    if _has_separator(email_or_phone) or email_or_phone.startswith(TOMBSTONE_PREFIX):
+        return False, f"The email/phone number cannot contain commas or line breaks or start with '{TOMBSTONE_PREFIX}'."
+    if "@" in email_or_phone:
+        if not validate_email(email_or_phone):
+            return False, "Invalid email format. Use a valid Gmail address (e.g., example@gmail.com)."
+    elif not validate_phone(email_or_phone):
+        return False, "Invalid phone number. Ensure it starts with '0' and is 9-10 digits long."
+    return True, ""
+
+
+def validate_username(username):
+    """Returns (is_valid, error_message) for a username."""
+    if not username:
+        return False, "Username cannot be empty."
+
+    if len(username) < 2:
+        return False, "Username must be at least 2 characters long."
+
+    if username.isdigit():
+        return False, "Username cannot be only numbers."
+
+    if _has_separator(username):
+        return False, "Username cannot contain commas or line breaks."
+
+    if username.startswith(" ") or username.endswith(" "):
+        return False, "Username cannot start or end with spaces."
+
+    if " " in username:
+        split_username = username.split(" ")
+        if any(part == "" for part in split_username):
+            return False, "Username cannot have consecutive spaces or start with space."
+
+    return True, ""
+
+
+class AuthAPI:
+    """Register, authenticate, recover and change passwords without any prompts.
+
+    Every call returns an AuthResult; storage failures surface as IOError. Failed
+    attempts are counted in the shared RateLimiter, so a locked-out caller gets
+    error=LOCKED_OUT and retry_after instead of being made to wait. source is the
+    caller's address (None for the terminal) and only keys lockouts that are not
+    tied to an account. Failures, lockouts, logins, recoveries and password changes
+    are recorded in the audit log (see audit.py).
+
+    With replica (a replica.Replica) the API is a follower's: lookups come from the
+    replica's copy and every change raises replica.ReadOnlyReplica.
+    """
+
+    def __init__(self, user_data_file="database.txt", backup_code_file="backup_codes.txt", replica=None):
+        self.user_data_file = os.path.join("Database_txt", user_data_file)
+        self.backup_code_file = os.path.join("Database_txt", backup_code_file)
+        self.read_only = replica is not None
+        if self.read_only:
+            self.user_store = self.backup_code_store = self.uniqueness = replica
+            self.journal = self.feed = None
+        else:
+            self.user_store = get_user_store(self.user_data_file)
+            self.backup_code_store = get_backup_code_store(self.backup_code_file)
+            self.uniqueness = get_uniqueness_index(self.user_data_file)
+            self.journal = get_journal(self.user_data_file)
+            self.feed = get_change_feed(self.user_data_file)
+        self.rate_limiter = get_rate_limiter()
+        self.sessions = get_session_store()
+        self.hash_executor = password_hasher.get_hash_executor()
+        self.audit = get_audit_log()
+        if self.journal is not None:
+            self.journal.recover(self.user_store, self.backup_code_store)
+        metrics.start_file_exporter()
+
+    @contextmanager
+    def _published(self):
+        """Holds the change feed, if it is on, around the block making a change; the events the
+        block adds to the yielded list are published once it is done."""
+        if self.feed is None:
+            yield []
+        else:
+            with self.feed.publishing() as events:
+                yield events
+
+    @contextmanager
+    def _journaled(self, *ops):
+        """Runs the block that applies ops as one journal entry, if the journal is on."""
+        if self.journal is None:
+            yield
+        else:
+            with self.journal.entry(list(ops)):
+                yield
+
+    def _hash(self, password):
+        """Returns (salt_hex, hashed_password) for a new password, hashed on the hash pool."""
+        salt = os.urandom(16)
+        return salt.hex(), self.hash_executor.submit(hash_password, password, salt).result()
+
+    def _audit(self, event, identifier=None, source=None, **detail):
+        if self.audit is not None:
+            self.audit.record(event, identifier, source, **detail)
+
+    def _locked_out(self, key, source=None):
+        """source (the caller's address) is for the audit log."""
+        retry_after = self.rate_limiter.retry_after(key)
+        if retry_after:
+            metrics.count("verify_me_locked_out_total", action=key[0])
+            self._audit(f"{key[0]}_locked_out", key[1], source, retry_after=retry_after)
+            return failure(LOCKED_OUT, f"Too many failed attempts. Please try again in {retry_after} seconds.",
+                           retry_after)
+        return None
+
+    def _failed(self, key, error, message, source=None):
+        """Counts a failed attempt; the result says how long to wait if it caused a lockout."""
+        retry_after = self.rate_limiter.record_failure(key)
+        metrics.count("verify_me_failed_attempts_total", action=key[0])
+        self._audit(f"{key[0]}_failed", key[1], source, error=error)
+        if retry_after:
+            metrics.count("verify_me_lockouts_total", action=key[0])
+            self._audit(f"{key[0]}_lockout", key[1], source, retry_after=retry_after)
+        return failure(error, message, retry_after)
+
+    def check_identifier(self, email_or_phone):
+        """Checks that an email/phone is well formed and not registered yet."""
+        if self.uniqueness.identifier_taken(email_or_phone):
+            return failure(ALREADY_EXISTS, "This email or phone number is already registered.")
+        is_valid, error_message = validate_identifier(email_or_phone)
+        if not is_valid:
+            return failure(INVALID_INPUT, error_message)
+        return success()
+
+    def check_username(self, username, email_or_phone=None):
+        """Checks that a username is well formed, free, and differs from the email/phone."""
+        is_valid, error_message = validate_username(username)
+        if not is_valid:
+            return failure(INVALID_INPUT, error_message)
+        if self.uniqueness.username_taken(username):
+            return failure(ALREADY_EXISTS, "This username is already taken. Please choose a different one.")
+        if username == email_or_phone:
+            return failure(INVALID_INPUT, "Username and email/phone number cannot be the same.")
+        return success()
+
+    def check_password(self, password, policy=REGISTER_POLICY):
+        """Checks a new password against a PasswordPolicy."""
+        problem = policy.check(password)
+        if problem:
+            return failure(INVALID_INPUT, problem)
+        return success()
+
+    @metrics.instrumented("register")
+    def register(self, email_or_phone, username, password, source=None):
+        """Creates an account. On success data has "username" and "backup_codes".
+
+        Refused input is not counted as a failed attempt: it only tells what is wrong or taken,
+        and a count per caller would let one client lock out everyone sharing its address.
+        """
+        for result in (self.check_identifier(email_or_phone),
+                       self.check_username(username, email_or_phone),
+                       self.check_password(password)):
+            if not result.ok:
+                self._audit("register_failed", email_or_phone, source, error=result.error)
+                return result
+
+        record = UserRecord(email_or_phone, username, *self._hash(password))
+        backup_codes = generate_backup_codes(10)
+        stored_codes = self.backup_code_store.digests(email_or_phone, backup_codes)
+        ops = (user_op(None, record), codes_op(email_or_phone, add=stored_codes))
+        with self._published() as events, self._journaled(*ops):
+            if not self.user_store.add_user(record):
+                self._audit("register_failed", email_or_phone, source, error=ALREADY_EXISTS)
+                return failure(ALREADY_EXISTS,
+                               "This email or phone number or username was registered by someone else meanwhile.")
+            self.backup_code_store.change_codes(email_or_phone, add=stored_codes)
+            events.append(register_event(record, stored_codes))
+        self._audit("register_ok", email_or_phone, source, username=username)
+        return success(f"User '{username}' registered successfully!", username=username, backup_codes=backup_codes)
+
+    def lookup(self, email_or_phone, source=None):
+        """Finds an account by email/phone. On success data has "user" (a UserRecord).
+
+        Failures count against the email/phone even when it has no account, never against the
+        caller's address: many clients can share one (a proxy, the Unix socket).
+        """
+        key = ("login", email_or_phone)
+        locked = self._locked_out(key, source=source)
+        if locked:
+            return locked
+        user = self.user_store.find_user(email_or_phone)
+        if user is None:
+            return self._failed(key, NOT_FOUND, "No account found with that email or phone number.", source=source)
+        return success(user=user)
+
+    def _find(self, email_or_phone):
+        user = self.user_store.find_user(email_or_phone)
+        if user is None:
+            return failure(NOT_FOUND, "User not found.")
+        return success(user=user)
+
+    def _session_user(self, email_or_phone, token):
+        result = self.session(token)
+        if result.ok and result.data["user"].identifier != email_or_phone:
+            return failure(SESSION_EXPIRED, "Your session has expired. Please log in again.")
+        return result
+
+    def _check_password(self, action, email_or_phone, password, source, token=None):
+        key = (action, email_or_phone)
+        locked = self._locked_out(key, source=source)
+        if locked:
+            return locked
+        if token is not None:
+            result = self._session_user(email_or_phone, token)
+        elif action == "login":
+            result = self.lookup(email_or_phone, source)
+        else:
+            result = self._find(email_or_phone)
+        if not result.ok:
+            return result
+        user = result.data["user"]
+        if not self.hash_executor.submit(verify_password, password, user).result():
+            return self._failed(key, BAD_CREDENTIALS, "Incorrect password.", source=source)
+        self.rate_limiter.record_success(key)
+        if action == "login":
+            self._audit("login_ok", email_or_phone, source)
+        if password_hasher.needs_rehash(user.hashed_password) and not self.read_only:
+            return success(user=self._rehash(user, password))
+        return result
+
+    def _rehash(self, user, password):
+        """Moves a verified password to the current hasher; skipped if the record changed meanwhile.
+
+        Returns the record as stored afterwards.
+        """
+        salt_hex, hashed_password = self._hash(password)
+        rehashed = user._replace(salt_hex=salt_hex, hashed_password=hashed_password)
+        with self._published() as events:
+            if not self.user_store.update_user(rehashed, expected=user):
+                return user
+            events.append(update_event(rehashed, revoke=False))
+        self.sessions.update_user(rehashed)
+        return rehashed
+
+    @metrics.instrumented("authenticate")
+    def authenticate(self, email_or_phone, password, source=None):
+        """Checks a login. On success data has "user" (a UserRecord)."""
+        return self._check_password("login", email_or_phone, password, source)
+
+    def login(self, email_or_phone, password, source=None):
+        """Checks a login and starts a session. On success data has "user" and "token"."""
+        result = self.authenticate(email_or_phone, password, source)
+        if not result.ok:
+            return result
+        return success(user=result.data["user"], token=self.sessions.create(result.data["user"]))
+
+    def session(self, token):
+        """Resolves a session token. On success data has "user".
+
+        Sessions are revoked only in the process that changed the password, so the session's
+        record is checked against the stored one (an in-memory lookup): if the password was
+        changed or reset since, by any process, the session ends here too.
+        """
+        user = self.sessions.get(token)
+        if user is not None:
+            current = self.user_store.find_user(user.identifier)
+            if current is not None and current.hashed_password == user.hashed_password:
+                return success(user=user)
+            self.sessions.revoke(token)
+        return failure(SESSION_EXPIRED, "Your session has expired. Please log in again.")
+
+    def logout(self, token):
+        self.sessions.revoke(token)
+        return success("Logged out.")
+
+    def verify_current_password(self, email_or_phone, password, source=None, token=None):
+        """Re-checks the password of a logged-in user before a sensitive change.
+
+        With the token of the user's session the record comes from the session cache.
+        """
+        return self._check_password("change_password", email_or_phone, password, source, token)
+
+    @metrics.instrumented("set_password")
+    def set_password(self, email_or_phone, new_password, policy=CHANGE_PASSWORD_POLICY, token=None, source=None):
+        """Stores a new password with a fresh salt. The caller must already have verified the user.
+
+        Every other session of the user is revoked; token's session, if given, stays
+        logged in. If the record changed since that session read it (e.g. in another
+        process), nothing is written and the session ends.
+        """
+        result = self.check_password(new_password, policy)
+        if not result.ok:
+            return result
+        if token is not None:
+            result = self._session_user(email_or_phone, token)
+            if not result.ok:
+                return result
+            user = expected = result.data["user"]
+        else:
+            user, expected = self.user_store.find_user(email_or_phone), None
+            if user is None:
+                return failure(NOT_FOUND, "User not found. Password not changed.")
+        salt_hex, hashed_password = self._hash(new_password)
+        updated = user._replace(salt_hex=salt_hex, hashed_password=hashed_password)
+        with self._published() as events, self._journaled(user_op(user, updated)):
+            changed = self.user_store.update_user(updated, expected=expected)
+            if changed:
+                events.append(update_event(updated))
+        if not changed:
+            if token is not None:
+                self.sessions.revoke(token)
+                return failure(SESSION_EXPIRED, "Your account changed since you logged in. Please log in again.")
+            return failure(NOT_FOUND, "User not found. Password not changed.")
+        revoked = self.sessions.revoke_user(email_or_phone, keep_token=token)
+        self.sessions.update_user(updated)
+        self._audit("password_reset" if policy is RESET_PASSWORD_POLICY else "password_changed", email_or_phone,
+                    source, revoked_sessions=revoked)
+        return success("Password changed successfully!")
+
+    def consume_backup_code(self, email_or_phone, backup_code, source=None):
+        """Uses up one backup code. On success data has "remaining_backup_codes"."""
+        key = ("recover", email_or_phone)
+        locked = self._locked_out(key, source=source)
+        if locked:
+            return locked
+        stored = self.backup_code_store.stored_code(email_or_phone, backup_code)
+        if stored is None:
+            return self._failed(key, BAD_CREDENTIALS, "Invalid backup code.", source=source)
+        with self._published() as events, self._journaled(codes_op(email_or_phone, drop=[stored])):
+            consumed = self.backup_code_store.consume(email_or_phone, backup_code)
+            if consumed:
+                events.append(codes_event(email_or_phone, drop=[stored], kind=CONSUME))
+        if not consumed:
+            return self._failed(key, BAD_CREDENTIALS, "Invalid backup code.", source=source)
+        self.rate_limiter.record_success(key)
+        remaining = self.backup_code_store.remaining_count(email_or_phone)
+        self._audit("recover_ok", email_or_phone, source, remaining_backup_codes=remaining)
+        return success("Backup code verified successfully!", remaining_backup_codes=remaining)
+
+    @metrics.instrumented("regenerate_backup_codes")
+    def regenerate_backup_codes(self, token):
+        """Replaces every backup code of the session's user. On success data has "backup_codes"."""
+        result = self.session(token)
+        if not result.ok:
+            return result
+        identifier = result.data["user"].identifier
+        codes = generate_backup_codes(10)
+        stored_codes = self.backup_code_store.digests(identifier, codes)
+        old_codes = self.backup_code_store.stored_codes(identifier)
+        with self._published() as events, self._journaled(codes_op(identifier, add=stored_codes, drop=old_codes)):
+            self.backup_code_store.change_codes(identifier, add=stored_codes, drop=old_codes)
+            events.append(codes_event(identifier, add=stored_codes, drop=old_codes))
+        self._audit("backup_codes_regenerated", identifier)
+        return success("New backup codes generated; the old ones no longer work.", backup_codes=codes)
+
+    @metrics.instrumented("reset_with_backup_code")
+    def reset_with_backup_code(self, email_or_phone, backup_code, new_password, source=None):
+        """Sets a new password after proving account ownership with a backup code."""
+        result = self.check_password(new_password, RESET_PASSWORD_POLICY)
+        if not result.ok:
+            return result
+        code_result = self.consume_backup_code(email_or_phone, backup_code, source)
+        if not code_result.ok:
+            return code_result
+        result = self.set_password(email_or_phone, new_password, RESET_PASSWORD_POLICY, source=source)
+        if not result.ok:
+            return result
+        return success("Password reset successfully!", **code_result.data)
+
+    @metrics.instrumented("change_password")
+    def change_password(self, email_or_phone, current_password, new_password, source=None, token=None):
+        """Changes a password after re-checking the current one."""
+        result = self.verify_current_password(email_or_phone, current_password, source, token)
+        if not result.ok:
+            return result
+        return self.set_password(email_or_phone, new_password, CHANGE_PASSWORD_POLICY, token, source)
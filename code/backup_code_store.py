@@ -0,0 +1,240 @@
+import itertools
+import threading
+
+from backup_codes import code_digest, get_key, is_digest, key_file_for
+from metrics import instrumented, timed
+from record_log import APPENDED, REPLACED, RecordLog
+from snapshot import MIN_RECORDS, SnapshotWriter, snapshot_file_for
+from snapshot import load as load_snapshot
+
+
+class BackupCodeStore:
+    """Keeps backup_codes.txt indexed in memory as identifier -> set of unused codes.
+
+    Codes are stored as keyed digests (see backup_codes.py), so checking one is an
+    HMAC plus a set lookup; plaintext codes from older files are still accepted.
+    A used code is dropped from the file by rewriting it, or with append_only=True by
+    appending a "~identifier,code" tombstone so no other user's lines are touched.
+    """
+
+    def __init__(self, backup_code_file, append_only=False, compact_threshold=0.5):
+        self.backup_code_file = backup_code_file
+        self.append_only = append_only
+        self._lock = threading.RLock()
+        self._log = RecordLog(backup_code_file, key_fields=2, min_fields=2, lock=self._lock,
+                              compact_threshold=compact_threshold)
+        self._snapshot_writer = SnapshotWriter(snapshot_file_for(backup_code_file), backup_code_file, (0,))
+        self.key = get_key(key_file_for(backup_code_file))
+        self._snapshot = None
+        self._snapshot_due = 0
+        self._codes = {}  # on top of the snapshot, if any: identifier -> all of that user's codes
+        self._live_count = 0
+        self._user_count = 0
+
+    def _codes_of(self, identifier):
+        codes = self._codes.get(identifier)
+        if codes is None:
+            fields = self._snapshot.find(0, identifier) if self._snapshot is not None else None
+            return frozenset(fields[1:]) if fields else frozenset()
+        return codes
+
+    def _items(self):
+        """Yields (identifier, codes) for every user with unused codes."""
+        for identifier, codes in self._codes.items():
+            if codes:
+                yield identifier, codes
+        if self._snapshot is not None:
+            for fields in self._snapshot.records():
+                if fields[0] not in self._codes:
+                    yield fields[0], frozenset(fields[1:])
+
+    def _apply(self, key, fields):
+        identifier, code = key
+        codes = self._codes.get(identifier)
+        if codes is None:
+            codes = self._codes[identifier] = set(self._codes_of(identifier))
+        had_codes = bool(codes)
+        if fields is not None:
+            if code not in codes:
+                codes.add(code)
+                self._live_count += 1
+        elif code in codes:
+            codes.discard(code)
+            self._live_count -= 1
+        if had_codes != bool(codes):
+            self._user_count += 1 if codes else -1
+        if not codes and self._snapshot is None:
+            del self._codes[identifier]
+
+    def _load(self):
+        """Starts over from a current snapshot plus the lines after it, or from the whole file."""
+        self._codes = {}
+        self._snapshot = None
+        if MIN_RECORDS:
+            with self._log.file_lock.shared():
+                self._snapshot = load_snapshot(snapshot_file_for(self.backup_code_file), self.backup_code_file, (0,))
+                if self._snapshot is not None:
+                    self._log.restore(self._snapshot.cursor)
+                    self._user_count = self._snapshot.count
+                    self._live_count = self._snapshot.extra["live_count"]
+                    for key, fields in self._log.read():
+                        self._apply(key, fields)
+                    self._snapshot_due = max(MIN_RECORDS, self._user_count // 4)
+                    return
+        self._snapshot_due = 0
+        self._user_count = 0
+        self._live_count = 0
+        for key, fields in self._log.read(from_start=True):
+            self._apply(key, fields)
+
+    def _maybe_snapshot(self):
+        """Writes a new snapshot in the background once enough changed since the last one."""
+        if not MIN_RECORDS or self._user_count < MIN_RECORDS or len(self._codes) < self._snapshot_due:
+            return
+        snapshot, changes = self._snapshot, {identifier: list(codes) for identifier, codes in self._codes.items()}
+        records = ([identifier, *codes] for identifier, codes in changes.items() if codes)
+        if snapshot is not None:
+            records = itertools.chain(records, (fields for fields in snapshot.records() if fields[0] not in changes))
+        if self._snapshot_writer.start(self._log.cursor(), records, {"live_count": self._live_count}):
+            self._snapshot_due = len(self._codes) + max(MIN_RECORDS, self._user_count // 4)
+
+    def refresh(self):
+        """Reloads the index only if the file changed since the last load or write."""
+        with self._lock:
+            state = self._log.poll()
+            if state == REPLACED:
+                with timed("backup_code_index_load"):
+                    self._load()
+            elif state == APPENDED:
+                with timed("backup_code_index_tail"):
+                    for key, fields in self._log.read():
+                        self._apply(key, fields)
+            self._maybe_snapshot()
+
+    def add_codes(self, email_or_phone, codes):
+        """Stores new backup codes for a user in a single append."""
+        self.add_codes_bulk({email_or_phone: codes})
+
+    def digests(self, email_or_phone, codes):
+        """Returns how codes are stored for this user."""
+        return [code_digest(self.key, email_or_phone, code) for code in codes]
+
+    @instrumented("add_backup_codes")
+    def add_codes_bulk(self, codes_by_identifier):
+        """Stores the codes of many users ({identifier: codes}) in a single append."""
+        records = [(identifier, digest) for identifier, codes in codes_by_identifier.items()
+                   for digest in self.digests(identifier, codes)]
+        with self._log.exclusive():
+            self.refresh()
+            self._log.append(records)
+            for record in records:
+                self._apply(record, record)
+
+    def _stored(self, email_or_phone, code):
+        """Returns how code is stored for this user if it is one of their unused codes, else None."""
+        codes = self._codes_of(email_or_phone)
+        digest = code_digest(self.key, email_or_phone, code)
+        if digest in codes:
+            return digest
+        if code in codes and not is_digest(code):
+            return code
+        return None
+
+    def is_valid(self, email_or_phone, code):
+        """Tells whether code is an unused backup code of this user."""
+        return self.stored_code(email_or_phone, code) is not None
+
+    def stored_code(self, email_or_phone, code):
+        """Returns the stored form of an unused code of this user, or None."""
+        with self._lock:
+            self.refresh()
+            return self._stored(email_or_phone, code)
+
+    def stored_codes(self, email_or_phone):
+        """Returns the stored forms of all unused codes of this user."""
+        with self._lock:
+            self.refresh()
+            return set(self._codes_of(email_or_phone))
+
+    @instrumented("consume_backup_code")
+    def consume(self, email_or_phone, code):
+        """Marks code as used if it is valid for this user. Returns False otherwise."""
+        with self._log.exclusive():
+            self.refresh()
+            stored = self._stored(email_or_phone, code)
+            if stored is None:
+                return False
+
+            key = (email_or_phone, stored)
+            if self.append_only:
+                self._log.append_tombstones([key])
+            else:
+                self._log.rewrite(key, None)
+            self._apply(key, None)
+
+            if self.append_only:
+                self._log.maybe_compact(self._live_count, self._live_records)
+            return True
+
+    def replace_codes(self, email_or_phone, codes, old_codes=None):
+        """Swaps a user's codes for new ones in a single append.
+
+        Drops every current code, or only the stored values in old_codes if given.
+        """
+        with self._log.exclusive():
+            self.refresh()
+            current = self._codes_of(email_or_phone)
+            self.change_codes(email_or_phone, add=self.digests(email_or_phone, codes),
+                              drop=[code for code in current if old_codes is None or code in old_codes])
+
+    @instrumented("replace_backup_codes")
+    def change_codes(self, email_or_phone, add=(), drop=()):
+        """Adds and drops stored codes (as returned by digests()) of one user in a single append."""
+        with self._log.exclusive():
+            self.refresh()
+            current = self._codes_of(email_or_phone)
+            dropped = [(email_or_phone, code) for code in drop if code in current]
+            records = [(email_or_phone, code) for code in add]
+            self._log.append(records, tombstones=dropped)
+            for key in dropped:
+                self._apply(key, None)
+            for record in records:
+                self._apply(record, record)
+            self._log.maybe_compact(self._live_count, self._live_records)
+
+    def plaintext_codes(self):
+        """Returns {identifier: codes} for codes still stored as plaintext."""
+        with self._lock:
+            self.refresh()
+            plaintext = {}
+            for identifier, codes in self._items():
+                legacy = [code for code in codes if not is_digest(code)]
+                if legacy:
+                    plaintext[identifier] = legacy
+            return plaintext
+
+    def remaining_count(self, email_or_phone):
+        """Returns how many unused backup codes a user has left."""
+        with self._lock:
+            self.refresh()
+            return len(self._codes_of(email_or_phone))
+
+    def user_count(self):
+        """Returns how many users have unused backup codes."""
+        with self._lock:
+            self.refresh()
+            return self._user_count
+
+    def sync(self):
+        """Makes every write so far durable."""
+        with self._lock:
+            self._log.sync()
+
+    def compact(self):
+        """Rewrites the file now so that replaced and used codes are gone from disk."""
+        with self._log.exclusive():
+            self.refresh()
+            self._log.compact(self._live_records)
+
+    def _live_records(self):
+        return [(identifier, code) for identifier, codes in self._items() for code in codes]
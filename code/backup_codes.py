@@ -0,0 +1,84 @@
+import hashlib
+import hmac
+import os
+import secrets
+import sys
+import threading
+
+# Backup codes are stored as HMAC-SHA256(key, identifier + code) in hex, so the codes file is useless
+# without the key. The key is a random secret in "backup_code.key" next to the codes file (mode 0600,
+# created on first use); VERIFY_ME_BACKUP_CODE_KEY=path keeps it somewhere else, e.g. off the data disk.
+KEY_FILE = os.environ.get("VERIFY_ME_BACKUP_CODE_KEY")
+KEY_FILE_NAME = "backup_code.key"
+CODE_DIGITS = 8
+
+_lock = threading.Lock()
+_keys = {}
+
+
+def generate_codes(count=10):
+    """Returns count distinct CODE_DIGITS-digit codes from the operating system's CSPRNG."""
+    codes = set()
+    while len(codes) < count:
+        codes.add(f"{secrets.randbelow(10 ** CODE_DIGITS):0{CODE_DIGITS}d}")
+    return list(codes)
+
+
+def key_file_for(data_file):
+    return KEY_FILE or os.path.join(os.path.dirname(data_file), KEY_FILE_NAME)
+
+
+def get_key(key_file):
+    """Returns the HMAC key in key_file, creating it if there is none yet."""
+    key_file = os.path.abspath(key_file)
+    with _lock:
+        key = _keys.get(key_file)
+        if key is None:
+            try:
+                fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except FileExistsError:
+                pass  # made earlier, or by another process just now
+            else:
+                with os.fdopen(fd, "w") as file:
+                    file.write(secrets.token_hex(32) + "\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+            with open(key_file, "r") as file:
+                key = bytes.fromhex(file.read().strip())
+            if len(key) < 16:
+                raise IOError(f"{key_file} does not hold a backup code key.")
+            _keys[key_file] = key
+        return key
+
+
+def code_digest(key, identifier, code):
+    """The stored form of a backup code: identifier-bound, so a digest cannot be moved to another account."""
+    return hmac.new(key, f"{identifier}\0{code}".encode(), hashlib.sha256).hexdigest()
+
+
+def is_digest(value):
+    """Tells a stored digest from a plaintext code written before codes were hashed."""
+    return len(value) == 64
+
+
+def migrate(store):
+    """Replaces every plaintext code in store by its digest. Returns how many were hashed."""
+    migrated = 0
+    for identifier, codes in store.plaintext_codes().items():
+        store.replace_codes(identifier, codes, old_codes=codes)
+        migrated += len(codes)
+    if migrated:
+        store.compact()  # so the plaintext is gone from the file, not just superseded
+    return migrated
+
+
+if __name__ == "__main__":
+    # python code/backup_codes.py migrate  -- run from the project folder
+    if sys.argv[1:] != ["migrate"]:
+        print("Usage: python code/backup_codes.py migrate")
+        sys.exit(1)
+    from storage import get_backup_code_store
+
+    code_file = os.path.join("Database_txt", "backup_codes.txt")
+    count = migrate(get_backup_code_store(code_file))
+    print(f"\033[1;32m[Success] {count} plaintext backup code(s) hashed; the key is {key_file_for(code_file)}.\033[0m")
@@ -0,0 +1,116 @@
+import argparse
+import csv
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import password_hasher
+from auth_api import BAD_CREDENTIALS, INVALID_INPUT, NOT_FOUND
+from bulk_import import read_rows
+from storage import get_user_store
+
+# ok: bool; error: None, INVALID_INPUT, NOT_FOUND or BAD_CREDENTIALS (see auth_api).
+VerifyResult = namedtuple("VerifyResult", ["identifier", "ok", "error"])
+
+
+def verify_chunk(items):
+    """Runs in a worker process: checks (password, salt_hex, hashed_password) triples."""
+    return [password_hasher.verify(password, salt_hex, hashed_password)
+            for password, salt_hex, hashed_password in items]
+
+
+class BatchVerifier:
+    """Checks many (identifier, password) pairs: one store lookup per chunk, hashes spread over processes.
+
+    Unlike AuthAPI.authenticate it counts no failed attempts and rehashes nothing;
+    it only tells whether each pair is right, e.g. to replay a login backlog or
+    to validate credentials during a migration.
+    """
+
+    def __init__(self, user_data_file="database.txt", workers=None, chunk_size=100):
+        self.user_store = get_user_store(os.path.join("Database_txt", user_data_file))
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def _submit(self, executor, chunk):
+        users = self.user_store.find_users({identifier for identifier, _ in chunk if identifier})
+        to_hash = [(password, users[identifier].salt_hex, users[identifier].hashed_password)
+                   for identifier, password in chunk if identifier in users and password]
+        return chunk, users, executor.submit(verify_chunk, to_hash) if to_hash else None
+
+    def _results(self, chunk, users, future):
+        matches = iter(future.result() if future is not None else ())
+        for identifier, password in chunk:
+            if not identifier or not password:
+                yield VerifyResult(identifier, False, INVALID_INPUT)
+            elif identifier not in users:
+                yield VerifyResult(identifier, False, NOT_FOUND)
+            elif next(matches):
+                yield VerifyResult(identifier, True, None)
+            else:
+                yield VerifyResult(identifier, False, BAD_CREDENTIALS)
+
+    def verify(self, credentials):
+        """Yields a VerifyResult for every (identifier, password) in credentials, in input order.
+
+        credentials is read lazily, so it may be a generator over a huge file; at most
+        two chunks per worker are in flight at any time.
+        """
+        pending = deque()
+        chunk = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for credential in credentials:
+                chunk.append(credential)
+                if len(chunk) >= self.chunk_size:
+                    pending.append(self._submit(executor, chunk))
+                    chunk = []
+                while len(pending) > self.workers * 2 or pending and (pending[0][2] is None or pending[0][2].done()):
+                    yield from self._results(*pending.popleft())
+            if chunk:
+                pending.append(self._submit(executor, chunk))
+            while pending:
+                yield from self._results(*pending.popleft())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check many identifier/password pairs at once.")
+    parser.add_argument("input", help="CSV with an identifier,password header, or JSON lines with those keys")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="defaults to the file extension")
+    parser.add_argument("--output", default="verify_results.csv",
+                        help="where to write line,identifier,result (default verify_results.csv)")
+    parser.add_argument("--workers", type=int, help="hashing processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=100)
+    args = parser.parse_args()
+
+    file_format = args.format or ("jsonl" if args.input.endswith((".jsonl", ".json")) else "csv")
+    line_numbers = deque()
+
+    def credentials():
+        for line_number, row in read_rows(args.input, file_format):
+            line_numbers.append(line_number)
+            row = row if isinstance(row, dict) else {}
+            identifier, password = row.get("identifier"), row.get("password")
+            yield (identifier.strip() if isinstance(identifier, str) else None,
+                   password if isinstance(password, str) else None)
+
+    started = time.monotonic()
+    counts = {}
+    verifier = BatchVerifier(workers=args.workers, chunk_size=args.chunk_size)
+    with open(args.output, "w", newline="") as output:
+        writer = csv.writer(output)
+        writer.writerow(["line", "identifier", "result"])
+        for result in verifier.verify(credentials()):
+            outcome = "ok" if result.ok else result.error
+            counts[outcome] = counts.get(outcome, 0) + 1
+            writer.writerow([line_numbers.popleft(), result.identifier or "", outcome])
+    total = sum(counts.values())
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"\033[1;32m[Success] {total} credential(s) checked in {elapsed:.1f}s "
+          f"({total / elapsed:.0f}/s), results in {args.output}.\033[0m")
+    for outcome, count in sorted(counts.items()):
+        print(f"  {outcome:<20}{count:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""Benchmarks for the account operations on synthetic databases of growing size.
+
+Run from the code folder: python -m benchmark --help
+"""
@@ -0,0 +1,87 @@
+import argparse
+import json
+import os
+import random
+
+import backup_codes
+import password_hasher
+
+# Every sample account uses this password, so benchmarks can log in to it.
+SAMPLE_PASSWORD = "Bench!mark1"
+SAMPLES_FILE = "samples.json"
+
+_FIRST_NAMES = ("anna", "bora", "chey", "dara", "kim", "lina", "mony", "nita", "rith", "sok", "vanna", "yuki")
+
+
+def _identifier(rng, index):
+    # About a third of the accounts use a phone number, like the real data.
+    if index % 3 == 2:
+        return "0" + str(100000000 + index)[-9:]
+    return f"{rng.choice(_FIRST_NAMES)}.{index}@gmail.com"
+
+
+def _fake_hash(rng, spec, salt_hex):
+    # Same shape and length as a real hash; nobody ever logs in to these accounts.
+    return f"{spec}${salt_hex}${rng.getrandbits(256):064x}"
+
+
+def _fake_codes(rng, count):
+    # Same shape as stored backup code digests (see backup_codes.py).
+    return [f"{rng.getrandbits(256):064x}" for _ in range(count)]
+
+
+def generate(directory, users, codes_per_user=10, samples=200, seed=0):
+    """Writes Database_txt/database.txt and backup_codes.txt with users accounts under directory.
+
+    samples accounts spread evenly over the file get a real password hash of
+    SAMPLE_PASSWORD and real backup codes; the rest get random hashes and digests
+    so generation stays fast at any size.
+    Returns the sample accounts as [{"identifier", "username", "backup_codes"}] and
+    also saves them to samples.json in directory.
+    """
+    rng = random.Random(seed)
+    hasher = password_hasher.get_password_hasher()
+    spec = f"{hasher.name}${hasher.params()}"
+    step = max(users // max(samples, 1), 1)
+    sample_accounts = []
+
+    data_directory = os.path.join(directory, "Database_txt")
+    os.makedirs(data_directory, exist_ok=True)
+    code_path = os.path.join(data_directory, "backup_codes.txt")
+    key = backup_codes.get_key(backup_codes.key_file_for(code_path))
+    with open(os.path.join(data_directory, "database.txt"), "w") as user_file, \
+            open(code_path, "w") as code_file:
+        for index in range(users):
+            identifier = _identifier(rng, index)
+            username = f"{rng.choice(_FIRST_NAMES)} {index}"
+            salt = rng.getrandbits(128).to_bytes(16, "big")
+            if index % step == 0 and len(sample_accounts) < samples:
+                codes = [f"{code:08d}" for code in rng.sample(range(10 ** 8), codes_per_user)]
+                hashed_password = password_hasher.encode(hasher, SAMPLE_PASSWORD, salt)
+                sample_accounts.append({"identifier": identifier, "username": username, "backup_codes": codes})
+                stored_codes = [backup_codes.code_digest(key, identifier, code) for code in codes]
+            else:
+                hashed_password = _fake_hash(rng, spec, salt.hex())
+                stored_codes = _fake_codes(rng, codes_per_user)
+            user_file.write(f"{identifier},{username},{salt.hex()},{hashed_password}\n")
+            code_file.writelines(f"{identifier},{code}\n" for code in stored_codes)
+
+    with open(os.path.join(directory, SAMPLES_FILE), "w") as file:
+        json.dump({"users": users, "seed": seed, "hasher": spec, "samples": sample_accounts}, file)
+    return sample_accounts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Database_txt folder for benchmarks.")
+    parser.add_argument("directory", help="where to create Database_txt/")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--codes-per-user", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=200, help="accounts with a usable password")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    generate(args.directory, args.users, args.codes_per_user, args.samples, args.seed)
+    print(f"\033[1;32m[Success] {args.users} users written to {args.directory}/Database_txt.\033[0m")
+
+
+if __name__ == "__main__":
+    main()
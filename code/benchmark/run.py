@@ -0,0 +1,281 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from unittest import mock
+
+import password_hasher
+import storage
+from benchmark.generate import SAMPLE_PASSWORD, SAMPLES_FILE, generate
+from binary_store import text_to_binary
+from change_password import ChangePassword
+from forget_password import Recovery
+from login import LoginSystem
+from register import UserSystem
+from sqlite_store import get_pool, import_text_files
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+USER_DATA_FILE = "database.txt"
+BACKUP_CODE_FILE = "backup_codes.txt"
+OPERATIONS = ("find_user", "register", "login", "recover", "change_password")
+DEFAULT_SIZES = "10000,100000,1000000"
+# Cheap enough that the numbers show how storage scales rather than the hash cost.
+DEFAULT_HASHER = "pbkdf2_sha256$i=1000"
+
+
+@contextlib.contextmanager
+def scripted(answers):
+    """Feeds answers to input() in order, captures what is printed and makes time.sleep return at once."""
+    output = io.StringIO()
+    with mock.patch("builtins.input", side_effect=list(answers)), mock.patch("time.sleep"), \
+            contextlib.redirect_stdout(output):
+        yield output
+
+
+class Workload:
+    """Drives the terminal classes through one operation with scripted answers.
+
+    Each method runs one iteration and tells whether it ended the way a
+    successful user session would.
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.passwords = {sample["identifier"]: SAMPLE_PASSWORD for sample in samples}
+        self.unused_codes = {sample["identifier"]: list(sample["backup_codes"]) for sample in samples}
+        self.user_system = UserSystem(USER_DATA_FILE, BACKUP_CODE_FILE)
+        self.login_system = LoginSystem(USER_DATA_FILE)
+        self.recovery = Recovery(USER_DATA_FILE, BACKUP_CODE_FILE)
+        self.change_password_system = ChangePassword(USER_DATA_FILE)
+
+    def load(self):
+        """Builds the in-memory indexes, which the first request would otherwise pay for."""
+        self.login_system.user_store.refresh()
+        self.recovery.backup_code_store.refresh()
+
+    def _sample(self, iteration):
+        return self.samples[iteration % len(self.samples)]
+
+    def find_user(self, iteration):
+        sample = self._sample(iteration)
+        return self.login_system.find_user(sample["identifier"]) is not None
+
+    def register(self, iteration):
+        # A taken email and a taken username first, so the duplicate checks run on both steps.
+        sample = self._sample(iteration)
+        answers = [sample["identifier"], f"bench.{iteration}@gmail.com",
+                   sample["username"], f"bench user {iteration}", "Passw0rd!", "Passw0rd!"]
+        with scripted(answers) as output:
+            self.user_system.register_user()
+        return "registered successfully" in output.getvalue()
+
+    def login(self, iteration):
+        identifier = self._sample(iteration)["identifier"]
+        with scripted([identifier, self.passwords[identifier], "3"]) as output:
+            self.login_system.user_login()
+        return "Login successful!" in output.getvalue()
+
+    def recover(self, iteration):
+        identifier = self._sample(iteration)["identifier"]
+        if not self.unused_codes[identifier]:
+            return False
+        new_password = f"Reset!{iteration:04d}"
+        with scripted([identifier, self.unused_codes[identifier].pop(), new_password]) as output:
+            self.recovery.recover_password()
+        self.passwords[identifier] = new_password
+        return "Password reset successfully!" in output.getvalue()
+
+    def change_password(self, iteration):
+        identifier = self._sample(iteration)["identifier"]
+        new_password = f"Chang3d!{iteration:04d}"
+        with scripted([self.passwords[identifier], new_password]) as output:
+            self.change_password_system.change_password(identifier)
+        self.passwords[identifier] = new_password
+        return "Password changed successfully!" in output.getvalue()
+
+
+def _percentile(sorted_values, percent):
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return round(peak / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+def run_operation(directory, operation, iterations):
+    """Runs in a fresh process so its peak RSS belongs to this operation and size alone."""
+    os.chdir(directory)
+    with open(SAMPLES_FILE, "r") as file:
+        samples = json.load(file)["samples"]
+    if storage.STORAGE == "sqlite":
+        import_text_files(get_pool(os.path.join("Database_txt", storage.SQLITE_DATABASE_FILE)),
+                          os.path.join("Database_txt", USER_DATA_FILE), os.path.join("Database_txt", BACKUP_CODE_FILE))
+    elif storage.STORAGE == "binary":
+        text_to_binary(os.path.join("Database_txt", USER_DATA_FILE), os.path.join("Database_txt", "database.bin"))
+
+    started = time.perf_counter()
+    workload = Workload(samples)
+    workload.load()
+    load_seconds = time.perf_counter() - started
+
+    step = getattr(workload, operation)
+    latencies = []
+    errors = 0
+    for iteration in range(iterations):
+        started = time.perf_counter()
+        ok = step(iteration)
+        latencies.append(time.perf_counter() - started)
+        errors += not ok
+
+    latencies.sort()
+    return {
+        "operation": operation,
+        "iterations": iterations,
+        "errors": errors,
+        "load_ms": round(load_seconds * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "ops_per_sec": round(len(latencies) / sum(latencies), 1),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _base_directory(workdir, users, seed, hasher):
+    """Generates the data for one size once and reuses it while the settings match."""
+    directory = os.path.join(workdir, f"users-{users}-seed-{seed}")
+    samples_file = os.path.join(directory, SAMPLES_FILE)
+    if os.path.exists(samples_file):
+        with open(samples_file, "r") as file:
+            if json.load(file)["hasher"] == hasher:
+                return directory
+    print(f"Generating {users} users in {directory} ...")
+    shutil.rmtree(directory, ignore_errors=True)
+    generate(directory, users, seed=seed)
+    return directory
+
+
+def run(sizes, operations, iterations, workdir, seed=0, hasher=DEFAULT_HASHER):
+    """Benchmarks every operation at every size. Returns the result records."""
+    # Spawned processes read the hasher from the environment; this process is told directly.
+    os.environ["VERIFY_ME_HASHER"] = hasher
+    password_hasher.HASHER_SPEC = hasher
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for users in sizes:
+        base = _base_directory(workdir, users, seed, hasher)
+        for operation in operations:
+            # Operations change the data, so each one starts from a fresh copy.
+            directory = os.path.join(workdir, f"run-{users}-{operation}")
+            shutil.rmtree(directory, ignore_errors=True)
+            shutil.copytree(base, directory)
+            with context.Pool(1) as pool:
+                result = pool.apply(run_operation, (directory, operation, iterations))
+            shutil.rmtree(directory, ignore_errors=True)
+            result["users"] = users
+            results.append(result)
+            print(f"{users:>9} {operation:<16} p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  "
+                  f"p99 {result['p99_ms']:>9.3f} ms  {result['ops_per_sec']:>9.1f} ops/s  "
+                  f"load {result['load_ms']:>9.1f} ms  rss {result['peak_rss_mb']} MB"
+                  + (f"  \033[1;31m{result['errors']} errors\033[0m" if result["errors"] else ""))
+    return results
+
+
+def compare(old_file, new_file, threshold):
+    """Prints how latency and throughput moved between two result files. Returns the regressions."""
+    with open(old_file, "r") as file:
+        old = {(r["users"], r["operation"]): r for r in json.load(file)["results"]}
+    with open(new_file, "r") as file:
+        new = {(r["users"], r["operation"]): r for r in json.load(file)["results"]}
+
+    regressions = []
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        changes = {}
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "ops_per_sec", "peak_rss_mb"):
+            if before.get(metric) and after.get(metric) is not None:
+                changes[metric] = (after[metric] - before[metric]) / before[metric] * 100
+        worse = [metric for metric, change in changes.items()
+                 if (change < -threshold if metric == "ops_per_sec" else change > threshold)]
+        color = "\033[1;31m" if worse else "\033[1;32m"
+        summary = "  ".join(f"{metric} {change:+.1f}%" for metric, change in changes.items())
+        print(f"{color}{key[0]:>9} {key[1]:<16}\033[0m {summary}")
+        if worse:
+            regressions.append((key, worse))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark",
+                                     description="Measure the account operations on synthetic databases.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks and save the results")
+    run_parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"user counts (default {DEFAULT_SIZES})")
+    run_parser.add_argument("--operations", default=",".join(OPERATIONS))
+    run_parser.add_argument("--iterations", type=int, default=100, help="calls per operation and size")
+    run_parser.add_argument("--output", default="benchmark_results.json")
+    run_parser.add_argument("--workdir", help="keep generated data here for later runs (default: a temp folder)")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--hasher", default=DEFAULT_HASHER,
+                            help=f"password hasher for the sample accounts (default {DEFAULT_HASHER})")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=10, help="percent change counted as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare(args.old, args.new, args.threshold)
+        if regressions:
+            print(f"\033[1;31m{len(regressions)} regression(s) above {args.threshold}%.\033[0m")
+            sys.exit(1)
+        print("\033[1;32mNo regressions.\033[0m")
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    operations = [operation for operation in args.operations.split(",") if operation]
+    unknown = set(operations) - set(OPERATIONS)
+    if unknown:
+        parser.error(f"unknown operations: {', '.join(sorted(unknown))}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="verify-me-bench-")
+    try:
+        results = run(sizes, operations, args.iterations, workdir, args.seed, args.hasher)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "meta": {
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "storage": storage.STORAGE,
+                "append_only": storage.APPEND_ONLY,
+                "hasher": args.hasher,
+                "iterations": args.iterations,
+                "seed": args.seed,
+            },
+            "results": results,
+        }, file, indent=2)
+    print(f"\033[1;32m[Success] Results saved to {args.output}.\033[0m")
@@ -0,0 +1,459 @@
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from file_lock import FileLock, atomic_write, fsync_directory
+from metrics import instrumented
+from record_log import RecordLog
+from user_store import UserRecord
+
+# database.bin: a 4 KB header page, then one fixed-width slot per user in insertion order.
+# database.bin.idx: two open-addressing hash tables (identifier, username) of 4-byte
+# slot numbers + 1 (0 = empty), so a lookup touches one index page and one slot page.
+MAGIC = b"VMUSERS1"
+INDEX_MAGIC = b"VMUIDX01"
+HEADER_SIZE = 4096
+# magic, identifier width, username width, digest width, record count, index generation, spec count
+HEADER = struct.Struct("<8sHHHQQH")
+COUNT_OFFSET, GENERATION_OFFSET, SPEC_COUNT_OFFSET = 14, 22, 30
+INDEX_HEADER = struct.Struct("<8sQQQ")  # magic, capacity, records indexed, generation
+INDEXED_OFFSET = 16
+INDEX_ENTRY = struct.Struct("<I")
+MAX_LOAD = 0.5
+LIVE = 1  # first byte of every written slot
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "little")
+
+
+class BinaryUserStore:
+    """UserStore interface over a fixed-width binary file read through mmap.
+
+    A slot holds the identifier and username NUL-padded to fixed widths, the
+    hasher spec as an index into a table in the header, and the raw salt and
+    digest bytes. Password changes overwrite their slot in place; new users are
+    appended and indexed. Readers take the shared file lock, writers the
+    exclusive one, like the text stores; only writers ever modify the index file.
+    """
+
+    def __init__(self, data_file, identifier_width=48, username_width=40, digest_width=64):
+        self.data_file = data_file
+        self.index_file = data_file + ".idx"
+        self.file_lock = FileLock(data_file)
+        self._lock = threading.RLock()
+        self._map = None
+        self._index_map = None
+        self._identity = None
+        self._index_persisted = False
+        with self.file_lock.exclusive():
+            if not os.path.exists(data_file):
+                _write_empty(data_file, identifier_width, username_width, digest_width)
+            self._open(writable=True)
+
+    # --- layout -------------------------------------------------------------
+
+    def _open(self, writable):
+        """(Re)maps both files and reads the header."""
+        self.close()
+        with open(self.data_file, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self._identity = (stat.st_dev, stat.st_ino)
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.identifier_width, self.username_width, self.digest_width,
+         self.record_count, self.generation, spec_count) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise IOError(f"{self.data_file} is not a binary user file.")
+        self.specs = _read_specs(self._map, spec_count)
+        self.slot_size = 1 + self.identifier_width + self.username_width + 1 + 16 + 1 + self.digest_width
+        self._open_index(writable)
+
+    def _open_index(self, writable):
+        try:
+            with open(self.index_file, "rb") as file:
+                self._index_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, self.capacity, self.indexed, generation = INDEX_HEADER.unpack_from(self._index_map)
+            valid = magic == INDEX_MAGIC and generation == self.generation and self.indexed <= self.record_count
+        except (OSError, ValueError, struct.error):
+            valid = False
+        self._index_persisted = valid
+        if not valid:
+            # Missing, stale or damaged: the slots are the truth, so index them again (in memory
+            # only when we hold just the shared lock; the next writer saves it).
+            self._rebuild_index(_capacity_for(self.record_count), persist=writable)
+
+    def close(self):
+        for name in ("_map", "_index_map"):
+            mapped = getattr(self, name)
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+            setattr(self, name, None)
+
+    def _check_current(self, writable=False):
+        """Remaps when another process appended users or replaced a file since we last looked.
+
+        Writers (writable=True) also save a rebuilt index and index slots a crashed
+        writer left unindexed; readers scan those few slots instead.
+        """
+        try:
+            stat = os.stat(self.data_file)
+        except FileNotFoundError:
+            raise IOError(f"{self.data_file} disappeared.")
+        record_count, generation, spec_count = struct.unpack_from("<QQH", self._map, COUNT_OFFSET)
+        if ((stat.st_dev, stat.st_ino) != self._identity or generation != self.generation
+                or spec_count != len(self.specs) or HEADER_SIZE + record_count * self.slot_size > len(self._map)
+                or writable and not self._index_persisted):
+            self._open(writable)
+        else:
+            self.record_count = record_count
+            if self._index_persisted:
+                (self.indexed,) = struct.unpack_from("<Q", self._index_map, INDEXED_OFFSET)
+        if writable and self.indexed < self.record_count:
+            self._catch_up_index()
+
+    def _slot_offset(self, number):
+        return HEADER_SIZE + number * self.slot_size
+
+    # --- slots --------------------------------------------------------------
+
+    def _encode(self, record):
+        identifier = record.identifier.encode()
+        username = record.username.encode()
+        if len(identifier) > self.identifier_width or len(username) > self.username_width:
+            raise IOError(f"Email/phone or username too long for {self.data_file}.")
+        if "$" in record.hashed_password:
+            spec, salt_hex, digest_hex = record.hashed_password.rsplit("$", 2)
+        else:
+            spec, salt_hex, digest_hex = "", record.salt_hex, record.hashed_password
+        salt, digest = bytes.fromhex(salt_hex), bytes.fromhex(digest_hex)
+        if len(salt) != 16 or len(digest) > self.digest_width:
+            raise IOError(f"Password hash of {record.identifier} does not fit {self.data_file}.")
+        return (bytes([LIVE]) + identifier.ljust(self.identifier_width, b"\0")
+                + username.ljust(self.username_width, b"\0") + bytes([self._spec_number(spec)])
+                + salt + bytes([len(digest)]) + digest.ljust(self.digest_width, b"\0"))
+
+    def _decode(self, slot):
+        position = 1
+        identifier = slot[position:position + self.identifier_width].rstrip(b"\0").decode()
+        position += self.identifier_width
+        username = slot[position:position + self.username_width].rstrip(b"\0").decode()
+        position += self.username_width
+        spec = self.specs[slot[position]]
+        salt = slot[position + 1:position + 17]
+        digest = slot[position + 18:position + 18 + slot[position + 17]]
+        if not spec:
+            return UserRecord(identifier, username, salt.hex(), digest.hex())
+        return UserRecord(identifier, username, salt.hex(), f"{spec}${salt.hex()}${digest.hex()}")
+
+    def _slot(self, number):
+        offset = self._slot_offset(number)
+        return self._map[offset:offset + self.slot_size]
+
+    def _slot_key(self, slot, column):
+        if column == 0:
+            return slot[1:1 + self.identifier_width].rstrip(b"\0")
+        start = 1 + self.identifier_width
+        return slot[start:start + self.username_width].rstrip(b"\0")
+
+    def _spec_number(self, spec):
+        """Returns the header table index of a hasher spec, adding it (under the write lock) if new."""
+        if spec in self.specs:
+            return self.specs.index(spec)
+        if len(self.specs) >= 255 or _specs_size(self.specs + [spec]) > HEADER_SIZE - HEADER.size:
+            raise IOError(f"Too many password hashing settings for {self.data_file}.")
+        self.specs.append(spec)
+        with open(self.data_file, "r+b") as file:
+            _write_specs(file, self.specs)
+            file.seek(SPEC_COUNT_OFFSET)
+            file.write(struct.pack("<H", len(self.specs)))
+        return len(self.specs) - 1
+
+    # --- index --------------------------------------------------------------
+
+    def _table_offset(self, column):
+        return INDEX_HEADER.size + column * self.capacity * INDEX_ENTRY.size
+
+    def _lookup(self, column, key):
+        """Returns the slot number holding key in column (0 identifier, 1 username), or None."""
+        mask = self.capacity - 1
+        table = self._table_offset(column)
+        position = _hash(key) & mask
+        while True:
+            (entry,) = INDEX_ENTRY.unpack_from(self._index_map, table + position * INDEX_ENTRY.size)
+            if entry == 0:
+                return None
+            number = entry - 1
+            if number < self.record_count and self._slot_key(self._slot(number), column) == key:
+                return number
+            position = (position + 1) & mask
+
+    def _find(self, column, key):
+        number = self._lookup(column, key)
+        if number is None:
+            # Slots appended by a writer that crashed before indexing them.
+            for candidate in range(self.indexed, self.record_count):
+                if self._slot_key(self._slot(candidate), column) == key:
+                    return candidate
+        return number
+
+    def _insert_entries(self, file, table_entries):
+        """Writes (column, key, number) entries into the index file open as file."""
+        mask = self.capacity - 1
+        for column, key, number in table_entries:
+            table = self._table_offset(column)
+            position = _hash(key) & mask
+            while True:
+                offset = table + position * INDEX_ENTRY.size
+                file.seek(offset)
+                (entry,) = INDEX_ENTRY.unpack(file.read(INDEX_ENTRY.size))
+                if entry == 0 or entry == number + 1:
+                    file.seek(offset)
+                    file.write(INDEX_ENTRY.pack(number + 1))
+                    break
+                position = (position + 1) & mask
+
+    def _rebuild_index(self, capacity, persist=True):
+        tables = [bytearray(capacity * INDEX_ENTRY.size) for _ in range(2)]
+        mask = capacity - 1
+        for number in range(self.record_count):
+            slot = self._slot(number)
+            if slot[0] != LIVE:
+                continue
+            for column in (0, 1):
+                position = _hash(self._slot_key(slot, column)) & mask
+                while INDEX_ENTRY.unpack_from(tables[column], position * INDEX_ENTRY.size)[0]:
+                    position = (position + 1) & mask
+                INDEX_ENTRY.pack_into(tables[column], position * INDEX_ENTRY.size, number + 1)
+        header = INDEX_HEADER.pack(INDEX_MAGIC, capacity, self.record_count, self.generation)
+        if isinstance(self._index_map, mmap.mmap):
+            self._index_map.close()
+        if persist:
+            with atomic_write(self.index_file, "wb") as file:
+                file.write(header + tables[0] + tables[1])
+            with open(self.index_file, "rb") as file:
+                self._index_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._index_map = header + tables[0] + tables[1]
+        self._index_persisted = persist
+        self.capacity = capacity
+        self.indexed = self.record_count
+
+    def _catch_up_index(self):
+        """Indexes the slots after self.indexed. Needs the exclusive lock."""
+        entries = []
+        for number in range(self.indexed, self.record_count):
+            slot = self._slot(number)
+            entries += [(0, self._slot_key(slot, 0), number), (1, self._slot_key(slot, 1), number)]
+        with open(self.index_file, "r+b") as file:
+            self._insert_entries(file, entries)
+            file.seek(INDEXED_OFFSET)
+            file.write(struct.pack("<Q", self.record_count))
+        self.indexed = self.record_count
+
+    # --- UserStore interface ------------------------------------------------
+
+    def refresh(self):
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+
+    @instrumented("find_user")
+    def find_user(self, email_or_phone):
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+            number = self._find(0, email_or_phone.encode())
+            return None if number is None else self._decode(self._slot(number))
+
+    def find_users(self, identifiers):
+        """Returns {identifier: UserRecord} for those of identifiers that exist, under one lock."""
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+            found = {}
+            for identifier in identifiers:
+                number = self._find(0, identifier.encode())
+                if number is not None:
+                    found[identifier] = self._decode(self._slot(number))
+            return found
+
+    def find_by_username(self, username):
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+            number = self._find(1, username.encode())
+            return None if number is None else self._decode(self._slot(number))
+
+    def identifier_exists(self, email_or_phone):
+        return self.find_user(email_or_phone) is not None
+
+    def username_exists(self, username):
+        return self.find_by_username(username) is not None
+
+    def live_records(self):
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+            return self.records_from(0)
+
+    def records_from(self, number):
+        """Returns the live records in slots number onwards, in insertion order."""
+        with self._lock, self.file_lock.shared():
+            self._check_current()
+            return [self._decode(slot) for slot in (self._slot(n) for n in range(number, self.record_count))
+                    if slot[0] == LIVE]
+
+    def add_user(self, record):
+        return not self.add_users([record])
+
+    @instrumented("add_users")
+    def add_users(self, records):
+        """Appends the users not taken yet. Returns the records refused as duplicates."""
+        refused = []
+        with self._lock, self.file_lock.exclusive():
+            self._check_current(writable=True)
+            accepted = []
+            identifiers, usernames = set(), set()
+            for record in records:
+                if (record.identifier in identifiers or record.username in usernames
+                        or self._find(0, record.identifier.encode()) is not None
+                        or self._find(1, record.username.encode()) is not None):
+                    refused.append(record)
+                    continue
+                identifiers.add(record.identifier)
+                usernames.add(record.username)
+                accepted.append(record)
+            if not accepted:
+                return refused
+
+            first = self.record_count
+            slots = b"".join(self._encode(record) for record in accepted)
+            count = first + len(accepted)
+            # Slots first, then the count that makes them visible, then the index; a crash in
+            # between leaves slots that the next writer or reader indexes (see _check_current).
+            with open(self.data_file, "r+b") as file:
+                file.seek(self._slot_offset(first))
+                file.write(slots)
+                file.seek(COUNT_OFFSET)
+                file.write(struct.pack("<Q", count))
+            self._open(writable=True)
+            if count > self.capacity * MAX_LOAD:
+                # A bigger index replaces the file; the new generation tells other processes to remap it.
+                self.generation += 1
+                with open(self.data_file, "r+b") as file:
+                    file.seek(GENERATION_OFFSET)
+                    file.write(struct.pack("<Q", self.generation))
+                self._rebuild_index(_capacity_for(count))
+            else:
+                self._catch_up_index()
+        return refused
+
+    def sync(self):
+        """Makes every write so far durable."""
+        with self._lock, open(self.data_file, "rb") as file:
+            os.fsync(file.fileno())
+
+    @instrumented("update_user")
+    def update_user(self, record, expected=None):
+        """Overwrites the user's slot in place. Returns False if the user is unknown or changed meanwhile."""
+        with self._lock, self.file_lock.exclusive():
+            self._check_current(writable=True)
+            number = self._find(0, record.identifier.encode())
+            if number is None:
+                return False
+            current = self._decode(self._slot(number))
+            if expected is not None and current != expected:
+                return False
+            slot = self._encode(record)
+            with open(self.data_file, "r+b") as file:
+                file.seek(self._slot_offset(number))
+                file.write(slot)
+            if record.username != current.username:
+                # The old entry no longer matches its slot and is skipped by lookups.
+                with open(self.index_file, "r+b") as file:
+                    self._insert_entries(file, [(1, record.username.encode(), number)])
+            return True
+
+
+def _capacity_for(count):
+    capacity = 1024
+    while count > capacity * MAX_LOAD:
+        capacity *= 2
+    return capacity
+
+
+def _read_specs(data, count):
+    specs = []
+    position = HEADER.size
+    for _ in range(count):
+        length = data[position]
+        specs.append(bytes(data[position + 1:position + 1 + length]).decode())
+        position += 1 + length
+    return specs
+
+
+def _specs_size(specs):
+    return sum(1 + len(spec.encode()) for spec in specs)
+
+
+def _write_specs(file, specs):
+    file.seek(HEADER.size)
+    file.write(b"".join(bytes([len(spec.encode())]) + spec.encode() for spec in specs))
+
+
+def _write_empty(data_file, identifier_width, username_width, digest_width):
+    header = bytearray(HEADER_SIZE)
+    HEADER.pack_into(header, 0, MAGIC, identifier_width, username_width, digest_width, 0, 0, 0)
+    with atomic_write(data_file, "wb") as file:
+        file.write(header)
+    if os.path.exists(data_file + ".idx"):
+        os.remove(data_file + ".idx")
+
+
+def create(data_file, records, identifier_width=48, username_width=40, digest_width=64):
+    """Writes a new binary user file (and its index) holding records. Replaces any existing one."""
+    _write_empty(data_file, identifier_width, username_width, digest_width)
+    store = BinaryUserStore(data_file)
+    if records:
+        refused = store.add_users(records)
+        if refused:
+            raise ValueError(f"Duplicate users: {', '.join(record.identifier for record in refused[:5])}")
+    store.close()
+    fsync_directory(os.path.dirname(data_file))
+
+
+def text_to_binary(text_file, data_file):
+    """Converts database.txt into data_file. Field widths are sized to the data. Returns the user count."""
+    latest = {}
+    for key, fields in RecordLog(text_file, key_fields=1, min_fields=4).read(from_start=True):
+        if fields is None:
+            latest.pop(key, None)
+        else:
+            latest[key] = UserRecord(*fields[:4])
+    records = list(latest.values())
+    identifier_width = max([48] + [len(r.identifier.encode()) for r in records])
+    username_width = max([40] + [len(r.username.encode()) for r in records])
+    create(data_file, records, identifier_width, username_width)
+    return len(records)
+
+
+def binary_to_text(data_file, text_file):
+    """Writes every user of data_file to text_file in the database.txt format. Returns the user count."""
+    store = BinaryUserStore(data_file)
+    records = store.live_records()
+    store.close()
+    with atomic_write(text_file) as file:
+        for record in records:
+            file.write(",".join(record) + "\n")
+    return len(records)
+
+
+if __name__ == "__main__":
+    # python code/binary_store.py to-binary|to-text  -- run from the project folder
+    text_file = os.path.join("Database_txt", "database.txt")
+    data_file = os.path.join("Database_txt", "database.bin")
+    if sys.argv[1:] == ["to-binary"]:
+        print(f"Converted {text_to_binary(text_file, data_file)} users into {data_file}.")
+    elif sys.argv[1:] == ["to-text"]:
+        print(f"Converted {binary_to_text(data_file, text_file)} users into {text_file}.")
+    else:
+        print("Usage: python code/binary_store.py to-binary|to-text")
+        sys.exit(1)
@@ -0,0 +1,208 @@
+import argparse
+import getpass
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+from file_lock import atomic_write
+from uniqueness import BloomFilter
+
+# Set VERIFY_ME_BLOCKLIST to the file built by "python code/blocklist.py build"; by default
+# Database_txt/breached_passwords.bin is used when it exists.
+BLOCKLIST_FILE = os.environ.get("VERIFY_ME_BLOCKLIST", os.path.join("Database_txt", "breached_passwords.bin"))
+
+MAGIC = b"VMBREACH"
+HEADER = struct.Struct("<8sI4x")  # magic, prefix width in bytes
+BLOOM_MAGIC = b"VMBLKBF1"
+BLOOM_HEADER = struct.Struct("<8sQd")  # magic, capacity, error rate
+
+
+def password_prefix(password, width):
+    """The first width bytes of the password's SHA-1, as stored in the blocklist."""
+    return hashlib.sha1(password.encode()).digest()[:width]
+
+
+class Blocklist:
+    """Membership test against a sorted file of fixed-width SHA-1 prefixes, read through mmap.
+
+    Nothing is loaded into memory: a lookup is a binary search over the mapped
+    file, optionally preceded by a memory-mapped Bloom filter (path + ".bloom")
+    that answers most "not breached" lookups from a handful of pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.width = HEADER.unpack_from(self._map)
+        if magic != MAGIC or self.width <= 0 or (len(self._map) - HEADER.size) % self.width:
+            self._map.close()
+            raise ValueError(f"{path} is not a breached password blocklist.")
+        self.count = (len(self._map) - HEADER.size) // self.width
+        self.bloom = self._open_bloom(path + ".bloom")
+
+    def _open_bloom(self, path):
+        try:
+            with open(path, "rb") as file:
+                bloom_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        magic, capacity, error_rate = BLOOM_HEADER.unpack_from(bloom_map)
+        bloom = BloomFilter(capacity, error_rate, bits=memoryview(bloom_map)[BLOOM_HEADER.size:])
+        if magic != BLOOM_MAGIC or capacity != self.count or len(bloom.bits) != bloom.byte_size():
+            return None  # stale or foreign filter; the sorted file alone is still correct
+        return bloom
+
+    def contains_prefix(self, prefix):
+        if self.bloom is not None and prefix.hex() not in self.bloom:
+            return False
+        data, width = self._map, self.width
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * width
+            if data[offset:offset + width] < prefix:
+                low = middle + 1
+            else:
+                high = middle
+        offset = HEADER.size + low * width
+        return low < self.count and data[offset:offset + width] == prefix
+
+    def __contains__(self, password):
+        return self.contains_prefix(password_prefix(password, self.width))
+
+
+def _prefixes(lines, width, plain):
+    """Reads "SHA1HEX[:count]" lines (or plain passwords) and yields their prefixes."""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if plain:
+            yield password_prefix(line, width)
+            continue
+        try:
+            yield bytes.fromhex(line.split(":", 1)[0][:width * 2])
+        except ValueError:
+            continue
+
+
+def _write_run(prefixes, directory):
+    prefixes.sort()
+    fd, path = tempfile.mkstemp(prefix="blocklist.", suffix=".run", dir=directory)
+    with os.fdopen(fd, "wb") as file:
+        file.write(b"".join(prefixes))
+    return path
+
+
+def _read_run(path, width, offset=0):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        while True:
+            block = file.read(width * 65536)
+            if not block:
+                return
+            for start in range(0, len(block), width):
+                yield block[start:start + width]
+
+
+def build(source_file, output_file, width=8, plain=False, bloom_error_rate=None, run_size=1000000):
+    """Builds a blocklist from a text dump with an external merge sort. Returns the distinct prefix count.
+
+    The dump is split into sorted runs of run_size prefixes in temp files next to
+    output_file, which are then merged and de-duplicated, so memory stays bounded
+    whatever the dump's size.
+    """
+    directory = os.path.dirname(output_file) or "."
+    runs = []
+    try:
+        with open(source_file, "r", encoding="utf-8", errors="replace") as source:
+            chunk = []
+            for prefix in _prefixes(source, width, plain):
+                if len(prefix) != width:
+                    continue
+                chunk.append(prefix)
+                if len(chunk) >= run_size:
+                    runs.append(_write_run(chunk, directory))
+                    chunk = []
+            if chunk:
+                runs.append(_write_run(chunk, directory))
+
+        count = 0
+        with atomic_write(output_file, "wb") as output:
+            output.write(HEADER.pack(MAGIC, width))
+            previous = None
+            for prefix in heapq.merge(*(_read_run(run, width) for run in runs)):
+                if prefix != previous:
+                    output.write(prefix)
+                    previous = prefix
+                    count += 1
+    finally:
+        for run in runs:
+            os.remove(run)
+
+    bloom_file = output_file + ".bloom"
+    if bloom_error_rate:
+        bloom = BloomFilter(max(count, 1), bloom_error_rate)
+        for prefix in _read_run(output_file, width, HEADER.size):
+            bloom.add(prefix.hex())
+        with atomic_write(bloom_file, "wb") as file:
+            file.write(BLOOM_HEADER.pack(BLOOM_MAGIC, max(count, 1), bloom_error_rate))
+            file.write(bloom.bits)
+    elif os.path.exists(bloom_file):
+        os.remove(bloom_file)
+    return count
+
+
+_lock = threading.Lock()
+_blocklists = {}
+
+
+def get_blocklist(path=None):
+    """Returns the shared Blocklist for path (default BLOCKLIST_FILE), or None if there is no such file."""
+    path = path or BLOCKLIST_FILE
+    with _lock:
+        if path not in _blocklists:
+            _blocklists[path] = Blocklist(path) if os.path.exists(path) else None
+        return _blocklists[path]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the breached password blocklist.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build_parser = commands.add_parser("build", help="build the blocklist from a text dump")
+    build_parser.add_argument("source", help='one "SHA1HEX" or "SHA1HEX:count" per line (e.g. a Pwned Passwords dump)')
+    build_parser.add_argument("--output", default=BLOCKLIST_FILE)
+    build_parser.add_argument("--prefix-bytes", type=int, default=8,
+                              help="bytes of each SHA-1 kept (default 8; collisions are negligible)")
+    build_parser.add_argument("--plain", action="store_true", help="the source lists passwords, not hashes")
+    build_parser.add_argument("--bloom", type=float, metavar="ERROR_RATE",
+                              help="also write a Bloom filter with this false positive rate (e.g. 0.01)")
+    build_parser.add_argument("--run-size", type=int, default=1000000, help="prefixes sorted in memory at a time")
+    commands.add_parser("check", help="tell whether a password is on the blocklist")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        if not 1 <= args.prefix_bytes <= 20:
+            parser.error("--prefix-bytes must be between 1 and 20")
+        count = build(args.source, args.output, args.prefix_bytes, args.plain, args.bloom, args.run_size)
+        print(f"\033[1;32m[Success] {count} breached password hashes written to {args.output}.\033[0m")
+        return
+
+    blocklist = get_blocklist()
+    if blocklist is None:
+        print(f"\033[1;31m[Error] No blocklist at {BLOCKLIST_FILE}.\033[0m")
+        sys.exit(1)
+    if getpass.getpass("Password to check: ") in blocklist:
+        print("\033[1;31mThis password has appeared in a data breach.\033[0m")
+    else:
+        print("\033[1;32mNot found in the blocklist.\033[0m")
+
+
+if __name__ == "__main__":
+    main()
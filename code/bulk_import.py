@@ -0,0 +1,221 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import auth_api
+from change_feed import get_change_feed, register_event
+from journal import codes_op, get_journal, user_op
+from password_policy import REGISTER_POLICY
+from storage import get_backup_code_store, get_user_store
+from user_store import UserRecord
+
+FIELDS = ("identifier", "username", "password")
+
+
+def read_rows(path, file_format):
+    """Streams (line_number, row dict) from a CSV file with a header or from JSON lines."""
+    with open(path, "r", newline="") as file:
+        if file_format == "jsonl":
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield line_number, row if isinstance(row, dict) else None
+        else:
+            reader = csv.DictReader(file)
+            for row in reader:
+                yield reader.line_num, row
+
+
+def validate_row(row, seen_identifiers, seen_usernames, user_store):
+    """Applies the registration rules to one input row. Returns (fields, None) or (None, reason)."""
+    if row is None or any(not isinstance(row.get(field), str) for field in FIELDS):
+        return None, "missing field (need identifier, username, password)"
+    identifier, username, password = (row[field].strip() for field in FIELDS)
+
+    is_valid, reason = auth_api.validate_identifier(identifier)
+    if not is_valid:
+        return None, reason
+    is_valid, reason = auth_api.validate_username(username)
+    if not is_valid:
+        return None, reason
+    if username == identifier:
+        return None, "Username and email/phone number cannot be the same."
+    reason = REGISTER_POLICY.check(password)
+    if reason:
+        return None, reason
+
+    if identifier in seen_identifiers:
+        return None, "duplicate email or phone number in this import"
+    if username in seen_usernames:
+        return None, "duplicate username in this import"
+    if user_store.identifier_exists(identifier):
+        return None, "This email or phone number is already registered."
+    if user_store.username_exists(username):
+        return None, "This username is already taken."
+
+    seen_identifiers.add(identifier)
+    seen_usernames.add(username)
+    return (identifier, username, password), None
+
+
+def hash_chunk(rows):
+    """Runs in a worker process: salts, hashes and generates backup codes for a chunk of users."""
+    hashed = []
+    for identifier, username, password in rows:
+        salt = os.urandom(16)
+        record = UserRecord(identifier, username, salt.hex(), auth_api.hash_password(password, salt))
+        hashed.append((record, auth_api.generate_backup_codes(10)))
+    return hashed
+
+
+class BulkImporter:
+    """Registers users from a CSV/JSONL file in chunks: validate, hash in parallel, append in bulk.
+
+    Each user's backup codes are written in plain text to codes_file, the only place they
+    can be handed out from: the stores keep just their HMACs.
+    """
+
+    def __init__(self, user_data_file="database.txt", backup_code_file="backup_codes.txt",
+                 workers=None, chunk_size=2000, rejects_file=None, codes_file=None, progress=sys.stdout):
+        if not codes_file:
+            raise ValueError("codes_file is required: the backup codes cannot be recovered afterwards.")
+        self.user_store = get_user_store(os.path.join("Database_txt", user_data_file))
+        self.backup_code_store = get_backup_code_store(os.path.join("Database_txt", backup_code_file))
+        self.feed = get_change_feed(os.path.join("Database_txt", user_data_file))
+        self.journal = get_journal(os.path.join("Database_txt", user_data_file))
+        if self.journal is not None:
+            self.journal.recover(self.user_store, self.backup_code_store)
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.rejects_file = rejects_file
+        self.codes_file = codes_file
+        self.progress = progress
+        self.imported = 0
+        self.rejected = 0
+
+    def _reject(self, writer, where, identifier, reason):
+        self.rejected += 1
+        if writer is not None:
+            writer.writerow([where, identifier, reason])
+
+    def _write_chunk(self, hashed, rejects, codes):
+        if self.feed is None:
+            self._store_chunk(hashed, rejects, codes)
+            return
+        with self.feed.publishing() as events:
+            for record, stored_codes in self._store_chunk(hashed, rejects, codes):
+                events.append(register_event(record, stored_codes))
+
+    @contextmanager
+    def _journaled(self, ops_lists):
+        """Runs the block that applies a chunk as one journal entry per user, if the journal is on."""
+        if self.journal is None:
+            yield
+        else:
+            with self.journal.entries(ops_lists):
+                yield
+
+    def _store_chunk(self, hashed, rejects, codes):
+        """Writes a chunk's users and codes. Returns the (record, stored backup codes) of those written."""
+        stored = {record.identifier: self.backup_code_store.digests(record.identifier, backup_codes)
+                  for record, backup_codes in hashed}
+        ops_lists = [[user_op(None, record), codes_op(record.identifier, add=stored[record.identifier])]
+                     for record, _ in hashed]
+        with self._journaled(ops_lists):
+            refused = {record.identifier for record in self.user_store.add_users([record for record, _ in hashed])}
+            codes_by_identifier = {}
+            for record, backup_codes in hashed:
+                if record.identifier in refused:
+                    self._reject(rejects, "", record.identifier, "registered by someone else during the import")
+                    continue
+                codes_by_identifier[record.identifier] = backup_codes
+                codes.writerow([record.identifier, *backup_codes])
+            self.backup_code_store.add_codes_bulk(codes_by_identifier)
+        self.imported += len(codes_by_identifier)
+        return [(record, stored[record.identifier]) for record, _ in hashed if record.identifier in codes_by_identifier]
+
+    def _report(self, started, done=False):
+        if self.progress is None:
+            return
+        elapsed = max(time.monotonic() - started, 1e-9)
+        end = "\n" if done else "\r"
+        self.progress.write(f"Imported {self.imported}, rejected {self.rejected} "
+                            f"({self.imported / elapsed:.0f} users/s){end}")
+        self.progress.flush()
+
+    def run(self, path, file_format="csv"):
+        """Imports every row of path. Returns (imported, rejected)."""
+        started = time.monotonic()
+        rejects_handle = open(self.rejects_file, "w", newline="") if self.rejects_file else None
+        # Only the owner may read the plaintext codes.
+        codes_handle = open(self.codes_file, "w", newline="",
+                            opener=lambda path, flags: os.open(path, flags, 0o600))
+        rejects = csv.writer(rejects_handle) if rejects_handle else None
+        codes = csv.writer(codes_handle)
+        if rejects:
+            rejects.writerow(["line", "identifier", "reason"])
+        try:
+            seen_identifiers = set()
+            seen_usernames = set()
+            pending = deque()
+            chunk = []
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                for line_number, row in read_rows(path, file_format):
+                    fields, reason = validate_row(row, seen_identifiers, seen_usernames, self.user_store)
+                    if fields is None:
+                        identifier = row.get("identifier", "") if isinstance(row, dict) else ""
+                        self._reject(rejects, line_number, identifier, reason)
+                        continue
+                    chunk.append(fields)
+                    if len(chunk) >= self.chunk_size:
+                        pending.append(executor.submit(hash_chunk, chunk))
+                        chunk = []
+                    # Keep every worker busy but bound how much hashed data waits in memory.
+                    while len(pending) > self.workers * 2 or pending and pending[0].done():
+                        self._write_chunk(pending.popleft().result(), rejects, codes)
+                        self._report(started)
+                if chunk:
+                    pending.append(executor.submit(hash_chunk, chunk))
+                while pending:
+                    self._write_chunk(pending.popleft().result(), rejects, codes)
+                    self._report(started)
+        finally:
+            for handle in (rejects_handle, codes_handle):
+                if handle is not None:
+                    handle.close()
+        self._report(started, done=True)
+        return self.imported, self.rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Register many users at once from a CSV or JSONL file.")
+    parser.add_argument("input", help="file with identifier, username and password per user")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="defaults to the file extension")
+    parser.add_argument("--rejects", default="rejects.csv", help="where to list refused rows (default rejects.csv)")
+    parser.add_argument("--codes-out", required=True,
+                        help="CSV file for each user's backup codes, which are stored only as HMACs")
+    parser.add_argument("--workers", type=int, help="hashing processes (default: CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    args = parser.parse_args()
+
+    file_format = args.format or ("jsonl" if args.input.endswith((".jsonl", ".json")) else "csv")
+    importer = BulkImporter(workers=args.workers, chunk_size=args.chunk_size,
+                            rejects_file=args.rejects, codes_file=args.codes_out)
+    imported, rejected = importer.run(args.input, file_format)
+    if rejected:
+        print(f"\033[1;33m{rejected} row(s) refused, see {args.rejects}.\033[0m")
+    print(f"\033[1;32m[Success] {imported} user(s) imported.\033[0m")
+
+
+if __name__ == "__main__":
+    main()
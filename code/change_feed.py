@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from file_lock import FileLock
+from metrics import instrumented
+
+# Set VERIFY_ME_CHANGE_FEED=1 to number every account change (registration, password change or
+# reset, rehash, used or replaced backup codes) and append it to Database_txt/database.txt.feed/,
+# for followers (see replica.py) to tail. Every process that writes the data files must set it.
+# The feed is split into segments named by their first sequence number; a new one is started
+# once the newest passes SEGMENT_BYTES, and only the newest KEEP_SEGMENTS are kept.
+CHANGE_FEED = os.environ.get("VERIFY_ME_CHANGE_FEED", "") == "1"
+FEED_SUFFIX = ".feed"
+SEGMENT_SUFFIX = ".log"
+SEGMENT_BYTES = 16 << 20
+KEEP_SEGMENTS = 8
+
+# Event types
+REGISTER = "register"
+UPDATE = "update"
+CONSUME = "consume"
+CODES = "codes"
+
+
+class FeedGap(IOError):
+    """Raised to a reader whose next events were dropped with an old segment before it read them."""
+
+
+def register_event(record, codes):
+    """A new account with its stored backup codes (digests, never the codes themselves)."""
+    return {"type": REGISTER, "identifier": record.identifier, "user": list(record), "add": sorted(codes)}
+
+
+def update_event(record, revoke=True):
+    """A changed user record; revoke tells followers to end the user's sessions (a new password)."""
+    return {"type": UPDATE, "identifier": record.identifier, "user": list(record), "revoke": revoke}
+
+
+def codes_event(identifier, add=(), drop=(), kind=CODES):
+    """Stored backup codes added to and dropped from a user: kind=CONSUME for a used code."""
+    return {"type": kind, "identifier": identifier, "add": sorted(add), "drop": sorted(drop)}
+
+
+def feed_directory_for(data_file):
+    return data_file + FEED_SUFFIX
+
+
+def _segments(directory):
+    """Returns [(first sequence number, path)] of the feed's segments, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(directory, name)) for name in names
+                  if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit())
+
+
+def _format(event):
+    text = json.dumps(event, separators=(",", ":"))
+    return f"{zlib.crc32(text.encode()):08x} {text}\n"
+
+
+def _parse(raw):
+    """Returns the event on a complete line, or None for a blank line or one torn by a crash."""
+    crc, _, text = raw.decode(errors="replace").strip().partition(" ")
+    if not text or crc != f"{zlib.crc32(text.encode()):08x}":
+        return None
+    return json.loads(text)
+
+
+class ChangeFeed:
+    """Appends numbered change events to a feed directory shared by every writing process.
+
+    A writer holds publishing() around the change it makes, so events are numbered
+    in the order the changes were applied even across processes; this serializes
+    the writers of one data directory while the feed is on.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, keep_segments=KEEP_SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.keep_segments = keep_segments
+        os.makedirs(directory, exist_ok=True)
+        self.file_lock = FileLock(directory, timeout=60)
+        self._fd = None
+        self._path = None  # newest segment as far as this process knows
+        self._read_to = 0
+        self._last_seq = 0
+
+    def _catch_up(self):
+        """Finds the newest segment and its last sequence number; the caller holds the file lock."""
+        segments = _segments(self.directory)
+        if not segments:
+            self._path, self._read_to, self._last_seq = None, 0, 0
+            return
+        first, path = segments[-1]
+        if path != self._path:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self._path, self._read_to, self._last_seq = path, 0, first - 1
+        with open(path, "rb") as file:
+            file.seek(self._read_to)
+            for raw in file:
+                if not raw.endswith(b"\n"):
+                    break
+                self._read_to += len(raw)
+                event = _parse(raw)
+                if event is not None:
+                    self._last_seq = event["seq"]
+
+    def last_seq(self):
+        """Returns the sequence number of the newest event (0 while there is none)."""
+        with self.file_lock.shared():
+            self._catch_up()
+            return self._last_seq
+
+    def _start_segment(self):
+        first = self._last_seq + 1
+        self._path = os.path.join(self.directory, f"{first:020d}{SEGMENT_SUFFIX}")
+        self._read_to = 0
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        for _, path in _segments(self.directory)[:-self.keep_segments]:
+            os.remove(path)
+
+    @instrumented("feed_append")
+    def _append(self, events):
+        self._catch_up()
+        if self._path is None or self._read_to >= self.segment_bytes:
+            self._start_segment()
+        elif self._fd is None:
+            self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        now = time.time()
+        lines = []
+        for event in events:
+            self._last_seq += 1
+            lines.append(_format({"seq": self._last_seq, "time": now, **event}))
+        # The leading newline keeps a line torn by a crash from swallowing the next event.
+        data = ("\n" + "".join(lines)).encode()
+        os.write(self._fd, data)
+        self._read_to += len(data)
+
+    @contextmanager
+    def publishing(self):
+        """Holds the feed's write lock around a change. The block adds the change's events to
+        the yielded list; they are appended, numbered, once it finishes without raising."""
+        with self.file_lock.exclusive():
+            events = []
+            yield events
+            if events:
+                self._append(events)
+
+    def reader(self, after_seq=0):
+        """Returns a FeedReader for the events after after_seq."""
+        return FeedReader(self.directory, after_seq)
+
+
+class FeedReader:
+    """Tails a feed directory from a sequence number, without taking its lock."""
+
+    def __init__(self, directory, after_seq=0):
+        self.directory = directory
+        self.seq = after_seq  # last event returned
+        self._first = None  # segment being read
+        self._path = None
+        self._position = 0
+
+    def _locate(self):
+        """Moves to the segment holding the event after self.seq; False if it does not exist yet."""
+        segments = _segments(self.directory)
+        candidates = [(first, path) for first, path in segments if first <= self.seq + 1]
+        if not candidates:
+            if segments or self.seq:
+                raise FeedGap(f"Events after {self.seq} are no longer in {self.directory}.")
+            return False
+        self._first, self._path = candidates[-1]
+        self._position = 0
+        return True
+
+    def _read_segment(self, events):
+        """Adds the complete events of the current segment past the position; False if it is gone."""
+        try:
+            file = open(self._path, "rb")
+        except FileNotFoundError:
+            return False
+        with file:
+            file.seek(self._position)
+            for raw in file:
+                if not raw.endswith(b"\n"):
+                    break  # still being written
+                self._position += len(raw)
+                event = _parse(raw)
+                if event is None or event["seq"] <= self.seq:
+                    continue
+                if event["seq"] != self.seq + 1:
+                    raise FeedGap(f"Expected event {self.seq + 1} in {self._path}, found {event['seq']}.")
+                events.append(event)
+                self.seq = event["seq"]
+        return True
+
+    def read(self):
+        """Returns the events written since the last call, oldest first.
+
+        Raises FeedGap if some of them were dropped with an old segment before they were read.
+        """
+        events = []
+        while True:
+            if self._path is None and not self._locate():
+                return events
+            if not self._read_segment(events):
+                self._path = None
+                continue
+            newer = [(first, path) for first, path in _segments(self.directory) if first > self._first]
+            if not newer:
+                return events
+            # A newer segment is only started after the last write to this one: finish it first.
+            if not self._read_segment(events):
+                self._path = None
+                continue
+            first, path = newer[0]
+            if first != self.seq + 1:
+                raise FeedGap(f"Expected event {self.seq + 1} to start {path}.")
+            self._first, self._path, self._position = first, path, 0
+
+
+_lock = threading.Lock()
+_feeds = {}
+
+
+def get_change_feed(user_data_file, always=False):
+    """Returns the ChangeFeed of a data file, or None while VERIFY_ME_CHANGE_FEED is off
+    (always=True: regardless, for followers)."""
+    if not (CHANGE_FEED or always):
+        return None
+    directory = os.path.abspath(feed_directory_for(user_data_file))
+    with _lock:
+        feed = _feeds.get(directory)
+        if feed is None:
+            feed = _feeds[directory] = ChangeFeed(directory)
+        return feed
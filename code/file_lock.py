@@ -0,0 +1,128 @@
+import os
+import stat
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: only threads of one process are serialized
+    fcntl = None
+
+
+# The umask can only be read by setting it, so it is read once, while the program starts.
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+class LockTimeout(IOError):
+    """Raised when a file lock could not be acquired in time."""
+
+
+class FileLock:
+    """Advisory shared/exclusive lock on a "<path>.lock" file, usable across processes.
+
+    The lock lives in a sidecar file because the data file itself is replaced by
+    rename on rewrite. Acquisition is re-entrant within one FileLock: a shared
+    request while holding the exclusive lock is a no-op.
+    """
+
+    def __init__(self, path, timeout=10.0, retry_interval=0.005, max_retry_interval=0.1):
+        self.lock_file = path + ".lock"
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self._thread_lock = threading.RLock()
+        self._fd = None
+        self._mode = None
+        self._depth = 0
+
+    def _acquire(self, exclusive):
+        if fcntl is None:
+            return
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if self._fd is None:
+            self._fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.monotonic() + self.timeout
+        interval = self.retry_interval
+        while True:
+            try:
+                fcntl.flock(self._fd, mode | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"Timed out after {self.timeout}s waiting for {self.lock_file}")
+                time.sleep(interval)
+                interval = min(interval * 2, self.max_retry_interval)
+
+    @contextmanager
+    def _hold(self, exclusive):
+        with self._thread_lock:
+            if self._depth == 0:
+                self._acquire(exclusive)
+                self._mode = "exclusive" if exclusive else "shared"
+            elif exclusive and self._mode == "shared":
+                raise RuntimeError("cannot upgrade a shared file lock to exclusive")
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    if fcntl is not None:
+                        fcntl.flock(self._fd, fcntl.LOCK_UN)
+                    self._mode = None
+
+    def shared(self):
+        """Context manager for reading: many processes may hold it at once."""
+        return self._hold(exclusive=False)
+
+    def exclusive(self):
+        """Context manager for writing: excludes every other reader and writer."""
+        return self._hold(exclusive=True)
+
+
+def fsync_directory(directory):
+    """Makes a rename inside directory durable (a no-op where directories cannot be opened)."""
+    try:
+        fd = os.open(directory or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def mode_for(path, new_file_mode=None):
+    """Permission bits for a file about to replace path: path's own, or if there is no such file
+    new_file_mode, by default what open() would give a new file."""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return new_file_mode if new_file_mode is not None else 0o666 & ~_UMASK
+
+
+@contextmanager
+def atomic_write(path, mode="w", new_file_mode=None):
+    """Writes path through a uniquely named temp file that is fsynced and then renamed over it.
+
+    The file keeps its permissions (see mode_for); mkstemp alone would leave every rewrite 0600.
+    """
+    directory = os.path.dirname(path)
+    fd, temp_file = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory or ".")
+    try:
+        os.chmod(temp_file, mode_for(path, new_file_mode))
+        with os.fdopen(fd, mode) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    fsync_directory(directory)
@@ -1,24 +1,26 @@
-import hashlib
 import os
-import random
-import re
+
+import auth_api
+from auth_api import AuthAPI, LOCKED_OUT
+from password_policy import RESET_PASSWORD_POLICY
 
 
 class Recovery:
     def __init__(self, user_data_file, backup_code_file):
         self.user_data_file = os.path.join("Database_txt", user_data_file)
         self.backup_code_file = os.path.join("Database_txt", backup_code_file)
+        self.api = AuthAPI(user_data_file, backup_code_file)
+        self.backup_code_store = self.api.backup_code_store
 
     def generate_backup_code(self):
         """Generates a backup code with 8 digits."""
-        return ''.join(random.choices('0123456789', k=8))
+        return auth_api.generate_backup_codes(1)[0]
 
     def save_backup_code(self, user_identifier, code):
         """Saves the backup code for a user."""
         try:
             os.makedirs(os.path.dirname(self.backup_code_file), exist_ok=True)
-            with open(self.backup_code_file, "a") as file:
-                file.write(f"{user_identifier},{code}\n")
+            self.backup_code_store.add_codes(user_identifier, [code])
         except Exception as e:
             print(f"Error saving backup code: {e}")
 
@@ -32,35 +34,21 @@ class Recovery:
             backup_code = input("Enter your backup code: ").strip()
 
             try:
-                lines = []
-                code_verified = False
-
-                with open(self.backup_code_file, "r") as file:
-                    for line in file:
-                        try:
-                            stored_identifier, stored_code = line.strip().split(",")
-                        except ValueError:
-                            continue
-
-                        if email_or_phone == stored_identifier and backup_code == stored_code:
-                            code_verified = True
-                        else:
-                            lines.append(line)  # Keep unused codes
-
-                if code_verified:
-                    print("Backup code verified successfully!")
-                    with open(self.backup_code_file, "w") as file:
-                        file.writelines(lines)  # Remove used code
-                    self.reset_password(email_or_phone)
-                    return
-
-            except FileNotFoundError:
-                print("Backup code file not found. Please contact support.")
-                return
-            except ValueError:
+                result = self.api.consume_backup_code(email_or_phone, backup_code)
+            except IOError:
                 print("Error reading backup codes. Please contact support.")
                 return
 
+            if result.ok:
+                print(result.message)
+                print(f"You have {result.data['remaining_backup_codes']} backup code(s) left.")
+                self.reset_password(email_or_phone)
+                return
+
+            if result.error == LOCKED_OUT:
+                print(f"Too many failed attempts for this account. Please try again in {result.retry_after} seconds.")
+                return
+
             attempts += 1
             remaining_attempts = max_attempts - attempts
             print(f"Invalid backup code. You have {remaining_attempts} attempt(s) remaining.")
@@ -69,9 +57,6 @@ class Recovery:
 
     def reset_password(self, user_identifier):
         """Allows the user to reset their password."""
-        temp_file = self.user_data_file + ".tmp"
-        password_updated = False
-
         for _ in range(3):  # Allow up to 3 attempts for a valid password
             new_password = input("Enter your new password: ").strip()
 
@@ -80,60 +65,27 @@ class Recovery:
                 continue
 
             try:
-                with open(self.user_data_file, "r") as file, open(temp_file, "w") as temp:
-                    for line in file:
-                        data = line.strip().split(",")
-                        if len(data) < 4:
-                            temp.write(line)
-                            continue
-
-                        email_or_phone, username, salt_hex, hashed_password = data
-
-
-                        if user_identifier == email_or_phone:
-                            salt = os.urandom(16)  # Generate a new salt
-                            hashed_new_password = self.hash_password(new_password, salt)
-                            temp.write(f"{email_or_phone},{username},{salt.hex()},{hashed_new_password}\n")
-                            password_updated = True
-                        else:
-                            temp.write(line)
-            except FileNotFoundError:
-                print("User data file not found. Please contact support.")
-                return
+                result = self.api.set_password(user_identifier, new_password, RESET_PASSWORD_POLICY)
             except Exception as e:
                 print(f"Error resetting password: {e}")
                 return
 
-            os.replace(temp_file, self.user_data_file)
-
-            if password_updated:
+            if result.ok:
                 print("Password reset successfully!")
-                return
             else:
                 print("User not found. Password not reset.")
-                return
+            return
 
         print("Failed to reset password after multiple attempts.")
 
     def hash_password(self, password, salt):
-        """Hashes the password using SHA256."""
-        return hashlib.sha256(salt + password.encode()).hexdigest()
+        """Hashes the password with the configured hasher."""
+        return auth_api.hash_password(password, salt)
 
     def validate_password_strength(self, password):
         """Validates the strength of a password."""
-        if len(password) < 8:
-            print("Password must be at least 8 characters long.")
-            return False
-        if not re.search(r"[A-Z]", password):
-            print("Password must contain at least one uppercase letter.")
-            return False
-        if not re.search(r"[a-z]", password):
-            print("Password must contain at least one lowercase letter.")
-            return False
-        if not re.search(r"[0-9]", password):
-            print("Password must contain at least one digit.")
-            return False
-        if not re.search(r"[!@#$%^&*(),.?\":{}|<>]", password):
-            print("Password must contain at least one special character.")
+        problem = RESET_PASSWORD_POLICY.check(password)
+        if problem:
+            print(problem)
             return False
         return True
@@ -0,0 +1,558 @@
+import argparse
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from array import array
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+
+import storage
+from auth_api import validate_identifier
+from backup_codes import CODE_DIGITS, is_digest
+from file_lock import FileLock, fsync_directory
+from password_hasher import hasher_from_spec
+from record_log import TOMBSTONE_PREFIX
+from sharding import ShardMap, is_sharded
+from snapshot import snapshot_file_for
+
+# The data files are checked in three passes, each spread over worker processes:
+#  1. every CHUNK_BYTES piece of the files is parsed and validated on its own, and its records
+#     and tombstones are spilled to temporary files partitioned by a hash of the email/phone;
+#  2. each partition (about PARTITION_BYTES of data) is read into memory to find superseded
+#     records and orphaned codes, and spills the live users partitioned by username;
+#  3. each username partition is checked for usernames held by two accounts.
+# So memory is bounded by the partition size whatever the size of the files. The lines to
+# drop are kept as sorted offsets, merged back when a repaired copy is written.
+CHUNK_BYTES = 64 << 20
+PARTITION_BYTES = 64 << 20
+EXAMPLES = 5
+REPAIRED_SUFFIX = ".repaired"
+HEX_DIGITS = "0123456789abcdefABCDEF"
+# Spilled lines are "file index,offset,R or T,email/phone,username or code"; neither holds a comma.
+
+# File kinds
+USERS = "u"
+CODES = "c"
+FIELD_COUNTS = {USERS: 4, CODES: 2}
+KEY_FIELDS = {USERS: 1, CODES: 2}
+
+# Problems. Repair drops the lines of those in DROPPED and keeps the others: an account with
+# a damaged hash can still be reset with a backup code, and a taken username needs a person.
+MALFORMED = "malformed"
+TORN = "torn"
+DUPLICATE = "duplicate"
+BAD_CODE = "bad_code"
+ORPHANED_CODE = "orphaned_code"
+BAD_HEX = "bad_hex"
+BAD_IDENTIFIER = "bad_identifier"
+DUPLICATE_USERNAME = "duplicate_username"
+DROPPED = {MALFORMED, TORN, DUPLICATE, BAD_CODE, ORPHANED_CODE}
+# Superseded lines are only dead weight: the stores read the latest record, and they append
+# tombstones for backup codes whatever VERIFY_ME_APPEND_ONLY says.
+WARNINGS = {BAD_IDENTIFIER, DUPLICATE}
+DESCRIPTIONS = {
+    MALFORMED: "malformed line(s): wrong number of fields, an empty field or not UTF-8",
+    TORN: "unfinished last line(s) left by a crashed write",
+    DUPLICATE: "record(s) superseded by a later one for the same key, or deletion marker(s)",
+    BAD_CODE: "backup code(s) that are neither a digest nor an 8-digit code",
+    ORPHANED_CODE: "backup code(s) of an email/phone with no account",
+    BAD_HEX: "account(s) whose salt or password hash is not hex or of no known algorithm",
+    BAD_IDENTIFIER: "account(s) whose email/phone would not be accepted today",
+    DUPLICATE_USERNAME: "account(s) with a username another account already has",
+}
+
+
+class FileChanged(IOError):
+    """Raised when a data file is replaced while it is being checked; run the check again."""
+
+
+def data_files(data_file):
+    """The files holding a data file's records: its shards if it is sharded."""
+    shard_map = ShardMap(data_file)
+    shard_map.refresh()
+    return [shard_map.path(shard) for shard in sorted(shard_map.shards)]
+
+
+def _complete_end(file, size):
+    """Returns the offset just past the last newline before size (0 if there is none)."""
+    position = size
+    while position > 0:
+        start = max(position - (1 << 20), 0)
+        file.seek(start)
+        newline = file.read(position - start).rfind(b"\n")
+        if newline >= 0:
+            return start + newline + 1
+        position = start
+    return 0
+
+
+def _open_checked(path, identity):
+    """Opens a data file, making sure it is still the one that was measured."""
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        raise FileChanged(f"{path} was removed during the check.")
+    stat = os.fstat(file.fileno())
+    if (stat.st_dev, stat.st_ino) != identity:
+        file.close()
+        raise FileChanged(f"{path} was replaced during the check.")
+    return file
+
+
+def _is_hex(text):
+    return bool(text) and len(text) % 2 == 0 and not text.strip(HEX_DIGITS)
+
+
+def _hash_ok(salt_hex, hashed_password, known_specs):
+    """Tells whether a salt and stored hash could be read by password_hasher.decode()."""
+    if not _is_hex(salt_hex):
+        return False
+    if "$" not in hashed_password:
+        return len(hashed_password) == 64 and _is_hex(hashed_password)
+    parts = hashed_password.split("$")
+    if len(parts) != 4 or not _is_hex(parts[2]) or not _is_hex(parts[3]):
+        return False
+    spec = f"{parts[0]}${parts[1]}"
+    if spec not in known_specs:
+        try:
+            hasher_from_spec(spec)
+        except ValueError:
+            return False
+        known_specs.add(spec)
+    return True
+
+
+def _code_ok(code):
+    return is_digest(code) and _is_hex(code) or len(code) == CODE_DIGITS and code.isdigit()
+
+
+def _partition(text, partitions):
+    return zlib.crc32(text.encode()) % partitions
+
+
+def _write_offsets(path, offsets):
+    with open(path, "wb") as file:
+        array("Q", sorted(offsets)).tofile(file)
+
+
+def _read_offsets(path):
+    with open(path, "rb") as file:
+        while True:
+            block = array("Q")
+            try:
+                block.fromfile(file, 1 << 16)
+            except EOFError:
+                pass  # the items that were there are still read
+            if not block:
+                return
+            yield from block
+
+
+def _spill_files(spill_dir, prefix):
+    return [os.path.join(spill_dir, name) for name in os.listdir(spill_dir) if name.startswith(prefix)]
+
+
+def _drops(spill_dir, kind, file_index):
+    """Yields the offsets of the lines to drop from one data file, in order."""
+    return heapq.merge(*(_read_offsets(path) for path in _spill_files(spill_dir, f"drop-{kind}{file_index}-")))
+
+
+class _Findings:
+    """Problem counts with the first few (kind, file index, offset) examples of each."""
+
+    def __init__(self):
+        self.problems = Counter()
+        self.examples = {}
+
+    def add(self, problem, kind, file_index, offset):
+        self.problems[problem] += 1
+        examples = self.examples.setdefault(problem, [])
+        if len(examples) < EXAMPLES:
+            examples.append((kind, file_index, offset))
+
+    def update(self, other):
+        self.problems.update(other.problems)
+        for problem, examples in other.examples.items():
+            merged = sorted(self.examples.get(problem, []) + examples)
+            self.examples[problem] = merged[:EXAMPLES]
+
+
+def check_chunk(spill_dir, partitions, chunk, kind, file_index, path, identity, start, end):
+    """Runs in a worker process: validates the lines of [start, end) of a data file.
+
+    Records and tombstones are spilled to the partition of their email/phone and the
+    offsets of malformed lines to a drop file. Returns (lines, _Findings).
+    """
+    findings = _Findings()
+    dropped = []
+    known_specs = set()
+    field_count = FIELD_COUNTS[kind]
+    key_fields = KEY_FIELDS[kind]
+    spills = [open(os.path.join(spill_dir, f"{kind}{partition}-{chunk}"), "w", buffering=1 << 18,
+                   encoding="utf-8", newline="\n")
+              for partition in range(partitions)]
+    lines = 0
+    try:
+        with _open_checked(path, identity) as file:
+            file.seek(start)
+            offset = start
+            for raw in file:
+                if offset >= end:
+                    break
+                at = offset
+                offset += len(raw)
+                lines += 1
+                try:
+                    line = raw.decode().strip()
+                except UnicodeDecodeError:
+                    line = None
+                if line == "":
+                    continue  # skipped by the stores too
+                if line is not None and line.startswith(TOMBSTONE_PREFIX):
+                    fields = line[len(TOMBSTONE_PREFIX):].split(",")
+                    if len(fields) >= key_fields and all(fields[:key_fields]):
+                        value = fields[1] if kind == CODES else ""
+                        spills[_partition(fields[0], partitions)].write(f"{file_index},{at},T,{fields[0]},{value}\n")
+                        continue
+                    line = None
+                fields = line.split(",") if line is not None else ()
+                if len(fields) != field_count or not all(fields):
+                    findings.add(MALFORMED, kind, file_index, at)
+                    dropped.append(at)
+                    continue
+                if kind == USERS:
+                    identifier, username, salt_hex, hashed_password = fields
+                    if not validate_identifier(identifier)[0]:
+                        findings.add(BAD_IDENTIFIER, kind, file_index, at)
+                    if not _hash_ok(salt_hex, hashed_password, known_specs):
+                        findings.add(BAD_HEX, kind, file_index, at)
+                    spills[_partition(identifier, partitions)].write(f"{file_index},{at},R,{identifier},{username}\n")
+                else:
+                    identifier, code = fields
+                    if not _code_ok(code):
+                        findings.add(BAD_CODE, kind, file_index, at)
+                        dropped.append(at)
+                        continue
+                    spills[_partition(identifier, partitions)].write(f"{file_index},{at},R,{identifier},{code}\n")
+    finally:
+        for spill in spills:
+            spill.close()
+    if dropped:
+        _write_offsets(os.path.join(spill_dir, f"drop-{kind}{file_index}-c{chunk}"), dropped)
+    return lines, findings
+
+
+def _latest(spill_paths, by_value):
+    """Reads spilled events, keeping the latest per email/phone (or per (email/phone, value) with
+    by_value). Returns {key: (file index, offset, is a record, value)} and the (file index, offset)
+    of the events it superseded."""
+    latest = {}
+    superseded = []
+    for path in spill_paths:
+        with open(path, "r", encoding="utf-8", newline="\n") as file:
+            for line in file:
+                file_index, offset, flag, identifier, value = line.rstrip("\n").split(",", 4)
+                event = (int(file_index), int(offset), flag == "R", value)
+                key = (identifier, value) if by_value else identifier
+                previous = latest.get(key)
+                if previous is None or previous[:2] < event[:2]:
+                    latest[key] = event
+                    if previous is not None:
+                        superseded.append(previous[:2])
+                else:
+                    superseded.append(event[:2])
+    return latest, superseded
+
+
+def _write_drops(spill_dir, kind, suffix, locations):
+    """Writes the (file index, offset) of lines to drop as one sorted offset file per data file."""
+    by_file = {}
+    for file_index, offset in locations:
+        by_file.setdefault(file_index, []).append(offset)
+    for file_index, offsets in by_file.items():
+        _write_offsets(os.path.join(spill_dir, f"drop-{kind}{file_index}-{suffix}"), offsets)
+
+
+def check_partition(spill_dir, partitions, partition):
+    """Runs in a worker process: resolves the users and codes of one email/phone partition.
+
+    Superseded records, tombstones and the codes of missing accounts are marked to drop, and
+    the live users are spilled to the partition of their username. Returns (users, codes, _Findings).
+    """
+    findings = _Findings()
+    users, superseded = _latest(_spill_files(spill_dir, f"{USERS}{partition}-"), by_value=False)
+    dropped = superseded + [event[:2] for event in users.values() if not event[2]]
+    for file_index, offset in dropped:
+        findings.add(DUPLICATE, USERS, file_index, offset)
+    _write_drops(spill_dir, USERS, f"p{partition}", dropped)
+
+    live = {identifier: event for identifier, event in users.items() if event[2]}
+    del users
+    names = [open(os.path.join(spill_dir, f"n{name_partition}-{partition}"), "w", buffering=1 << 18,
+                   encoding="utf-8", newline="\n")
+             for name_partition in range(partitions)]
+    try:
+        for identifier, (file_index, offset, _, username) in live.items():
+            names[_partition(username, partitions)].write(f"{file_index},{offset},{identifier},{username}\n")
+    finally:
+        for file in names:
+            file.close()
+
+    codes, superseded = _latest(_spill_files(spill_dir, f"{CODES}{partition}-"), by_value=True)
+    for file_index, offset in superseded:
+        findings.add(DUPLICATE, CODES, file_index, offset)
+    dropped = superseded
+    live_codes = 0
+    for (identifier, _), (file_index, offset, is_record, _) in codes.items():
+        if not is_record:
+            findings.add(DUPLICATE, CODES, file_index, offset)
+        elif identifier not in live:
+            findings.add(ORPHANED_CODE, CODES, file_index, offset)
+        else:
+            live_codes += 1
+            continue
+        dropped.append((file_index, offset))
+    _write_drops(spill_dir, CODES, f"p{partition}", dropped)
+    return len(live), live_codes, findings
+
+
+def check_usernames(spill_dir, partition):
+    """Runs in a worker process: finds the usernames of one partition held by more than one account."""
+    findings = _Findings()
+    first = {}
+    for path in _spill_files(spill_dir, f"n{partition}-"):
+        with open(path, "r", encoding="utf-8", newline="\n") as file:
+            for line in file:
+                file_index, offset, _, username = line.rstrip("\n").split(",", 3)
+                location = (int(file_index), int(offset))
+                previous = first.get(username)
+                if previous is None:
+                    first[username] = location
+                    continue
+                if location < previous:
+                    first[username], location = location, previous
+                findings.add(DUPLICATE_USERNAME, USERS, *location)
+    return findings
+
+
+def write_repaired(path, identity, end, drops, output):
+    """Copies the lines of path before end to output, leaving out those at the drop offsets
+    (an iterable in order) and blank lines. Returns how many lines were left out."""
+    drops = iter(drops)
+    next_drop = next(drops, None)
+    left_out = 0
+    with _open_checked(path, identity) as source, open(output, "wb") as target:
+        offset = 0
+        for raw in source:
+            if offset >= end:
+                break
+            while next_drop is not None and next_drop < offset:
+                next_drop = next(drops, None)
+            if offset == next_drop or not raw.strip():
+                left_out += 1
+            else:
+                target.write(raw)
+            offset += len(raw)
+        target.flush()
+        os.fsync(target.fileno())
+    return left_out
+
+
+def replace_with_repaired(path, identity, end, output):
+    """Swaps the repaired copy in for path under its write lock, after adding the lines other
+    processes appended since the check. Raises FileChanged if path was rewritten meanwhile."""
+    with FileLock(path, timeout=60).exclusive():
+        with _open_checked(path, identity) as source, open(output, "ab") as target:
+            # No writer is running while we hold the lock, so an unfinished last line is a crash's.
+            tail_end = _complete_end(source, os.fstat(source.fileno()).st_size)
+            source.seek(end)
+            remaining = max(tail_end - end, 0)
+            while remaining:
+                block = source.read(min(remaining, 1 << 20))
+                target.write(block)
+                remaining -= len(block)
+            target.flush()
+            os.fsync(target.fileno())
+        # The repaired file could get the old one's inode, which would make its snapshot look current.
+        if os.path.exists(snapshot_file_for(path)):
+            os.remove(snapshot_file_for(path))
+        os.replace(output, path)
+    fsync_directory(os.path.dirname(path))
+
+
+def _repair_file(spill_dir, kind, file_index, path, identity, end, output):
+    """Runs in a worker process: write_repaired() for one data file."""
+    return write_repaired(path, identity, end, _drops(spill_dir, kind, file_index), output)
+
+
+class IntegrityChecker:
+    """Checks database.txt and backup_codes.txt (or their shards) and writes repaired copies.
+
+    Nothing is locked while checking: the files are measured first and only what they held
+    then is read, so the program can keep running. A file rewritten meanwhile raises FileChanged.
+    """
+
+    def __init__(self, user_data_file, backup_code_file, workers=None, temp_dir=None):
+        self.user_data_file = user_data_file
+        self.backup_code_file = backup_code_file
+        self.workers = workers or os.cpu_count() or 1
+        self.temp_dir = temp_dir or os.path.dirname(user_data_file) or "."
+        self.files = {}  # (kind, file index) -> (path, identity, end of the last complete line)
+        self.lines = Counter()  # kind -> lines read
+        self.users = 0
+        self.codes = 0
+        self.findings = _Findings()
+        self.elapsed = 0.0
+        self._spill_dir = None
+
+    def _measure(self):
+        # Codes first: an account is written before its codes, so every code read has its account.
+        for kind, data_file in ((CODES, self.backup_code_file), (USERS, self.user_data_file)):
+            for file_index, path in enumerate(data_files(data_file)):
+                try:
+                    file = open(path, "rb")
+                except FileNotFoundError:
+                    continue
+                with file:
+                    stat = os.fstat(file.fileno())
+                    end = _complete_end(file, stat.st_size)
+                if end < stat.st_size:
+                    self.findings.add(TORN, kind, file_index, end)
+                self.files[kind, file_index] = (path, (stat.st_dev, stat.st_ino), end)
+
+    def _chunks(self, path, end):
+        """Splits [0, end) of a file into pieces of about CHUNK_BYTES starting at line starts."""
+        starts = [0]
+        with open(path, "rb") as file:
+            while starts[-1] + CHUNK_BYTES < end:
+                file.seek(starts[-1] + CHUNK_BYTES - 1)
+                file.readline()
+                if file.tell() >= end:
+                    break
+                starts.append(file.tell())
+        return zip(starts, starts[1:] + [end])
+
+    def check(self):
+        """Runs the three passes. Afterwards findings holds what was found."""
+        started = time.monotonic()
+        self._measure()
+        total = sum(end for _, _, end in self.files.values())
+        partitions = max(1, -(-total // PARTITION_BYTES))
+        self._spill_dir = tempfile.mkdtemp(prefix="integrity-", dir=self.temp_dir)
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = []
+            for (kind, file_index), (path, identity, end) in self.files.items():
+                for start, stop in self._chunks(path, end):
+                    futures.append((kind, executor.submit(check_chunk, self._spill_dir, partitions, len(futures),
+                                                          kind, file_index, path, identity, start, stop)))
+            for kind, future in futures:
+                lines, findings = future.result()
+                self.lines[kind] += lines
+                self.findings.update(findings)
+            for users, codes, findings in executor.map(check_partition, [self._spill_dir] * partitions,
+                                                       [partitions] * partitions, range(partitions)):
+                self.users += users
+                self.codes += codes
+                self.findings.update(findings)
+            for findings in executor.map(check_usernames, [self._spill_dir] * partitions, range(partitions)):
+                self.findings.update(findings)
+        self.elapsed = time.monotonic() - started
+
+    def errors(self):
+        return sum(count for problem, count in self.findings.problems.items() if problem not in WARNINGS)
+
+    def repair(self, replace=False):
+        """Writes "<file>.repaired" next to every data file, without the lines of the DROPPED
+        problems; with replace=True the copies then take the files' place. Call check() first.
+        Returns {path: lines left out}."""
+        outputs = {key: path + REPAIRED_SUFFIX for key, (path, _, _) in self.files.items()}
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            futures = {key: executor.submit(_repair_file, self._spill_dir, *key, *self.files[key], outputs[key])
+                       for key in self.files}
+            left_out = {self.files[key][0]: future.result() for key, future in futures.items()}
+        if replace:
+            with ExitStack() as manifests:
+                # Shards are not split or joined while their manifest is held.
+                for data_file in (self.user_data_file, self.backup_code_file):
+                    if is_sharded(data_file):
+                        manifests.enter_context(ShardMap(data_file).file_lock.shared())
+                for key, (path, identity, end) in self.files.items():
+                    replace_with_repaired(path, identity, end, outputs[key])
+        return left_out
+
+    def cleanup(self):
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+            self._spill_dir = None
+
+
+def _show(path, offset):
+    with open(path, "rb") as file:
+        file.seek(offset)
+        line = file.readline().decode(errors="replace").rstrip("\r\n")
+    return line if len(line) <= 100 else line[:97] + "..."
+
+
+def print_report(checker):
+    print(f"\033[1;34mChecked {checker.lines[USERS]} line(s) of {checker.user_data_file} and "
+          f"{checker.lines[CODES]} of {checker.backup_code_file} in {checker.elapsed:.1f}s: "
+          f"{checker.users} account(s), {checker.codes} backup code(s).\033[0m")
+    for problem, description in DESCRIPTIONS.items():
+        count = checker.findings.problems[problem]
+        if not count:
+            continue
+        if problem in WARNINGS:
+            print(f"\033[1;33m[Warning] {count} {description}.\033[0m")
+        else:
+            print(f"\033[1;31m[Error] {count} {description}.\033[0m")
+        for kind, file_index, offset in checker.findings.examples[problem]:
+            path = checker.files[kind, file_index][0]
+            print(f"  {path}@{offset}: {_show(path, offset)}")
+    if not checker.findings.problems:
+        print("\033[1;32m[Success] No problems found.\033[0m")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check database.txt and backup_codes.txt, and repair them.")
+    parser.add_argument("command", choices=["verify", "repair"])
+    parser.add_argument("--replace", action="store_true",
+                        help="repair: replace the files by the repaired copies instead of writing them next to them")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--temp-dir", help="where to keep the temporary files (default: Database_txt)")
+    args = parser.parse_args()
+    if args.replace and args.command != "repair":
+        parser.error("--replace only goes with repair")
+    if storage.STORAGE != "text":
+        print(f"\033[1;33m[Warning] VERIFY_ME_STORAGE={storage.STORAGE}: only the text files are checked.\033[0m")
+
+    checker = IntegrityChecker(os.path.join("Database_txt", "database.txt"),
+                               os.path.join("Database_txt", "backup_codes.txt"),
+                               workers=args.workers, temp_dir=args.temp_dir)
+    try:
+        checker.check()
+        print_report(checker)
+        if args.command == "verify":
+            sys.exit(1 if checker.errors() else 0)
+        left_out = checker.repair(replace=args.replace)
+    except FileChanged as e:
+        print(f"\033[1;31m[Error] {e} Run it again.\033[0m")
+        sys.exit(1)
+    finally:
+        checker.cleanup()
+    for path, count in left_out.items():
+        where = path if args.replace else path + REPAIRED_SUFFIX
+        print(f"\033[1;32m[Success] {where}: {count} line(s) left out.\033[0m")
+    kept = sum(checker.findings.problems[problem] for problem in (BAD_HEX, DUPLICATE_USERNAME))
+    if kept:
+        print(f"\033[1;33m{kept} account(s) with a bad hash or a taken username were kept; see them above.\033[0m")
+    if not args.replace:
+        print("Check the copies, then run repair --replace (or move them over the files with the program stopped).")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import json
+import os
+import secrets
+import threading
+import zlib
+from contextlib import contextmanager
+
+import metrics
+from file_lock import FileLock
+from user_store import UserRecord
+
+# Set VERIFY_ME_JOURNAL=1 to make registrations, password changes and backup code use crash-safe:
+# each is first written to database.txt.journal as one entry and fsynced, then applied to the data
+# files. Entries committed by concurrent threads share one fsync. A process that starts up replays
+# the entries a crashed process left half-applied, or rolls them back if they can no longer apply.
+JOURNAL = os.environ.get("VERIFY_ME_JOURNAL", "") == "1"
+JOURNAL_SUFFIX = ".journal"
+CHECKPOINT_BYTES = 1 << 20
+
+# Outcomes of resolve()
+APPLIED = "applied"
+REDONE = "redone"
+ROLLED_BACK = "rolled back"
+
+
+def user_op(before, after):
+    """A user record changing from before to after (None: no record yet)."""
+    return ["user", (after or before).identifier, list(before) if before else None, list(after)]
+
+
+def codes_op(identifier, add=(), drop=()):
+    """Stored backup codes (digests, never the codes themselves) added to and dropped from a user."""
+    return ["codes", identifier, sorted(add), sorted(drop)]
+
+
+def _state(op, user_store, backup_code_store):
+    """APPLIED, "pending" (not applied yet) or "conflict" (someone else changed it since)."""
+    kind, identifier, first, second = op
+    if kind == "user":
+        current = user_store.find_user(identifier)
+        current = list(current) if current is not None else None
+        if current == second:
+            return APPLIED
+        return "pending" if current == first else "conflict"
+    current = backup_code_store.stored_codes(identifier)
+    if all(code in current for code in first) and not any(code in current for code in second):
+        return APPLIED
+    return "pending"
+
+
+def _apply(op, user_store, backup_code_store, undo=False):
+    kind, identifier, first, second = op
+    if kind == "user":
+        before, after = (second, first) if undo else (first, second)
+        if after is None:
+            return  # registrations are never taken back once written; their codes are
+        if before is None:
+            user_store.add_user(UserRecord(*after))
+        else:
+            user_store.update_user(UserRecord(*after), expected=UserRecord(*before))
+    elif undo:
+        backup_code_store.change_codes(identifier, add=second, drop=first)
+    else:
+        backup_code_store.change_codes(identifier, add=first, drop=second)
+
+
+def resolve(ops, user_store, backup_code_store):
+    """Finishes an entry whose writer crashed: redoes its missing changes, or undoes the ones it
+    made if another change got in the way. Returns APPLIED, REDONE or ROLLED_BACK."""
+    states = [_state(op, user_store, backup_code_store) for op in ops]
+    if all(state == APPLIED for state in states):
+        return APPLIED
+    if "conflict" in states:
+        for op, state in zip(ops, states):
+            if state == APPLIED:
+                _apply(op, user_store, backup_code_store, undo=True)
+        return ROLLED_BACK
+    for op, state in zip(ops, states):
+        if state == "pending":
+            _apply(op, user_store, backup_code_store)
+    return REDONE
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _Batch:
+    """Entries that go to disk with the same fsync."""
+    __slots__ = ("lines", "done", "error")
+
+    def __init__(self):
+        self.lines = []
+        self.done = False
+        self.error = None
+
+
+class Journal:
+    """Write-ahead journal with group commit, shared by every process working on the same files.
+
+    begin() writes an entry and returns once it is on disk; the caller then applies
+    it to the stores and calls finish(). Threads that call begin() while an fsync is
+    running queue their entries, and the next fsync covers all of them. Appends hold
+    the journal's shared file lock, so processes append side by side; a checkpoint
+    takes the exclusive lock, syncs the data files and cuts the journal down to the
+    entries still being applied.
+    """
+
+    def __init__(self, path, checkpoint_bytes=CHECKPOINT_BYTES):
+        self.path = path
+        self.checkpoint_bytes = checkpoint_bytes
+        # finish() checkpoints once the journal reaches this size; after a checkpoint it becomes
+        # twice what was left, so entries that stay in flight don't make every finish() rescan.
+        self._checkpoint_at = checkpoint_bytes
+        self.file_lock = FileLock(path, timeout=60)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._condition = threading.Condition()
+        self._batch = _Batch()
+        self._flushing = False
+        # Entry ids start with this process's own prefix, so ids stay unique when a pid is reused.
+        self._owner = f"{os.getpid()}.{secrets.token_hex(4)}"
+        self._next_id = 0
+        self._abandoned = set()
+        self._stores = None
+
+    @staticmethod
+    def _format(entry):
+        text = json.dumps(entry, separators=(",", ":"))
+        return f"{zlib.crc32(text.encode()):08x} {text}\n"
+
+    def _write(self, lines, durable):
+        # The leading newline keeps a line torn by a crash from swallowing the next entry.
+        data = ("\n" + "".join(lines)).encode()
+        with self.file_lock.shared():
+            os.write(self._fd, data)
+            if durable:
+                with metrics.timed("journal_fsync"):
+                    os.fsync(self._fd)
+                metrics.count("verify_me_journal_entries_total", len(lines))
+                metrics.count("verify_me_journal_fsyncs_total")
+
+    def begin(self, ops):
+        """Writes an entry for ops and returns its id once the entry is durable."""
+        return self.begin_all([ops])[0]
+
+    def begin_all(self, ops_lists):
+        """Writes one entry per ops list and returns their ids once all of them are durable."""
+        with self._condition:
+            txs = []
+            batch = self._batch
+            for ops in ops_lists:
+                self._next_id += 1
+                tx = f"{self._owner}-{self._next_id}"
+                batch.lines.append(self._format({"tx": tx, "pid": os.getpid(), "ops": ops}))
+                txs.append(tx)
+            while not batch.done:
+                if self._flushing:
+                    self._condition.wait()
+                    continue
+                # Leader: write everything queued so far with one fsync; later callers start a new batch.
+                self._batch = _Batch()
+                self._flushing = True
+                self._condition.release()
+                try:
+                    self._write(batch.lines, durable=True)
+                except OSError as e:
+                    batch.error = e
+                finally:
+                    self._condition.acquire()
+                    self._flushing = False
+                    batch.done = True
+                    self._condition.notify_all()
+        if batch.error is not None:
+            raise IOError(f"Could not write to {self.path}: {batch.error}")
+        return txs
+
+    def finish(self, tx):
+        """Marks an entry as fully applied. Not fsynced: redoing an applied entry changes nothing."""
+        self.finish_all([tx])
+
+    def finish_all(self, txs):
+        """Marks entries as fully applied with one write."""
+        self._write([self._format({"done": tx}) for tx in txs], durable=False)
+        if os.fstat(self._fd).st_size >= self._checkpoint_at:
+            self.checkpoint(min_bytes=self._checkpoint_at)
+
+    @contextmanager
+    def entry(self, ops):
+        """begin() before the block and finish() after it; if the block raises, the entry is
+        resolved right away like one of a crashed process."""
+        with self.entries([ops]):
+            yield
+
+    @contextmanager
+    def entries(self, ops_lists):
+        """entry() for many entries at once, written with one fsync."""
+        txs = self.begin_all(ops_lists)
+        try:
+            yield
+        except BaseException:
+            self._abandon(list(zip(txs, ops_lists)))
+            raise
+        self.finish_all(txs)
+
+    def _abandon(self, entries):
+        """Resolves the [(tx, ops)] of a block that raised, so that a half-applied change is not
+        left visible until the next checkpoint. Those that cannot be resolved now are left to it."""
+        if self._stores is None:
+            self._abandoned.update(tx for tx, _ in entries)
+            return
+        done = []
+        for tx, ops in entries:
+            try:
+                outcome = resolve(ops, *self._stores)
+            except IOError:
+                self._abandoned.add(tx)
+                continue
+            metrics.count("verify_me_journal_recovered_total", outcome=outcome)
+            done.append(tx)
+        try:
+            if done:
+                self._write([self._format({"done": tx}) for tx in done], durable=False)
+        except OSError:
+            self._abandoned.update(done)
+
+    def _unfinished(self):
+        """Returns [(tx, pid, ops)] for entries without a done marker, oldest first."""
+        entries = {}
+        try:
+            with open(self.path, "rb") as file:
+                for raw in file:
+                    crc, _, text = raw.decode(errors="replace").strip().partition(" ")
+                    if not text or crc != f"{zlib.crc32(text.encode()):08x}":
+                        continue  # blank, or torn by a crash before it was acknowledged
+                    entry = json.loads(text)
+                    if "done" in entry:
+                        entries.pop(entry["done"], None)
+                    else:
+                        entries[entry["tx"]] = (entry["tx"], entry["pid"], entry["ops"])
+        except FileNotFoundError:
+            pass
+        return list(entries.values())
+
+    def recover(self, user_store, backup_code_store):
+        """Resolves the entries of crashed processes against the stores, once per process.
+
+        The stores are remembered and synced by every later checkpoint.
+        """
+        with self._condition:
+            if self._stores is not None:
+                return
+            self._stores = (user_store, backup_code_store)
+        self.checkpoint()
+
+    def _in_flight(self, tx, pid):
+        """Tells whether an unfinished entry may still be being applied by its writer."""
+        if tx.startswith(self._owner + "-"):
+            return tx not in self._abandoned
+        return pid != os.getpid() and _alive(pid)
+
+    def checkpoint(self, min_bytes=0):
+        """Resolves entries of crashed processes, syncs the data files and cuts the journal down to
+        the entries still being applied. Skipped (returns False) while the journal is smaller than
+        min_bytes, which a concurrent checkpoint may just have made it."""
+        if self._stores is None:
+            return False
+        user_store, backup_code_store = self._stores
+        with self.file_lock.exclusive():
+            if os.fstat(self._fd).st_size < min_bytes:
+                return False
+            kept = []
+            for tx, pid, ops in self._unfinished():
+                if self._in_flight(tx, pid):
+                    kept.append(self._format({"tx": tx, "pid": pid, "ops": ops}))
+                    continue
+                outcome = resolve(ops, user_store, backup_code_store)
+                self._abandoned.discard(tx)
+                metrics.count("verify_me_journal_recovered_total", outcome=outcome)
+                os.write(self._fd, ("\n" + self._format({"done": tx})).encode())
+            user_store.sync()
+            backup_code_store.sync()
+            self._compact("".join(kept).encode())
+            self._checkpoint_at = max(self.checkpoint_bytes, 2 * os.fstat(self._fd).st_size)
+            return True
+
+    def _compact(self, data):
+        """Overwrites the journal from the start with data (a subset of its lines), then cuts it.
+
+        A crash half way leaves data followed by the rest of the old journal. An old entry that
+        survives there is in data too, or was resolved and still has its done marker after it.
+        """
+        fd = os.open(self.path, os.O_WRONLY)  # not O_APPEND, which would ignore the offset
+        try:
+            os.pwrite(fd, data, 0)
+            os.fsync(fd)
+            os.ftruncate(fd, len(data))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+_lock = threading.Lock()
+_journals = {}
+
+
+def get_journal(user_data_file):
+    """Returns the Journal of a data file, or None while VERIFY_ME_JOURNAL is off."""
+    if not JOURNAL:
+        return None
+    path = os.path.abspath(user_data_file + JOURNAL_SUFFIX)
+    with _lock:
+        journal = _journals.get(path)
+        if journal is None:
+            journal = _journals[path] = Journal(path)
+        return journal
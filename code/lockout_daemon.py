@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import mmap
+import os
+import sys
+
+from rate_limiter import FILTER_SLOTS, FILTER_SUFFIX, LOCKOUT_SOCKET, RateLimiter, SharedRateLimiter, filter_slot
+
+# The daemon answers requests of one JSON line each, a list of [operation, key] calls, with one
+# JSON line holding the list of their results. Keys are the RateLimiter keys as lists.
+DEFAULT_SOCKET = os.path.join("Database_txt", "lockouts.sock")
+EXPIRE_INTERVAL = 1.0
+MAX_REQUEST_SIZE = 1 << 20
+
+
+class LockoutDaemon:
+    """Holds the one RateLimiter every worker process uses through a SharedRateLimiter.
+
+    It also keeps the shared filter next to the socket: per slot, how many keys with an
+    entry hash there. The file is zeroed in place on start, so processes that mapped it
+    from an earlier daemon keep reading the current one.
+    """
+
+    def __init__(self, socket_path, **limiter_options):
+        self.socket_path = socket_path
+        fd = os.open(socket_path + FILTER_SUFFIX, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, FILTER_SLOTS * 4)
+            self._map = mmap.mmap(fd, FILTER_SLOTS * 4)
+        finally:
+            os.close(fd)
+        self._map[:] = bytes(FILTER_SLOTS * 4)
+        self._counters = memoryview(self._map).cast("I")
+        self.limiter = RateLimiter(on_change=self._changed, **limiter_options)
+        self._operations = {
+            "retry_after": self.limiter.retry_after,
+            "record_failure": self.limiter.record_failure,
+            "lock": self.limiter.lock,
+            "record_success": self.limiter.record_success,
+            "count": lambda key: len(self.limiter),
+        }
+
+    def _changed(self, key, present):
+        self._counters[filter_slot(key)] += 1 if present else -1
+
+    def handle(self, calls):
+        """Runs a request's calls in order and returns their results."""
+        return [self._operations[operation](None if key is None else tuple(key)) for operation, key in calls]
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    results = self.handle(json.loads(line))
+                except (ValueError, TypeError, KeyError):
+                    break  # not a client of ours
+                writer.write((json.dumps(results, separators=(",", ":")) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _expire(self):
+        while True:
+            await asyncio.sleep(EXPIRE_INTERVAL)
+            self.limiter.expire()
+
+    async def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left by a daemon that did not stop cleanly
+        server = await asyncio.start_unix_server(self._serve_client, path=self.socket_path, limit=MAX_REQUEST_SIZE)
+        os.chmod(self.socket_path, 0o600)
+        expiry = asyncio.ensure_future(self._expire())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            expiry.cancel()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Share failed-attempt counters and lockouts between processes.")
+    parser.add_argument("command", choices=["serve", "status"])
+    parser.add_argument("--socket", default=LOCKOUT_SOCKET or DEFAULT_SOCKET)
+    args = parser.parse_args()
+
+    if args.command == "status":
+        count = SharedRateLimiter(args.socket).ping()
+        if count is None:
+            print(f"\033[1;31m[Error] No lockout daemon is answering on {args.socket}.\033[0m")
+            sys.exit(1)
+        print(f"\033[1;32mLockout daemon on {args.socket}: {count} key(s) with failed attempts or lockouts.\033[0m")
+        return
+
+    daemon = LockoutDaemon(args.socket)
+    print(f"\033[1;32mLockout daemon listening on {args.socket}; "
+          f"start the other programs with VERIFY_ME_LOCKOUT_SOCKET={args.socket}\033[0m")
+    try:
+        asyncio.run(daemon.serve())
+    except KeyboardInterrupt:
+        print("Lockout daemon stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,113 +1,113 @@
-import hashlib
 import os
-import time
+
+import auth_api
+from auth_api import AuthAPI, LOCKED_OUT
 from change_password import ChangePassword  # Import ChangePassword class
+from user_store import UserRecord
 
 
 class LoginSystem:
     def __init__(self, user_data_file):
         self.user_data_file = os.path.join("Database_txt", user_data_file)
-        self.max_failed_attempts = 3  # Configurable maximum attempts for email/phone
         self.max_failed_password_attempts = 4  # Configurable maximum password attempts
-        self.initial_delay_time = 30  # Configurable initial delay in seconds
         self.change_password_handler = ChangePassword(user_data_file)  # Instantiate ChangePassword class
+        self.api = AuthAPI(user_data_file)
+        self.user_store = self.api.user_store
 
     def hash_password(self, password, salt):
-        """Hashes the password using SHA256."""
-        return hashlib.sha256(salt + password.encode()).hexdigest()
+        """Hashes the password with the configured hasher."""
+        return auth_api.hash_password(password, salt)
 
     def find_user(self, email_or_phone):
         """Find user details in the database."""
         try:
-            with open(self.user_data_file, "r") as file:
-                for line in file:
-                    data = line.strip().split(",")
-                    if len(data) >= 4 and data[0] == email_or_phone:
-                        return data
-        except FileNotFoundError:
-            print("\033[1;31mError: User data file not found. Please check the file path.\033[0m")
+            return self.user_store.find_user(email_or_phone)
         except IOError:
             print("\033[1;31mError: An error occurred while accessing the user data file.\033[0m")
         return None
 
     def update_user_data(self, email_or_phone, new_data):
         """Updates user data for a given email or phone."""
+        data = new_data.strip().split(",")
+        if len(data) < 4 or data[0] != email_or_phone:
+            print("\033[1;31mError: Invalid user data.\033[0m")
+            return
         try:
-            updated_lines = []
-            with open(self.user_data_file, "r") as file:
-                for line in file:
-                    data = line.strip().split(",")
-                    if len(data) >= 4 and data[0] == email_or_phone:
-                        updated_lines.append(new_data + "\n")
-                    else:
-                        updated_lines.append(line)
-            with open(self.user_data_file, "w") as file:
-                file.writelines(updated_lines)
-        except FileNotFoundError:
-            print("\033[1;31mError: User data file not found. Please check the file path.\033[0m")
+            if not self.user_store.update_user(UserRecord(*data[:4])):
+                print("\033[1;31mError: User not found.\033[0m")
         except IOError:
             print("\033[1;31mError: An error occurred while accessing the user data file.\033[0m")
 
-    def change_password(self, email_or_phone):
+    def change_password(self, email_or_phone, token=None):
         """Allows the user to change their password by delegating to the ChangePassword class."""
         print("\033[1;36m--- Change Password ---\033[0m")
-        self.change_password_handler.change_password(email_or_phone)
+        self.change_password_handler.change_password(email_or_phone, token)
+
+    def new_backup_codes(self, token):
+        """Replaces the user's backup codes and shows the new ones."""
+        print("\033[1;36m--- New Backup Codes ---\033[0m")
+        try:
+            result = self.api.regenerate_backup_codes(token)
+        except IOError:
+            print("\033[1;31mError: An error occurred while accessing the backup code file.\033[0m")
+            return
+        if not result.ok:
+            print(f"\033[1;31m{result.message}\033[0m")
+            return
+        print(f"\033[1;32m{result.message}\033[0m")
+        print("\nHere are your backup codes:")
+        for code in result.data["backup_codes"]:
+            print(f"\033[1;33m{code}\033[0m")
+        print("\n\033[1;32mPlease save these backup codes in a secure location.\033[0m")
 
-    def user_menu(self, email_or_phone):
-        """Displays the menu for logged-in users."""
+    def user_menu(self, email_or_phone, token=None):
+        """Displays the menu for logged-in users; token is the session started at login."""
         while True:
+            if token is not None and not self.api.session(token).ok:
+                print("\033[1;31mYour session has expired. Please log in again.\033[0m")
+                return
             print("=" * 30)
             print("\n\033[1;36m      --- User Menu ---\033[0m")
             print("=" * 30)
             print("\033[1;33m1. Change Password\033[0m")
-            print("\033[1;33m2. Logout\033[0m")
+            print("\033[1;33m2. New Backup Codes\033[0m")
+            print("\033[1;33m3. Logout\033[0m")
             print("=" * 30)
             choice = input("\033[1;34mEnter your choice: \033[0m").strip()
 
             if choice == "1":
-                self.change_password(email_or_phone)
-            elif choice == "2":
+                self.change_password(email_or_phone, token)
+            elif choice == "2" and token is not None:
+                self.new_backup_codes(token)
+            elif choice == "3":
+                if token is not None:
+                    self.api.logout(token)
                 print("\033[1;32mLogging out Successfully...\033[0m")
                 break
             else:
                 print("\033[1;31mInvalid choice. Please try again.\033[0m")
 
     def user_login(self):
-        """Handles the user login with delays triggered after every failed attempt."""
-        failed_attempts = 0
-        delay_time = self.initial_delay_time
-        email_or_phone = ""
-
+        """Handles the user login, locking out after repeated failures instead of sleeping."""
         while True:
-            if failed_attempts >= self.max_failed_attempts:
-                print(f"\033[1;31mToo many failed attempts with email or phone. Please wait {delay_time} seconds before trying again.\033[0m")
-                time.sleep(delay_time)
-                delay_time *= 3  # Exponential backoff
-                failed_attempts = 0
-
-                # After 3 wrong attempts, ask if the user wants to try again or not
-                try_again = input("\033[1;34mWould you like to try again? (yes/no): \033[0m").strip().lower()
-                if try_again != 'yes':
-                    print("\033[1;32mReturning to the main interface...\033[0m")
-                    return  # Return to the main interface (or exit)
-
             email_or_phone = input("\033[1;34mEnter your email or phone number: \033[0m").strip()
-            user_data = self.find_user(email_or_phone)
-
-            if not user_data:
-                print("\033[1;31mNo account found with that email or phone number. Please try again.\033[0m")
-                failed_attempts += 1
-                continue
-
-            password = input("\033[1;34mEnter your password: \033[0m").strip()
-            salt_hex = user_data[2]
-            stored_hashed_password = user_data[3]
-            salt = bytes.fromhex(salt_hex)
+            try:
+                result = self.api.lookup(email_or_phone)
+                if result.ok:
+                    password = input("\033[1;34mEnter your password: \033[0m").strip()
+                    result = self.api.login(email_or_phone, password)
+            except IOError:
+                print("\033[1;31mError: An error occurred while accessing the user data file.\033[0m")
+                return
 
-            if self.hash_password(password, salt) == stored_hashed_password:
+            if result.ok:
                 print("\033[1;32mLogin successful!\033[0m")
-                self.user_menu(email_or_phone)
+                self.user_menu(email_or_phone, result.data["token"])
                 return
-            else:
-                print("\033[1;31mIncorrect password. Please try again.\033[0m")
-                failed_attempts += 1
+
+            if result.error == LOCKED_OUT or result.retry_after:
+                print(f"\033[1;31mToo many failed attempts. Please try again in {result.retry_after} seconds.\033[0m")
+                print("\033[1;32mReturning to the main interface...\033[0m")
+                return
+
+            print(f"\033[1;31m{result.message} Please try again.\033[0m")
@@ -0,0 +1,234 @@
+import atexit
+import cProfile
+import functools
+import os
+import random
+import threading
+import time
+
+from file_lock import atomic_write
+
+# Set VERIFY_ME_METRICS=1 to count and time the hot paths. When it is off at startup the
+# instrumented functions are left undecorated, so they cost nothing.
+# VERIFY_ME_METRICS_FILE=path also turns them on and writes the Prometheus text format to path
+# every METRICS_FILE_INTERVAL seconds and at exit; "{pid}" in path is replaced by the process id.
+# VERIFY_ME_PROFILE_RATE=0.01 runs that share of service requests under cProfile and saves the
+# stats in VERIFY_ME_PROFILE_DIR (default "profiles").
+METRICS_FILE = os.environ.get("VERIFY_ME_METRICS_FILE")
+ENABLED = os.environ.get("VERIFY_ME_METRICS", "") == "1" or bool(METRICS_FILE)
+METRICS_FILE_INTERVAL = 15
+PROFILE_RATE = float(os.environ.get("VERIFY_ME_PROFILE_RATE", "0") or 0)
+PROFILE_DIR = os.environ.get("VERIFY_ME_PROFILE_DIR", "profiles")
+
+# Histogram bucket upper bounds in seconds.
+BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    "verify_me_operation_seconds": "Time spent in each instrumented operation.",
+    "verify_me_operation_errors_total": "Instrumented operations that raised an exception.",
+    "verify_me_failed_attempts_total": "Failed attempts counted by the rate limiter, by action.",
+    "verify_me_lockouts_total": "Failed attempts that started a lockout, by action.",
+    "verify_me_locked_out_total": "Requests refused because the caller was locked out, by action.",
+    "verify_me_http_requests_total": "Service requests by path and status.",
+    "verify_me_replica_events_total": "Change feed events applied by a follower, by type.",
+    "verify_me_replica_lag_seconds": "Time from a change being published to a follower applying it.",
+    "verify_me_replica_resyncs_total": "Times a follower reloaded its copy from the data files.",
+}
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+                break
+
+
+class Registry:
+    """Counters and latency histograms keyed by metric name and label pairs."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram()
+            histogram.observe(value)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, (list(h.bucket_counts), h.count, h.sum))
+                                for key, h in self._histograms.items())
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append(f"# HELP {name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, count, total) in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', repr(float(bound))),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+REGISTRY = Registry()
+
+
+def count(name, amount=1, **labels):
+    """Adds to a counter; does nothing while metrics are off."""
+    if ENABLED:
+        REGISTRY.inc(name, tuple(sorted(labels.items())), amount)
+
+
+def observe(name, value, **labels):
+    """Records a value in a histogram; does nothing while metrics are off."""
+    if ENABLED:
+        REGISTRY.observe(name, value, tuple(sorted(labels.items())))
+
+
+class _Timer:
+    __slots__ = ("labels", "started")
+
+    def __init__(self, operation):
+        self.labels = (("operation", operation),)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        REGISTRY.observe("verify_me_operation_seconds", time.perf_counter() - self.started, self.labels)
+        if exc_type is not None:
+            REGISTRY.inc("verify_me_operation_errors_total", self.labels)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(operation):
+    """Context manager that records how long its block took under operation."""
+    return _Timer(operation) if ENABLED else _NULL_TIMER
+
+
+def instrumented(operation):
+    """Decorator recording every call's duration under operation. Returns func itself while metrics are off."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(operation):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+_profiling = threading.local()
+
+
+def profiled(name, func, *args, **kwargs):
+    """Calls func, running a PROFILE_RATE share of the calls under cProfile.
+
+    The stats of a sampled call go to PROFILE_DIR/<name>-<time>-<pid>-<thread>.prof
+    (read them with python -m pstats).
+    """
+    if not PROFILE_RATE or getattr(_profiling, "active", False) or random.random() >= PROFILE_RATE:
+        return func(*args, **kwargs)
+    profile = cProfile.Profile()
+    _profiling.active = True
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        _profiling.active = False
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_name = name.strip("/").replace("/", "_") or "request"
+        profile.dump_stats(os.path.join(
+            PROFILE_DIR, f"{safe_name}-{time.time():.6f}-{os.getpid()}-{threading.get_ident()}.prof"))
+
+
+def write_file(path):
+    """Writes the current metrics to path atomically."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with atomic_write(path) as file:
+        file.write(REGISTRY.render())
+
+
+_exporter_lock = threading.Lock()
+_exporter = None
+
+
+def start_file_exporter():
+    """Starts writing METRICS_FILE in the background, once per process. Does nothing if it is unset."""
+    global _exporter
+    if not METRICS_FILE:
+        return
+    with _exporter_lock:
+        if _exporter is not None:
+            return
+        path = METRICS_FILE.replace("{pid}", str(os.getpid()))
+        stopped = threading.Event()
+
+        def export():
+            while not stopped.wait(METRICS_FILE_INTERVAL):
+                try:
+                    write_file(path)
+                except OSError:
+                    pass
+
+        def stop():
+            stopped.set()
+            write_file(path)
+
+        _exporter = threading.Thread(target=export, name="verify-me-metrics", daemon=True)
+        _exporter.start()
+        atexit.register(stop)
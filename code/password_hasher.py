@@ -0,0 +1,209 @@
+import argparse
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import instrumented
+
+# Set VERIFY_ME_HASHER to "algorithm$params" (e.g. "scrypt$n=16384:r=8:p=1") to choose how new
+# passwords are hashed. Otherwise the setting saved by "python code/password_hasher.py calibrate
+# --save" is used, or DEFAULT_HASHER.
+HASHER_SPEC = os.environ.get("VERIFY_ME_HASHER")
+HASHER_CONFIG_FILE = os.path.join("Database_txt", "password_hasher.txt")
+DEFAULT_HASHER = "pbkdf2_sha256$i=600000"
+
+
+def _parse_params(text):
+    # Parameters are "name=value" pairs joined by ":", never ",", so the stored hash stays one CSV field.
+    params = {}
+    for item in filter(None, text.split(":")):
+        name, _, value = item.partition("=")
+        params[name] = int(value)
+    return params
+
+
+class PBKDF2Hasher:
+    """PBKDF2-HMAC-SHA256; the cost is the iteration count."""
+
+    name = "pbkdf2_sha256"
+
+    def __init__(self, i=600000):
+        self.iterations = i
+
+    def params(self):
+        return f"i={self.iterations}"
+
+    def digest(self, password, salt):
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, self.iterations)
+
+    def with_cost(self, cost):
+        return PBKDF2Hasher(i=cost)
+
+
+class ScryptHasher:
+    """scrypt; memory-hard, every hash needs 128 * r * n bytes of RAM."""
+
+    name = "scrypt"
+
+    def __init__(self, n=16384, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def params(self):
+        return f"n={self.n}:r={self.r}:p={self.p}"
+
+    def digest(self, password, salt):
+        # OpenSSL refuses to use more than 32 MB unless told otherwise.
+        maxmem = 128 * self.r * (self.n + self.p + 2) + (1 << 20)
+        return hashlib.scrypt(password.encode(), salt=salt, n=self.n, r=self.r, p=self.p, maxmem=maxmem)
+
+    def with_cost(self, cost):
+        return ScryptHasher(n=cost, r=self.r, p=self.p)
+
+
+class LegacySHA256Hasher:
+    """The original single sha256(salt + password); only kept to verify old records."""
+
+    name = "sha256"
+
+    def params(self):
+        return ""
+
+    def digest(self, password, salt):
+        return hashlib.sha256(salt + password.encode()).digest()
+
+
+# algorithm name -> hasher class
+HASHERS = {cls.name: cls for cls in (PBKDF2Hasher, ScryptHasher, LegacySHA256Hasher)}
+
+
+def hasher_from_spec(spec):
+    """Builds a hasher from "algorithm$params". Raises ValueError for unknown algorithms or params."""
+    name, _, params = spec.partition("$")
+    cls = HASHERS.get(name)
+    if cls is None:
+        raise ValueError(f"Unknown password hashing algorithm: {name}")
+    try:
+        return cls(**_parse_params(params))
+    except TypeError:
+        raise ValueError(f"Invalid parameters for {name}: {params}")
+
+
+@instrumented("hash_password")
+def encode(hasher, password, salt):
+    """Returns the stored form algorithm$params$salt$hash."""
+    return f"{hasher.name}${hasher.params()}${salt.hex()}${hasher.digest(password, salt).hex()}"
+
+
+@instrumented("decode_hash")
+def decode(salt_hex, hashed_password):
+    """Splits a stored hash into (hasher, salt, digest).
+
+    Records written before hashers existed keep a bare sha256 hex digest with the
+    salt in its own column.
+    """
+    if "$" not in hashed_password:
+        return LegacySHA256Hasher(), bytes.fromhex(salt_hex), bytes.fromhex(hashed_password)
+    name, params, stored_salt, digest = hashed_password.split("$")
+    return hasher_from_spec(f"{name}${params}"), bytes.fromhex(stored_salt), bytes.fromhex(digest)
+
+
+@instrumented("verify_password")
+def verify(password, salt_hex, hashed_password):
+    """Tells whether password matches the stored hash, whatever algorithm made it."""
+    hasher, salt, digest = decode(salt_hex, hashed_password)
+    return hmac.compare_digest(hasher.digest(password, salt), digest)
+
+
+def needs_rehash(hashed_password):
+    """Tells whether a stored hash was made with another algorithm or cost than the current one."""
+    current = get_password_hasher()
+    return hashed_password.rpartition("$")[0].rpartition("$")[0] != f"{current.name}${current.params()}"
+
+
+_lock = threading.Lock()
+_hasher = None
+_executor = None
+
+
+def get_password_hasher():
+    """Returns the hasher used for new passwords."""
+    global _hasher
+    with _lock:
+        if _hasher is None:
+            spec = HASHER_SPEC
+            if not spec and os.path.exists(HASHER_CONFIG_FILE):
+                with open(HASHER_CONFIG_FILE, "r") as file:
+                    spec = file.read().strip()
+            _hasher = hasher_from_spec(spec or DEFAULT_HASHER)
+        return _hasher
+
+
+def get_hash_executor():
+    """Returns the pool that runs hashes and verifies.
+
+    hashlib's pbkdf2_hmac and scrypt release the GIL, so the pool hashes on every
+    core while the caller's thread stays free; one thread per core also bounds how
+    much memory concurrent scrypt calls take.
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="verify-me-hash")
+        return _executor
+
+
+def _time_digest(hasher, rounds=3):
+    salt = os.urandom(16)
+    best = None
+    for _ in range(rounds):
+        started = time.perf_counter()
+        hasher.digest("calibration password", salt)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def calibrate(algorithm, target_ms):
+    """Returns the most expensive hasher of this algorithm whose verify takes at most target_ms here."""
+    if algorithm == PBKDF2Hasher.name:
+        # Time grows linearly with the iteration count: measure once, scale, then step down if needed.
+        probe = PBKDF2Hasher(i=10000)
+        iterations = max(1000, int(probe.iterations * target_ms / _time_digest(probe)) // 1000 * 1000)
+        hasher = probe.with_cost(iterations)
+        while iterations > 1000 and _time_digest(hasher) > target_ms:
+            iterations = iterations * 9 // 10 // 1000 * 1000
+            hasher = probe.with_cost(iterations)
+        return hasher
+    if algorithm == ScryptHasher.name:
+        # n must be a power of two; keep doubling while the next step still fits.
+        hasher = ScryptHasher(n=1024)
+        while _time_digest(hasher.with_cost(hasher.n * 2)) <= target_ms:
+            hasher = hasher.with_cost(hasher.n * 2)
+        return hasher
+    raise ValueError(f"Cannot calibrate {algorithm}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pick the password hashing cost that fits this machine.")
+    parser.add_argument("command", choices=("calibrate",))
+    parser.add_argument("--algorithm", choices=(PBKDF2Hasher.name, ScryptHasher.name), default=PBKDF2Hasher.name)
+    parser.add_argument("--target-ms", type=float, default=250, help="time one verify may take (default 250)")
+    parser.add_argument("--save", action="store_true", help=f"use the result for new passwords ({HASHER_CONFIG_FILE})")
+    args = parser.parse_args()
+
+    hasher = calibrate(args.algorithm, args.target_ms)
+    spec = f"{hasher.name}${hasher.params()}"
+    print(f"{spec}  ({_time_digest(hasher):.0f} ms per verify)")
+    if args.save:
+        with open(HASHER_CONFIG_FILE, "w") as file:
+            file.write(spec + "\n")
+        print(f"\033[1;32m[Success] Saved to {HASHER_CONFIG_FILE}. Passwords are rehashed at their next login.\033[0m")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import string
+
+from blocklist import get_blocklist
+
+
+class PasswordPolicy:
+    """Rules a new password must follow. check() returns the first broken rule, or None.
+
+    With check_breached, passwords found in the breached password blocklist are
+    refused too (when a blocklist file has been built).
+    """
+
+    def __init__(self, min_length=8, require_upper=True, require_lower=True, require_digit=False,
+                 special_chars=string.punctuation, check_breached=True):
+        self.min_length = min_length
+        self.require_upper = require_upper
+        self.require_lower = require_lower
+        self.require_digit = require_digit
+        self.special_chars = special_chars
+        self.check_breached = check_breached
+
+    def check(self, password):
+        """Returns a message describing why password is rejected, or None if it is acceptable."""
+        if len(password) < self.min_length:
+            return f"Password must be at least {self.min_length} characters long."
+        if self.require_upper and not any(c.isupper() for c in password):
+            return "Password must contain at least one uppercase letter."
+        if self.require_lower and not any(c.islower() for c in password):
+            return "Password must contain at least one lowercase letter."
+        if self.require_digit and not any(c.isdigit() for c in password):
+            return "Password must contain at least one number."
+        if self.special_chars and not any(c in self.special_chars for c in password):
+            if self.special_chars == string.punctuation:
+                return "Password must contain at least one special character."
+            return f"Password must contain at least one special character ({self.special_chars})."
+        if self.check_breached:
+            blocklist = get_blocklist()
+            if blocklist is not None and password in blocklist:
+                return "This password has appeared in a data breach. Please choose a different one."
+        return None
+
+    def is_valid(self, password):
+        return self.check(password) is None
+
+
+# The rules each flow has always applied.
+REGISTER_POLICY = PasswordPolicy()
+RESET_PASSWORD_POLICY = PasswordPolicy(require_digit=True, special_chars="!@#$%^&*(),.?\":{}|<>")
+CHANGE_PASSWORD_POLICY = PasswordPolicy(require_lower=False, require_digit=True, special_chars="!@#$%&*")
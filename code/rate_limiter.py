@@ -0,0 +1,288 @@
+import json
+import math
+import mmap
+import os
+import socket
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+import metrics
+
+# Set VERIFY_ME_LOCKOUT_SOCKET=path to share failed-attempt counters and lockouts between all
+# processes through the lockout daemon listening there (python code/lockout_daemon.py serve).
+# The daemon also keeps "<path>.filter", FILTER_SLOTS shared counters of the keys it has entries
+# for by hash, so a process can tell that a key has no history without asking it.
+LOCKOUT_SOCKET = os.environ.get("VERIFY_ME_LOCKOUT_SOCKET")
+FILTER_SUFFIX = ".filter"
+FILTER_SLOTS = 1 << 20
+
+
+class _Entry:
+    __slots__ = ("failures", "locked_until", "lockouts", "last_seen")
+
+    def __init__(self):
+        self.failures = deque()  # timestamps of failures inside the window
+        self.locked_until = 0.0
+        self.lockouts = 0  # consecutive lockouts, drives the backoff
+        self.last_seen = 0.0
+
+
+class RateLimiter:
+    """Tracks failed attempts per key and answers "retry after N seconds" instead of sleeping.
+
+    A key is any hashable value, usually (action, identifier) or (action, identifier, source).
+    max_failures failures inside a sliding window of window seconds lock the key out for
+    base_lockout * backoff_factor ** (lockouts so far) seconds, capped at max_lockout.
+    Entries with no activity for a full window after their lockout are evicted, and at
+    most max_entries keys are kept so memory stays bounded under credential stuffing.
+    on_change, if given, is called as on_change(key, True) when a key gets an entry and
+    on_change(key, False) when its entry is dropped.
+    """
+
+    def __init__(self, max_failures=3, window=300, base_lockout=30, backoff_factor=3,
+                 max_lockout=3600, max_entries=100000, clock=time.monotonic, on_change=None):
+        self.max_failures = max_failures
+        self.window = window
+        self.base_lockout = base_lockout
+        self.backoff_factor = backoff_factor
+        self.max_lockout = max_lockout
+        self.max_entries = max_entries
+        self.clock = clock
+        self.on_change = on_change
+        self._entries = OrderedDict()  # least recently active first
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+
+    def _expired(self, entry, now):
+        return now >= max(entry.locked_until, entry.last_seen) + self.window
+
+    def _sweep(self, now):
+        """Drops expired entries from the cold end, and the oldest ones if over capacity."""
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if self._expired(entry, now) or len(self._entries) >= self.max_entries:
+                del self._entries[key]
+                if self.on_change is not None:
+                    self.on_change(key, False)
+            else:
+                break
+        self._next_sweep = now + 1.0
+
+    def _touch(self, key, now):
+        if now >= self._next_sweep or len(self._entries) >= self.max_entries:
+            self._sweep(now)
+        entry = self._entries.get(key)
+        if entry is None or self._expired(entry, now):
+            if entry is None and self.on_change is not None:
+                self.on_change(key, True)
+            entry = _Entry()
+            self._entries[key] = entry
+        self._entries.move_to_end(key)
+        entry.last_seen = now
+        return entry
+
+    def _lock_out(self, entry, now):
+        duration = min(self.base_lockout * self.backoff_factor ** entry.lockouts, self.max_lockout)
+        entry.lockouts += 1
+        entry.locked_until = now + duration
+        entry.failures.clear()
+        return duration
+
+    def expire(self):
+        """Drops expired entries now; otherwise that happens as other keys are touched."""
+        with self._lock:
+            self._sweep(self.clock())
+
+    def retry_after(self, key):
+        """Returns the whole seconds to wait before key may try again, 0 if it may try now."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return 0
+            remaining = entry.locked_until - self.clock()
+            return math.ceil(remaining) if remaining > 0 else 0
+
+    def record_failure(self, key):
+        """Counts a failed attempt. Returns the lockout in seconds if this failure caused one, else 0."""
+        with self._lock:
+            now = self.clock()
+            entry = self._touch(key, now)
+            if entry.locked_until > now:
+                return math.ceil(entry.locked_until - now)
+            entry.failures.append(now)
+            while entry.failures and entry.failures[0] <= now - self.window:
+                entry.failures.popleft()
+            if len(entry.failures) >= self.max_failures:
+                return math.ceil(self._lock_out(entry, now))
+            return 0
+
+    def lock(self, key):
+        """Locks key out right away with the next backoff step. Returns the lockout in seconds."""
+        with self._lock:
+            now = self.clock()
+            entry = self._touch(key, now)
+            if entry.locked_until > now:
+                return math.ceil(entry.locked_until - now)
+            return math.ceil(self._lock_out(entry, now))
+
+    def record_success(self, key):
+        """Forgets the failure history of key."""
+        with self._lock:
+            if self._entries.pop(key, None) is not None and self.on_change is not None:
+                self.on_change(key, False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def filter_slot(key):
+    """The slot of key in the daemon's shared filter."""
+    return zlib.crc32(json.dumps(list(key), separators=(",", ":")).encode()) & (FILTER_SLOTS - 1)
+
+
+class _Batch:
+    """Calls that go to the daemon in the same request."""
+    __slots__ = ("calls", "results", "done", "error")
+
+    def __init__(self):
+        self.calls = []
+        self.results = None
+        self.done = False
+        self.error = None
+
+
+class SharedRateLimiter:
+    """A RateLimiter whose counters live in the lockout daemon, shared by every process using it.
+
+    Calls that threads make while a request is on its way are sent together in the next
+    one. retry_after() and record_success() for a key whose slot in the shared filter is
+    0 (no entry in the daemon) return at once, without a request or a lock. While the
+    daemon cannot be reached, each process falls back to its own RateLimiter and tries
+    the daemon again after retry_interval seconds.
+    """
+
+    def __init__(self, socket_path, timeout=1.0, retry_interval=5.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._local = RateLimiter()
+        self._condition = threading.Condition()
+        self._batch = _Batch()
+        self._sending = False
+        self._socket = None
+        self._reader = None
+        self._filter = None
+        self._down_until = 0.0
+
+    def _down(self):
+        return time.monotonic() < self._down_until
+
+    def _has_history(self, key):
+        """False only if the daemon has no entry for key; reads the shared filter without locking."""
+        if self._filter is None:
+            try:
+                with open(self.socket_path + FILTER_SUFFIX, "rb") as file:
+                    counters = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast("I")
+            except (OSError, ValueError, TypeError):
+                return True
+            if len(counters) != FILTER_SLOTS:
+                return True
+            self._filter = counters
+        return self._filter[filter_slot(key)] != 0
+
+    def _send(self, calls):
+        if self._socket is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            try:
+                connection.connect(self.socket_path)
+            except OSError:
+                connection.close()
+                raise
+            self._socket, self._reader = connection, connection.makefile("rb")
+        try:
+            self._socket.sendall((json.dumps(calls, separators=(",", ":")) + "\n").encode())
+            line = self._reader.readline()
+            if not line:
+                raise ConnectionError("The lockout daemon closed the connection.")
+            return json.loads(line)
+        except (OSError, ValueError):
+            self._reader.close()
+            self._socket.close()
+            self._socket = self._reader = None
+            raise ConnectionError("Lost the connection to the lockout daemon.")
+
+    def _call(self, operation, key):
+        """Returns the daemon's answer, or None if it cannot be reached."""
+        if self._down():
+            return None
+        with self._condition:
+            batch = self._batch
+            index = len(batch.calls)
+            batch.calls.append([operation, None if key is None else list(key)])
+            while not batch.done:
+                if self._sending:
+                    self._condition.wait()
+                    continue
+                # Leader: send everything queued so far; later callers start a new batch.
+                self._batch = _Batch()
+                self._sending = True
+                self._condition.release()
+                try:
+                    with metrics.timed("lockout_daemon_request"):
+                        batch.results = self._send(batch.calls)
+                except OSError as e:
+                    batch.error = e
+                finally:
+                    self._condition.acquire()
+                    self._sending = False
+                    batch.done = True
+                    self._condition.notify_all()
+        if batch.error is not None:
+            self._down_until = time.monotonic() + self.retry_interval
+            metrics.count("verify_me_lockout_daemon_errors_total")
+            return None
+        return batch.results[index]
+
+    def retry_after(self, key):
+        if not self._down() and not self._has_history(key):
+            return 0
+        result = self._call("retry_after", key)
+        return self._local.retry_after(key) if result is None else result
+
+    def record_failure(self, key):
+        result = self._call("record_failure", key)
+        return self._local.record_failure(key) if result is None else result
+
+    def lock(self, key):
+        result = self._call("lock", key)
+        return self._local.lock(key) if result is None else result
+
+    def record_success(self, key):
+        self._local.record_success(key)
+        if not self._down() and self._has_history(key):
+            self._call("record_success", key)
+
+    def ping(self):
+        """Returns how many keys the daemon has entries for, or None if it cannot be reached."""
+        return self._call("count", None)
+
+    def __len__(self):
+        count = self.ping()
+        return len(self._local) if count is None else count
+
+
+_default_limiter = None
+_default_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Returns the process-wide RateLimiter shared by the account classes (a SharedRateLimiter
+    while VERIFY_ME_LOCKOUT_SOCKET is set)."""
+    global _default_limiter
+    with _default_lock:
+        if _default_limiter is None:
+            _default_limiter = SharedRateLimiter(LOCKOUT_SOCKET) if LOCKOUT_SOCKET else RateLimiter()
+        return _default_limiter
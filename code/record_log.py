@@ -0,0 +1,252 @@
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from file_lock import FileLock, atomic_write, fsync_directory, mode_for
+from metrics import instrumented
+from snapshot import snapshot_file_for
+
+TOMBSTONE_PREFIX = "~"
+
+# poll() results
+UNCHANGED = "unchanged"
+APPENDED = "appended"
+REPLACED = "replaced"
+
+
+class RecordLog:
+    """A CSV data file read as a log: the latest record for a key wins and "~key" lines delete it."""
+
+    def __init__(self, path, key_fields, min_fields, lock=None,
+                 compact_threshold=0.5, min_compact_records=1000):
+        self.path = path
+        self.key_fields = key_fields
+        self.min_fields = min_fields
+        self.lock = lock if lock is not None else threading.RLock()
+        self.file_lock = FileLock(path)
+        self.compact_threshold = compact_threshold
+        self.min_compact_records = min_compact_records
+        self.position = 0  # bytes already read into the caller's state
+        self.record_count = 0  # records and tombstones up to position
+        self._identity = None
+        self._compaction = None
+
+    def key_of(self, fields):
+        return tuple(fields[:self.key_fields])
+
+    def format_record(self, fields):
+        return ",".join(fields) + "\n"
+
+    def format_tombstone(self, key):
+        return TOMBSTONE_PREFIX + ",".join(key) + "\n"
+
+    def parse(self, line):
+        """Returns (key, fields) for a record, (key, None) for a tombstone, or None if malformed."""
+        line = line.strip()
+        if line.startswith(TOMBSTONE_PREFIX):
+            key = line[len(TOMBSTONE_PREFIX):].split(",")
+            if len(key) < self.key_fields:
+                return None
+            return tuple(key[:self.key_fields]), None
+        fields = line.split(",")
+        if len(fields) < self.min_fields:
+            return None
+        return self.key_of(fields), fields
+
+    @contextmanager
+    def exclusive(self):
+        """Holds the in-process lock and the cross-process write lock together."""
+        with self.lock, self.file_lock.exclusive():
+            yield
+
+    def _drop_snapshot(self):
+        """Deletes the file's index snapshot before the file is replaced; the caller holds exclusive().
+
+        The new file could get the old one's inode back, and then nothing else would tell the
+        snapshot is stale.
+        """
+        try:
+            os.remove(snapshot_file_for(self.path))
+        except FileNotFoundError:
+            pass
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat
+
+    def cursor(self):
+        """Returns how far the file has been read, as a JSON-friendly dict for restore()."""
+        return {"identity": list(self._identity) if self._identity else None,
+                "position": self.position, "record_count": self.record_count}
+
+    def restore(self, cursor):
+        """Continues from a cursor() saved earlier; poll() then reports what changed since."""
+        self._identity = tuple(cursor["identity"]) if cursor.get("identity") else None
+        self.position = cursor.get("position", 0)
+        self.record_count = cursor.get("record_count", 0)
+
+    def poll(self):
+        """Tells whether the file is unchanged, was appended to, or was replaced since last read."""
+        stat = self._stat()
+        if stat is None:
+            return UNCHANGED if self._identity is None else REPLACED
+        if (stat.st_dev, stat.st_ino) != self._identity or stat.st_size < self.position:
+            return REPLACED
+        if stat.st_size > self.position:
+            return APPENDED
+        return UNCHANGED
+
+    def read(self, from_start=False):
+        """Yields (key, fields) for every record after the current position, advancing it."""
+        if from_start:
+            self.position = 0
+            self.record_count = 0
+        with self.file_lock.shared():
+            try:
+                file = open(self.path, "rb")
+            except FileNotFoundError:
+                self._identity = None
+                self.position = 0
+                return
+            with file:
+                stat = os.fstat(file.fileno())
+                self._identity = (stat.st_dev, stat.st_ino)
+                file.seek(self.position)
+                for raw in file:
+                    if not raw.endswith(b"\n"):
+                        break  # a half-written line from a crashed writer; never treat it as data
+                    self.position += len(raw)
+                    parsed = self.parse(raw.decode())
+                    if parsed is not None:
+                        self.record_count += 1
+                        yield parsed
+
+    @instrumented("file_append")
+    def _append_lines(self, lines):
+        data = "".join(lines).encode()
+        with self.exclusive():
+            with open(self.path, "ab") as file:
+                file.write(data)
+                end = file.tell()
+            stat = self._stat()
+            if self._identity == (stat.st_dev, stat.st_ino) and end - len(data) == self.position:
+                # Nobody else wrote in between, so our own state is still current.
+                self.position = end
+                self.record_count += len(lines)
+
+    def append(self, records, tombstones=()):
+        """Appends upsert records, after deletion markers for the tombstones keys, in a single write."""
+        self._append_lines([self.format_tombstone(key) for key in tombstones]
+                           + [self.format_record(fields) for fields in records])
+
+    def append_tombstones(self, keys):
+        """Appends deletion markers in a single write."""
+        self._append_lines([self.format_tombstone(key) for key in keys])
+
+    @instrumented("file_rewrite")
+    def rewrite(self, key, fields):
+        """Rewrites the whole file replacing (or, with fields=None, dropping) every record for key.
+
+        The caller is expected to hold exclusive() and to have read the file up to its end.
+        """
+        with self.exclusive():
+            self._drop_snapshot()
+            found = False
+            record_count = 0
+            with open(self.path, "r") as file, atomic_write(self.path) as temp:
+                for line in file:
+                    parsed = self.parse(line)
+                    if parsed is None or parsed[0] != key:
+                        temp.write(line)
+                        record_count += parsed is not None
+                        continue
+                    if not found and fields is not None:
+                        temp.write(self.format_record(fields))
+                        record_count += 1
+                    found = True
+                size = temp.tell()
+            stat = self._stat()
+            self._identity = (stat.st_dev, stat.st_ino)
+            self.position = size
+            self.record_count = record_count
+            return found
+
+    def sync(self):
+        """Flushes the file's appended and rewritten data to disk."""
+        try:
+            with open(self.path, "rb") as file:
+                os.fsync(file.fileno())
+        except FileNotFoundError:
+            pass
+
+    def dead_ratio(self, live_count):
+        if self.record_count == 0:
+            return 0.0
+        return max(self.record_count - live_count, 0) / self.record_count
+
+    def maybe_compact(self, live_count, snapshot):
+        """Starts a background compaction once enough of the file is superseded records."""
+        if self.record_count < self.min_compact_records:
+            return False
+        if self.dead_ratio(live_count) < self.compact_threshold:
+            return False
+        with self.lock:
+            if self._compaction is not None and self._compaction.is_alive():
+                return False
+            self._compaction = threading.Thread(target=self.compact, args=(snapshot,), daemon=True)
+            self._compaction.start()
+        return True
+
+    @instrumented("compact")
+    def compact(self, snapshot):
+        """Rewrites the file to hold only live records.
+
+        snapshot() is called under the lock and must return the live records as field lists.
+        Records appended while the copy is being written are carried over before the swap.
+        """
+        with self.lock:
+            records = list(snapshot())
+            offset = self.position
+            record_count = self.record_count
+            live_count = len(records)
+
+        directory = os.path.dirname(self.path)
+        fd, temp_file = tempfile.mkstemp(prefix=os.path.basename(self.path) + ".",
+                                         suffix=".compact", dir=directory or ".")
+        try:
+            os.chmod(temp_file, mode_for(self.path))
+            with os.fdopen(fd, "wb") as temp:
+                for fields in records:
+                    temp.write(self.format_record(fields).encode())
+                live_size = temp.tell()
+
+                with self.exclusive():
+                    if self.poll() == REPLACED:
+                        # Someone else rewrote the file; our snapshot no longer describes it.
+                        return False
+                    tail_records = self.record_count - record_count
+                    with open(self.path, "rb") as source:
+                        source.seek(offset)
+                        while True:
+                            chunk = source.read(1 << 20)
+                            if not chunk:
+                                break
+                            temp.write(chunk)
+                    temp.flush()
+                    os.fsync(temp.fileno())
+                    self._drop_snapshot()
+                    os.replace(temp_file, self.path)
+                    fsync_directory(directory)
+                    stat = self._stat()
+                    self._identity = (stat.st_dev, stat.st_ino)
+                    # Anything past our old position was appended by another process and is still unread.
+                    self.position = live_size + (self.position - offset)
+                    self.record_count = live_count + tail_records
+        finally:
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+        return True
@@ -1,8 +1,8 @@
-import hashlib
 import os
-import random
-import string
-import time
+
+import auth_api
+from auth_api import AuthAPI
+from password_policy import REGISTER_POLICY
 
 
 class UserSystem:
@@ -17,31 +17,30 @@ class UserSystem:
         except OSError as e:
             self.show_error(f"Failed to create database directory: {e}")
 
+        self.api = AuthAPI(user_data_file, backup_code_file)
+        self.rate_limiter = self.api.rate_limiter
+        # This terminal's own invalid entries; with a shared lockout daemon other terminals keep theirs.
+        self.rate_limit_key = ("register", None, f"terminal {os.getpid()}")
+
     def hash_password(self, password, salt):
-        """Hashes the password using SHA256."""
-        return hashlib.sha256(salt + password.encode()).hexdigest()
+        """Hashes the password with the configured hasher."""
+        return auth_api.hash_password(password, salt)
 
     def generate_backup_code(self, count=1):
         """Generates multiple 8-digit unique backup codes."""
-        backup_codes = set()
-        while len(backup_codes) < count:
-            backup_codes.add(''.join(random.choices(string.digits, k=8)))
-        return list(backup_codes)
+        return auth_api.generate_backup_codes(count)
 
     def validate_email(self, email):
         """Validates if the email ends with '@gmail.com'."""
-        return email.endswith("@gmail.com")
+        return auth_api.validate_email(email)
 
     def validate_phone(self, phone):
         """Validates if the phone starts with '0' and contains 9-10 digits.""" 
-        return phone.startswith("0") and phone[1:].isdigit() and 9 <= len(phone) <= 10
+        return auth_api.validate_phone(phone)
 
     def validate_password(self, password):
         """Validates if the password meets complexity requirements.""" 
-        has_upper = any(char.isupper() for char in password)
-        has_lower = any(char.islower() for char in password)
-        has_special = any(char in string.punctuation for char in password)
-        return len(password) >= 8 and has_upper and has_lower and has_special
+        return REGISTER_POLICY.is_valid(password)
 
     def show_error(self, message):
         """Displays errors in a consistent format.""" 
@@ -55,111 +54,49 @@ class UserSystem:
         """Displays steps in a consistent format.""" 
         print(f"\033[1;34m[Step {step_number}] {message}\033[0m")
 
+    def lock_out(self):
+        """Locks registration for a while instead of sleeping, and says for how long."""
+        retry_after = self.rate_limiter.lock(self.rate_limit_key)
+        self.show_error(f"Too many invalid attempts. Try again after {retry_after} seconds.")
+
     def validate_username(self, username):
         """Validates if the username meets the requirements.""" 
-        if len(username) < 2:
-            return False, "Username must be at least 2 characters long."
-
-        if username.isdigit():
-            return False, "Username cannot be only numbers."
-
-        if username.startswith(" ") or username.endswith(" "):
-            return False, "Username cannot start or end with spaces."
+        return auth_api.validate_username(username)
 
-        if " " in username:
-            split_username = username.split(" ")
-            if any(part == "" for part in split_username):
-                return False, "Username cannot have consecutive spaces or start with space."
-
-        return True, ""
+    def prompt_until_valid(self, prompt, check, max_attempts):
+        """Asks for a value until check(value) succeeds. Returns None after max_attempts failures."""
+        for _ in range(max_attempts):
+            value = input(prompt).strip()
+            try:
+                result = check(value)
+            except IOError as e:
+                self.show_error(f"Error reading user data file: {e}")
+                return None
+            if result.ok:
+                return value
+            self.show_error(result.message)
+        self.lock_out()
+        return None
 
     def register_user(self):
         """Registers a new user with retry limits and delay enforcement.""" 
         max_attempts = 3  # Maximum attempts for each step
-        delay_time = 30  # Delay in seconds after exceeding attempts
-
-        self.show_step(1, "Enter your email or phone number.")
-        failed_attempts = 0
-        while failed_attempts < max_attempts:
-            email_or_phone = input("Enter your email or phone number: ").strip()
 
-            try:
-                if os.path.exists(self.user_data_file):
-                    with open(self.user_data_file, "r") as file:
-                        existing_users = file.readlines()
-                        if any(email_or_phone in user.split(",") for user in existing_users):
-                            self.show_error("This email or phone number is already registered.")
-                            failed_attempts += 1
-                            if failed_attempts >= max_attempts:
-                                self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-                                time.sleep(delay_time)
-                                return
-                            continue
-            except IOError as e:
-                self.show_error(f"Error reading user data file: {e}")
-                return
-
-            if "@" in email_or_phone:
-                if not self.validate_email(email_or_phone):
-                    self.show_error("Invalid email format. Use a valid Gmail address (e.g., example@gmail.com).")
-                    failed_attempts += 1
-                else:
-                    break
-            else:
-                if not self.validate_phone(email_or_phone):
-                    self.show_error("Invalid phone number. Ensure it starts with '0' and is 9-10 digits long.")
-                    failed_attempts += 1
-                else:
-                    break
+        retry_after = self.rate_limiter.retry_after(self.rate_limit_key)
+        if retry_after:
+            self.show_error(f"Too many invalid attempts. Try again after {retry_after} seconds.")
+            return
 
-        if failed_attempts >= max_attempts:
-            self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-            time.sleep(delay_time)
+        self.show_step(1, "Enter your email or phone number.")
+        email_or_phone = self.prompt_until_valid("Enter your email or phone number: ",
+                                                 self.api.check_identifier, max_attempts)
+        if email_or_phone is None:
             return
 
         self.show_step(2, "Enter a unique username.")
-        failed_attempts = 0
-        while failed_attempts < max_attempts:
-            username = input("Enter your username: ").strip()
-
-            is_valid, error_message = self.validate_username(username)
-            if not is_valid:
-                self.show_error(error_message)
-                failed_attempts += 1
-                if failed_attempts >= max_attempts:
-                    self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-                    time.sleep(delay_time)
-                    return
-                continue
-
-            try:
-                if os.path.exists(self.user_data_file):
-                    with open(self.user_data_file, "r") as file:
-                        existing_users = file.readlines()
-                        if any(username in user.split(",") for user in existing_users):
-                            self.show_error("This username is already taken. Please choose a different one.")
-                            failed_attempts += 1
-                            if failed_attempts >= max_attempts:
-                                self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-                                time.sleep(delay_time)
-                                return
-                            continue
-            except IOError as e:
-                self.show_error(f"Error reading user data file: {e}")
-                return
-
-            if not username:
-                self.show_error("Username cannot be empty.")
-                failed_attempts += 1
-            elif username == email_or_phone:
-                self.show_error("Username and email/phone number cannot be the same.")
-                failed_attempts += 1
-            else:
-                break
-
-        if failed_attempts >= max_attempts:
-            self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-            time.sleep(delay_time)
+        username = self.prompt_until_valid("Enter your username: ",
+                                           lambda name: self.api.check_username(name, email_or_phone), max_attempts)
+        if username is None:
             return
 
         self.show_step(3, "Enter and confirm your password.")
@@ -167,13 +104,10 @@ class UserSystem:
         while failed_attempts < max_attempts:
             password = input("Enter your password: ").strip()
 
-            if not self.validate_password(password):
-                self.show_error("Password must be at least 8 characters long and include uppercase, lowercase, and special characters.")
+            result = self.api.check_password(password)
+            if not result.ok:
+                self.show_error(result.message)
                 failed_attempts += 1
-                if failed_attempts >= max_attempts:
-                    self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-                    time.sleep(delay_time)
-                    return
                 continue
 
             confirm_password = input("Confirm your password: ").strip()
@@ -184,30 +118,21 @@ class UserSystem:
                 break
 
         if failed_attempts >= max_attempts:
-            self.show_error(f"Too many invalid attempts. Try again after {delay_time} seconds.")
-            time.sleep(delay_time)
+            self.lock_out()
             return
 
-        salt = os.urandom(16)
-        hashed_password = self.hash_password(password, salt)
-        backup_codes = self.generate_backup_code(10)
-
         try:
-            with open(self.user_data_file, "a") as file:
-                file.write(f"{email_or_phone},{username},{salt.hex()},{hashed_password}\n")
+            result = self.api.register(email_or_phone, username, password)
         except IOError as e:
-            self.show_error(f"Error writing to user data file: {e}")
+            self.show_error(f"Error writing to the data files: {e}")
             return
 
-        try:
-            with open(self.backup_code_file, "a") as file:
-                for code in backup_codes:
-                    file.write(f"{email_or_phone},{code}\n")
-        except IOError as e:
-            self.show_error(f"Error writing to backup code file: {e}")
+        if not result.ok:
+            self.show_error(result.message)
             return
 
-        self.show_success(f"User '{username}' registered successfully!")
+        backup_codes = result.data["backup_codes"]
+        self.show_success(result.message)
         print("\nHere are your backup codes:")
         for code in backup_codes:
             print(f"\033[1;33m{code}\033[0m")
@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+import metrics
+from auth_api import AuthAPI
+from change_feed import REGISTER, UPDATE, FeedGap, get_change_feed
+from service import READ_ROUTES, HTTPServer
+from sessions import get_session_store
+from storage import get_user_store
+from user_store import UserRecord
+
+# VERIFY_ME_REPLICA_MAX_LAG: a follower answers reads from a copy at most this many seconds behind
+# the change feed (default 1); a read finding it older first catches up. It also polls the feed
+# every POLL_INTERVAL seconds in the background.
+MAX_LAG = float(os.environ.get("VERIFY_ME_REPLICA_MAX_LAG", "1") or 1)
+POLL_INTERVAL = 0.05
+
+
+class ReadOnlyReplica(IOError):
+    """Raised by the write methods of a Replica: changes go to the primary."""
+
+
+class Replica:
+    """A follower's in-memory copy of the users, kept current from the primary's change feed.
+
+    It starts from the data files, read under the feed's lock so no change is half
+    made, and then applies the feed's events. It answers the lookups of a user store
+    and a uniqueness index, so an AuthAPI built on it serves logins, sessions and the
+    registration checks; its write methods raise ReadOnlyReplica. A follower that falls
+    so far behind that the events it needs were dropped starts over from the files.
+    """
+
+    def __init__(self, feed, source_store, sessions=None, max_lag=MAX_LAG):
+        self.feed = feed
+        self.source_store = source_store
+        self.sessions = sessions
+        self.max_lag = max_lag
+        self._lock = threading.RLock()
+        self._by_identifier = {}
+        self._by_username = {}
+        self._reader = None
+        self._caught_up_at = None  # time.monotonic() of the last catch_up()
+
+    @property
+    def seq(self):
+        return self._reader.seq if self._reader is not None else 0
+
+    def _bootstrap(self):
+        with metrics.timed("replica_bootstrap"), self.feed.file_lock.shared():
+            seq = self.feed.last_seq()
+            records = self.source_store.live_records()
+        self._by_identifier = {record.identifier: record for record in records}
+        self._by_username = {record.username: record.identifier for record in records}
+        self._reader = self.feed.reader(seq)
+        metrics.count("verify_me_replica_resyncs_total")
+
+    def _apply(self, event):
+        if event["type"] in (REGISTER, UPDATE):
+            record = UserRecord(*event["user"])
+            previous = self._by_identifier.get(record.identifier)
+            if previous is not None and self._by_username.get(previous.username) == record.identifier:
+                del self._by_username[previous.username]
+            self._by_identifier[record.identifier] = record
+            self._by_username[record.username] = record.identifier
+            if self.sessions is not None and event["type"] == UPDATE:
+                if event.get("revoke"):
+                    self.sessions.revoke_user(record.identifier)
+                else:
+                    self.sessions.update_user(record)
+        # Backup code events need nothing here: codes are only checked on the primary, by writes.
+        metrics.count("verify_me_replica_events_total", type=event["type"])
+
+    def catch_up(self):
+        """Applies every event published so far. Returns how many were applied."""
+        with self._lock:
+            started = time.monotonic()
+            if self._reader is None:
+                self._bootstrap()
+            try:
+                events = self._reader.read()
+            except FeedGap:
+                self._bootstrap()
+                events = self._reader.read()
+            now = time.time()
+            for event in events:
+                self._apply(event)
+                metrics.observe("verify_me_replica_lag_seconds", max(now - event["time"], 0.0))
+            self._caught_up_at = started
+            return len(events)
+
+    def refresh(self):
+        """Catches up if the copy may be more than max_lag seconds behind."""
+        if self._caught_up_at is None or time.monotonic() - self._caught_up_at > self.max_lag:
+            self.catch_up()
+
+    def lag(self):
+        """Returns (events not applied yet, seconds since the copy was last caught up)."""
+        with self._lock:
+            behind = self.feed.last_seq() - self.seq
+            age = time.monotonic() - self._caught_up_at if self._caught_up_at is not None else None
+            return behind, age
+
+    def follow(self, interval=POLL_INTERVAL):
+        """Keeps catching up on a background thread."""
+        def poll():
+            while True:
+                try:
+                    self.catch_up()
+                except OSError:
+                    pass  # the next read retries, and fails loudly if the feed stays unreadable
+                time.sleep(interval)
+
+        thread = threading.Thread(target=poll, name="verify-me-replica", daemon=True)
+        thread.start()
+        return thread
+
+    def find_user(self, email_or_phone):
+        with self._lock:
+            self.refresh()
+            return self._by_identifier.get(email_or_phone)
+
+    def find_by_username(self, username):
+        with self._lock:
+            self.refresh()
+            identifier = self._by_username.get(username)
+            return self._by_identifier.get(identifier) if identifier is not None else None
+
+    def identifier_exists(self, email_or_phone):
+        return self.find_user(email_or_phone) is not None
+
+    def username_exists(self, username):
+        return self.find_by_username(username) is not None
+
+    # The uniqueness index's questions, answered exactly from the copy.
+    identifier_taken = identifier_exists
+    username_taken = username_exists
+
+    def live_records(self):
+        with self._lock:
+            self.refresh()
+            return list(self._by_identifier.values())
+
+    def user_count(self):
+        with self._lock:
+            self.refresh()
+            return len(self._by_identifier)
+
+    def _read_only(self, *args, **kwargs):
+        raise ReadOnlyReplica("This is a read-only replica; send changes to the primary.")
+
+    add_user = add_users = update_user = _read_only
+    digests = stored_code = stored_codes = change_codes = consume = remaining_count = _read_only
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve logins and sessions from a copy kept by the change feed.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--unix-socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=32, help="threads for hashing")
+    parser.add_argument("--max-lag", type=float, default=MAX_LAG, help="seconds a read may lag the primary")
+    args = parser.parse_args()
+
+    user_data_file = os.path.join("Database_txt", "database.txt")
+    replica = Replica(get_change_feed(user_data_file, always=True), get_user_store(user_data_file),
+                      get_session_store(), max_lag=args.max_lag)
+    replica.catch_up()
+    replica.follow()
+    server = HTTPServer(AuthAPI(replica=replica), workers=args.workers, routes=READ_ROUTES)
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"\033[1;32mVERIFY ME replica of {user_data_file} at event {replica.seq}, listening on {where}\033[0m")
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        print("Replica stopped.")
+
+
+if __name__ == "__main__":
+    main()
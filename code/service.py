@@ -0,0 +1,245 @@
+import argparse
+import asyncio
+import json
+import sys
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import metrics
+from auth_api import (ALREADY_EXISTS, BAD_CREDENTIALS, INVALID_INPUT, LOCKED_OUT, NOT_FOUND, SESSION_EXPIRED,
+                      AuthAPI, success)
+
+MAX_BODY_SIZE = 64 * 1024
+
+STATUS_TEXT = {
+    200: "OK",
+    201: "Created",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+# AuthResult.error -> HTTP status
+ERROR_STATUS = {
+    INVALID_INPUT: 400,
+    BAD_CREDENTIALS: 401,
+    NOT_FOUND: 404,
+    ALREADY_EXISTS: 409,
+    LOCKED_OUT: 429,
+    SESSION_EXPIRED: 401,
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def login(api, identifier, password, source=None):
+    result = api.login(identifier, password, source)
+    if result.ok:
+        user = result.data["user"]
+        result = success(identifier=user.identifier, username=user.username, token=result.data["token"])
+    return result
+
+
+def session(api, token, source=None):
+    result = api.session(token)
+    if result.ok:
+        user = result.data["user"]
+        result = success(identifier=user.identifier, username=user.username)
+    return result
+
+
+def logout(api, token, source=None):
+    return api.logout(token)
+
+
+def new_backup_codes(api, token, source=None):
+    return api.regenerate_backup_codes(token)
+
+
+def change_password(api, identifier, current_password, new_password, source=None):
+    return api.change_password(identifier, current_password, new_password, source)
+
+
+def register(api, identifier, username, password, source=None):
+    return api.register(identifier, username, password, source)
+
+
+def recover(api, identifier, backup_code, new_password, source=None):
+    return api.reset_with_backup_code(identifier, backup_code, new_password, source)
+
+
+# path -> (handler, required JSON fields, status on success)
+ROUTES = {
+    "/register": (register, ("identifier", "username", "password"), 201),
+    "/login": (login, ("identifier", "password"), 200),
+    "/recover": (recover, ("identifier", "backup_code", "new_password"), 200),
+    "/change-password": (change_password, ("identifier", "current_password", "new_password"), 200),
+    "/session": (session, ("token",), 200),
+    "/logout": (logout, ("token",), 200),
+    "/backup-codes": (new_backup_codes, ("token",), 200),
+}
+
+# What a follower (replica.py) serves: everything that only reads.
+READ_ROUTES = {path: ROUTES[path] for path in ("/login", "/session", "/logout")}
+
+
+class HTTPServer:
+    """Minimal HTTP/1.1 JSON front-end over AuthAPI on asyncio streams.
+
+    AuthAPI calls block on hashing and file I/O, so they run in a thread pool.
+    GET /metrics returns the Prometheus metrics when VERIFY_ME_METRICS is on.
+    """
+
+    def __init__(self, api, workers=32, routes=ROUTES):
+        self.api = api
+        self.routes = routes
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify-me")
+
+    async def _readline(self, reader, status, message):
+        try:
+            return await reader.readline()
+        except ValueError:  # longer than the stream's limit
+            raise BadRequest(status, message)
+
+    async def _read_request(self, reader):
+        request_line = await self._readline(reader, 400, "Request line too long.")
+        if not request_line:
+            return None
+        try:
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise BadRequest(400, "Malformed request line.")
+        headers = {}
+        while True:
+            line = await self._readline(reader, 431, "Request header too large.")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise BadRequest(400, "Invalid Content-Length.")
+        if length < 0:
+            raise BadRequest(400, "Invalid Content-Length.")
+        if length > MAX_BODY_SIZE:
+            raise BadRequest(413, "Request body too large.")
+        body = await reader.readexactly(length) if length else b""
+        return method, path, headers, body
+
+    async def _dispatch(self, method, path, body, source):
+        if path == "/metrics" and method == "GET":
+            if not metrics.ENABLED:
+                return 404, {"error": "Metrics are off; start the service with VERIFY_ME_METRICS=1."}
+            return 200, metrics.REGISTRY.render()
+        route = self.routes.get(path)
+        if route is None:
+            return 404, {"error": "Unknown endpoint."}
+        if method != "POST":
+            return 405, {"error": "Use POST."}
+        try:
+            payload = json.loads(body or b"{}")
+        except ValueError:
+            return 400, {"error": "Body must be JSON."}
+        handler, fields, ok_status = route
+        if not isinstance(payload, dict) or any(not isinstance(payload.get(f), str) for f in fields):
+            return 400, {"error": f"Expected string fields: {', '.join(fields)}."}
+
+        call = partial(metrics.profiled, path, handler, self.api, *(payload[f].strip() for f in fields), source=source)
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        except IOError as e:
+            return 500, {"error": f"Storage error: {e}"}
+        except Exception:
+            # A bug or corrupt data (e.g. an unreadable stored hash): the details go to the log only.
+            print(f"\033[1;31m[Error] {method} {path} failed:\033[0m", file=sys.stderr)
+            traceback.print_exc()
+            return 500, {"error": "Internal error."}
+        if result.ok:
+            return ok_status, result.data
+        body = {"error": result.message}
+        if result.retry_after:
+            body["retry_after"] = result.retry_after
+        return ERROR_STATUS.get(result.error, 400), body
+
+    def _response(self, status, body, keep_alive):
+        if isinstance(body, str):
+            data, content_type = body.encode(), "text/plain; version=0.0.4"
+        else:
+            data, content_type = json.dumps(body).encode(), "application/json"
+        headers = [
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(data)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        if isinstance(body, dict) and "retry_after" in body:
+            headers.append(f"Retry-After: {body['retry_after']}")
+        return ("\r\n".join(headers) + "\r\n\r\n").encode() + data
+
+    async def handle_connection(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        source = peer[0] if isinstance(peer, tuple) else "local"
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except BadRequest as e:
+                    writer.write(self._response(e.status, {"error": str(e)}, False))
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                status, payload = await self._dispatch(method, path, body, source)
+                known_path = path in self.routes or path == "/metrics"
+                metrics.count("verify_me_http_requests_total", path=path if known_path else "other", status=status)
+                writer.write(self._response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=None, port=None, unix_socket=None):
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle_connection, path=unix_socket, limit=MAX_BODY_SIZE)
+        else:
+            server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_BODY_SIZE,
+                                                backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve register/login/recover/change-password over HTTP/JSON.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix-socket", help="listen on a Unix socket instead of TCP")
+    parser.add_argument("--workers", type=int, default=32, help="threads for hashing and file I/O")
+    args = parser.parse_args()
+
+    server = HTTPServer(AuthAPI(), workers=args.workers)
+    where = args.unix_socket or f"http://{args.host}:{args.port}"
+    print(f"\033[1;32mVERIFY ME service listening on {where}\033[0m")
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        print("Service stopped.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import atexit
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from file_lock import atomic_write
+from user_store import UserRecord
+
+# VERIFY_ME_SESSION_TTL: seconds a session stays valid without being used (default 30 minutes).
+# VERIFY_ME_SESSION_FILE=path keeps sessions across restarts: they are saved there at exit, at most
+# every SAVE_INTERVAL seconds while they change, and at once when one is revoked, so a crash cannot
+# bring back a session that was logged out. Only hashes of the tokens are written.
+SESSION_TTL = float(os.environ.get("VERIFY_ME_SESSION_TTL", "1800") or 1800)
+SESSION_FILE = os.environ.get("VERIFY_ME_SESSION_FILE")
+SAVE_INTERVAL = 30
+
+
+def _key(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class _Session:
+    __slots__ = ("user", "expires_at")
+
+    def __init__(self, user, expires_at):
+        self.user = user
+        self.expires_at = expires_at
+
+
+class SessionStore:
+    """Random session tokens mapped to the logged-in UserRecord, so logged-in calls skip the user lookup.
+
+    Sessions expire ttl seconds after their last use and at most max_sessions are
+    kept, least recently used evicted first, so memory stays bounded. Revocation is
+    per process: another process changing a password makes this cache stale, which
+    AuthAPI.session() detects by comparing the cached record with the stored one.
+    """
+
+    def __init__(self, ttl=1800, max_sessions=100000, session_file=None, clock=time.time):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.session_file = session_file
+        self.clock = clock
+        self._sessions = OrderedDict()  # token hash -> _Session, least recently used first
+        self._by_identifier = {}  # identifier -> set of token hashes
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        self._dirty = False
+        self._next_save = 0.0
+        if session_file:
+            self._load()
+
+    def _forget(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            keys = self._by_identifier.get(session.user.identifier)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_identifier[session.user.identifier]
+            self._dirty = True
+
+    def _sweep(self, now):
+        """Drops expired sessions from the cold end, and the oldest ones if over capacity."""
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.expires_at <= now or len(self._sessions) >= self.max_sessions:
+                self._forget(key)
+            else:
+                break
+        self._next_sweep = now + 1.0
+
+    def _changed(self, now):
+        self._dirty = True
+        if self.session_file and now >= self._next_save:
+            self._save()
+
+    def create(self, user):
+        """Starts a session for user and returns its token."""
+        token = secrets.token_urlsafe(32)
+        key = _key(token)
+        with self._lock:
+            now = self.clock()
+            if now >= self._next_sweep or len(self._sessions) >= self.max_sessions:
+                self._sweep(now)
+            self._sessions[key] = _Session(user, now + self.ttl)
+            self._by_identifier.setdefault(user.identifier, set()).add(key)
+            self._changed(now)
+        return token
+
+    def get(self, token):
+        """Returns the UserRecord of a live session and extends it, or None."""
+        key = _key(token)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return None
+            now = self.clock()
+            if session.expires_at <= now:
+                self._forget(key)
+                return None
+            session.expires_at = now + self.ttl
+            self._sessions.move_to_end(key)
+            return session.user
+
+    def update_user(self, user):
+        """Replaces the cached record in every session of user.identifier, e.g. after a rehash."""
+        with self._lock:
+            for key in self._by_identifier.get(user.identifier, ()):
+                self._sessions[key].user = user
+            self._dirty = True
+
+    def _revoked(self):
+        """Saves right away: unlike a new session, a revoked one must not survive a crash."""
+        if self.session_file:
+            self._save()
+
+    def revoke(self, token):
+        """Ends one session (logout)."""
+        key = _key(token)
+        with self._lock:
+            if key in self._sessions:
+                self._forget(key)
+                self._revoked()
+
+    def revoke_user(self, identifier, keep_token=None):
+        """Ends every session of identifier except keep_token's. Returns how many were ended."""
+        keep = _key(keep_token) if keep_token else None
+        with self._lock:
+            keys = [key for key in self._by_identifier.get(identifier, ()) if key != keep]
+            for key in keys:
+                self._forget(key)
+            if keys:
+                self._revoked()
+            return len(keys)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _load(self):
+        try:
+            with open(self.session_file, "r") as file:
+                saved = json.load(file)["sessions"]
+        except (OSError, ValueError, KeyError):
+            return
+        now = self.clock()
+        for key, fields, expires_at in saved[-self.max_sessions:]:
+            if expires_at > now:
+                user = UserRecord(*fields)
+                self._sessions[key] = _Session(user, expires_at)
+                self._by_identifier.setdefault(user.identifier, set()).add(key)
+
+    def _save(self):
+        """Writes the live sessions to session_file; the caller holds the lock."""
+        now = self.clock()
+        sessions = [[key, list(session.user), session.expires_at]
+                    for key, session in self._sessions.items() if session.expires_at > now]
+        with atomic_write(self.session_file, new_file_mode=0o600) as file:
+            json.dump({"sessions": sessions}, file)
+        self._dirty = False
+        self._next_save = now + SAVE_INTERVAL
+
+    def save(self):
+        """Writes the sessions to session_file now, if it is set and they changed."""
+        with self._lock:
+            if self.session_file and self._dirty:
+                self._save()
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def get_session_store():
+    """Returns the process-wide SessionStore shared by the account classes."""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = SessionStore(ttl=SESSION_TTL, session_file=SESSION_FILE)
+            if SESSION_FILE:
+                atexit.register(_default_store.save)
+        return _default_store
@@ -0,0 +1,409 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+from backup_code_store import BackupCodeStore
+from file_lock import FileLock, atomic_write, fsync_directory
+from metrics import instrumented
+from record_log import RecordLog
+from snapshot import snapshot_file_for
+from user_store import UserStore
+
+# A sharded data file is described by "<data file>.shards", a JSON list of shards. Shard
+# (bits, value) holds the identifiers whose shard_hash ends in the bits low bits value and
+# lives in "<name>.<bits>-<value><ext>" (database.3-5.txt); splitting it makes (bits + 1, value)
+# and (bits + 1, value | 1 << bits). Without the file, (0, 0) is the unsharded data file itself.
+
+
+def shard_hash(identifier):
+    """Stable across processes and runs, unlike hash()."""
+    return int.from_bytes(hashlib.blake2b(identifier.encode(), digest_size=8).digest(), "little")
+
+
+def shard_file(data_file, bits, value):
+    if bits == 0:
+        return data_file
+    root, ext = os.path.splitext(data_file)
+    return f"{root}.{bits}-{value}{ext}"
+
+
+def is_sharded(data_file):
+    return os.path.exists(data_file + ".shards")
+
+
+def _latest_records(log):
+    """Reads a whole shard: the latest record of every live key."""
+    latest = {}
+    for key, fields in log.read(from_start=True):
+        if fields is None:
+            latest.pop(key, None)
+        else:
+            latest[key] = fields
+    return latest.values()
+
+
+def _remove(log):
+    """Deletes a retired shard with its lock and snapshot files; nobody reaches it once the manifest moved on."""
+    for path in (log.path, log.file_lock.lock_file, snapshot_file_for(log.path)):
+        if os.path.exists(path):
+            os.remove(path)
+    fsync_directory(os.path.dirname(log.path))
+
+
+class ShardMap:
+    """The shards of one data file, re-read whenever another process replaces the manifest."""
+
+    def __init__(self, data_file):
+        self.data_file = data_file
+        self.manifest_file = data_file + ".shards"
+        # Every operation holds this shared; a split holds it exclusive, so nobody works on a shard
+        # while it is being replaced by its two halves.
+        self.file_lock = FileLock(self.manifest_file, timeout=60.0)
+        self.shards = {(0, 0)}
+        self.depth = 0
+        self._identity = None
+
+    def refresh(self):
+        """Re-reads the manifest if it changed. Returns True if it did."""
+        try:
+            stat = os.stat(self.manifest_file)
+            identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        except FileNotFoundError:
+            identity = None
+        if identity == self._identity:
+            return False
+        shards = {(0, 0)}
+        if identity is not None:
+            with open(self.manifest_file, "r") as file:
+                shards = {tuple(shard) for shard in json.load(file)["shards"]}
+        self.shards = shards
+        self.depth = max(bits for bits, _ in shards)
+        self._identity = identity
+        return True
+
+    def save(self, shards):
+        with atomic_write(self.manifest_file) as file:
+            json.dump({"shards": sorted(shards)}, file)
+        self.refresh()
+
+    def shard_of(self, identifier):
+        hashed = shard_hash(identifier)
+        for bits in range(self.depth + 1):
+            shard = (bits, hashed & ((1 << bits) - 1))
+            if shard in self.shards:
+                return shard
+        raise IOError(f"{self.manifest_file} has no shard for {identifier}.")
+
+    def path(self, shard):
+        return shard_file(self.data_file, *shard)
+
+
+class _ShardedStore:
+    """Routes each identifier to the store of its shard and splits shards that grow past split_size."""
+
+    key_fields = 1
+    min_fields = 1
+
+    def __init__(self, data_file, append_only=False, split_size=None):
+        self.data_file = data_file
+        self.append_only = append_only
+        self.split_size = split_size
+        self.map = ShardMap(data_file)
+        self._lock = threading.RLock()
+        self._stores = {}
+
+    def _new_store(self, path):
+        raise NotImplementedError
+
+    @contextmanager
+    def _shared(self):
+        with self.map.file_lock.shared():
+            self._refresh_map()
+            yield
+
+    @contextmanager
+    def _exclusive(self):
+        with self.map.file_lock.exclusive():
+            self._refresh_map()
+            yield
+
+    def _refresh_map(self):
+        with self._lock:
+            if self.map.refresh():
+                self._stores = {shard: store for shard, store in self._stores.items() if shard in self.map.shards}
+
+    def _store(self, shard):
+        with self._lock:
+            store = self._stores.get(shard)
+            if store is None:
+                store = self._stores[shard] = self._new_store(self.map.path(shard))
+            return store
+
+    def _store_for(self, identifier):
+        return self._store(self.map.shard_of(identifier))
+
+    def _all_stores(self):
+        return [self._store(shard) for shard in sorted(self.map.shards)]
+
+    def refresh(self):
+        with self._shared():
+            for store in self._all_stores():
+                store.refresh()
+
+    def sync(self):
+        with self._shared():
+            for store in self._all_stores():
+                store.sync()
+
+    def shard_sizes(self):
+        """Returns {shard file: users in it}."""
+        with self._shared():
+            return {self.map.path(shard): self._store(shard).user_count() for shard in sorted(self.map.shards)}
+
+    @instrumented("shard_split")
+    def _split(self, shard):
+        """Replaces shard by its two halves. Needs the exclusive manifest lock."""
+        bits, value = shard
+        children = [(bits + 1, value), (bits + 1, value | 1 << bits)]
+        log = RecordLog(self.map.path(shard), self.key_fields, self.min_fields)
+        # The shard's own lock also waits out a background compaction about to swap the file.
+        with log.file_lock.exclusive():
+            records = _latest_records(log)
+            with atomic_write(self.map.path(children[0])) as low, atomic_write(self.map.path(children[1])) as high:
+                for fields in records:
+                    (high if shard_hash(fields[0]) >> bits & 1 else low).write(log.format_record(fields))
+            self.map.save((self.map.shards - {shard}) | set(children))
+            _remove(log)
+        self._refresh_map()
+
+    def rebalance(self, split_size=None, min_shards=1):
+        """Splits shards until none holds more than split_size users and there are at least
+        min_shards of them. Safe while other processes use the files. Returns the splits made."""
+        split_size = split_size or self.split_size
+        splits = 0
+        with self._exclusive():
+            while True:
+                sizes = {shard: self._store(shard).user_count() for shard in self.map.shards}
+                largest = max(sizes, key=sizes.get)
+                if len(sizes) >= min_shards and not (split_size and sizes[largest] > split_size):
+                    return splits
+                self._split(largest)
+                splits += 1
+
+    def _maybe_split(self, shards):
+        """Splits the given shards if they grew past split_size."""
+        if not self.split_size:
+            return
+        def too_big(shard):
+            return shard in self.map.shards and self._store(shard).user_count() > self.split_size
+
+        with self._shared():
+            pending = [shard for shard in shards if too_big(shard)]
+        if not pending:
+            return
+        with self._exclusive():
+            while pending:
+                shard = pending.pop()
+                if too_big(shard):
+                    self._split(shard)
+                    bits, value = shard
+                    pending += [(bits + 1, value), (bits + 1, value | 1 << bits)]
+
+    def join(self):
+        """Merges every shard back into the unsharded data file and removes the manifest."""
+        with self._exclusive():
+            shards = sorted(self.map.shards)
+            if shards == [(0, 0)]:
+                return
+            logs = [RecordLog(self.map.path(shard), self.key_fields, self.min_fields) for shard in shards]
+            with atomic_write(self.data_file) as output:
+                for log in logs:
+                    with log.file_lock.exclusive():
+                        output.writelines(log.format_record(fields) for fields in _latest_records(log))
+            os.remove(self.map.manifest_file)
+            for log in logs:
+                _remove(log)
+            self._refresh_map()
+
+
+class ShardedUserStore(_ShardedStore):
+    """UserStore interface over the shards of database.txt.
+
+    Lookups, logins and password changes touch only the user's shard. Usernames are
+    unique across shards, so registrations are serialized by one more lock file and
+    a username lookup asks every shard.
+    """
+
+    key_fields = 1
+    min_fields = 4
+
+    def __init__(self, user_data_file, append_only=False, split_size=None):
+        super().__init__(user_data_file, append_only, split_size)
+        self.user_data_file = user_data_file
+        self.registration_lock = FileLock(user_data_file + ".register")
+
+    def _new_store(self, path):
+        return UserStore(path, append_only=self.append_only)
+
+    def find_user(self, email_or_phone):
+        with self._shared():
+            return self._store_for(email_or_phone).find_user(email_or_phone)
+
+    def find_users(self, identifiers):
+        """Returns {identifier: UserRecord} for those of identifiers that exist, one call per shard."""
+        with self._shared():
+            by_shard = {}
+            for identifier in identifiers:
+                by_shard.setdefault(self.map.shard_of(identifier), []).append(identifier)
+            found = {}
+            for shard, shard_identifiers in by_shard.items():
+                found.update(self._store(shard).find_users(shard_identifiers))
+            return found
+
+    def find_by_username(self, username):
+        with self._shared():
+            for store in self._all_stores():
+                record = store.find_by_username(username)
+                if record is not None:
+                    return record
+            return None
+
+    def identifier_exists(self, email_or_phone):
+        return self.find_user(email_or_phone) is not None
+
+    def username_exists(self, username):
+        return self.find_by_username(username) is not None
+
+    def live_records(self):
+        with self._shared():
+            return [record for store in self._all_stores() for record in store.live_records()]
+
+    def add_user(self, record):
+        return not self.add_users([record])
+
+    def add_users(self, records):
+        """Appends the users not taken yet, one write per shard. Returns the records refused as duplicates."""
+        refused = []
+        with self._shared(), self.registration_lock.exclusive():
+            by_shard = {}
+            usernames = set()
+            for record in records:
+                if record.username in usernames or self.username_exists(record.username):
+                    refused.append(record)
+                    continue
+                usernames.add(record.username)
+                by_shard.setdefault(self.map.shard_of(record.identifier), []).append(record)
+            for shard, shard_records in by_shard.items():
+                refused += self._store(shard).add_users(shard_records)
+        self._maybe_split(by_shard)
+        return refused
+
+    def update_user(self, record, expected=None):
+        with self._shared():
+            return self._store_for(record.identifier).update_user(record, expected=expected)
+
+
+class ShardedBackupCodeStore(_ShardedStore):
+    """BackupCodeStore interface over the shards of backup_codes.txt; every call touches one shard."""
+
+    key_fields = 2
+    min_fields = 2
+
+    def __init__(self, backup_code_file, append_only=False, split_size=None):
+        super().__init__(backup_code_file, append_only, split_size)
+        self.backup_code_file = backup_code_file
+
+    def _new_store(self, path):
+        return BackupCodeStore(path, append_only=self.append_only)
+
+    def add_codes(self, email_or_phone, codes):
+        self.add_codes_bulk({email_or_phone: codes})
+
+    def add_codes_bulk(self, codes_by_identifier):
+        with self._shared():
+            by_shard = {}
+            for identifier, codes in codes_by_identifier.items():
+                by_shard.setdefault(self.map.shard_of(identifier), {})[identifier] = codes
+            for shard, shard_codes in by_shard.items():
+                self._store(shard).add_codes_bulk(shard_codes)
+        self._maybe_split(by_shard)
+
+    def is_valid(self, email_or_phone, code):
+        with self._shared():
+            return self._store_for(email_or_phone).is_valid(email_or_phone, code)
+
+    def consume(self, email_or_phone, code):
+        with self._shared():
+            return self._store_for(email_or_phone).consume(email_or_phone, code)
+
+    def remaining_count(self, email_or_phone):
+        with self._shared():
+            return self._store_for(email_or_phone).remaining_count(email_or_phone)
+
+    def replace_codes(self, email_or_phone, codes, old_codes=None):
+        with self._shared():
+            self._store_for(email_or_phone).replace_codes(email_or_phone, codes, old_codes)
+
+    def digests(self, email_or_phone, codes):
+        with self._shared():
+            return self._store_for(email_or_phone).digests(email_or_phone, codes)
+
+    def stored_code(self, email_or_phone, code):
+        with self._shared():
+            return self._store_for(email_or_phone).stored_code(email_or_phone, code)
+
+    def stored_codes(self, email_or_phone):
+        with self._shared():
+            return self._store_for(email_or_phone).stored_codes(email_or_phone)
+
+    def change_codes(self, email_or_phone, add=(), drop=()):
+        with self._shared():
+            self._store_for(email_or_phone).change_codes(email_or_phone, add, drop)
+
+    def compact(self):
+        with self._shared():
+            for store in self._all_stores():
+                store.compact()
+
+    def plaintext_codes(self):
+        with self._shared():
+            plaintext = {}
+            for store in self._all_stores():
+                plaintext.update(store.plaintext_codes())
+            return plaintext
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shard database.txt and backup_codes.txt by identifier hash.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="list the shards and how many users each holds")
+    split_parser = commands.add_parser("split", help="split shards; safe while the program is running")
+    split_parser.add_argument("--shards", type=int, default=1, help="split until there are at least this many")
+    split_parser.add_argument("--max-users", type=int, help="split every shard holding more users than this")
+    commands.add_parser("join", help="merge the shards back into single files")
+    args = parser.parse_args()
+
+    stores = [ShardedUserStore(os.path.join("Database_txt", "database.txt")),
+              ShardedBackupCodeStore(os.path.join("Database_txt", "backup_codes.txt"))]
+    if args.command == "split":
+        if args.shards < 1 or args.max_users is not None and args.max_users < 1:
+            parser.error("--shards and --max-users must be positive")
+        for store in stores:
+            splits = store.rebalance(args.max_users, args.shards)
+            print(f"\033[1;32m[Success] {store.data_file}: {splits} shards split.\033[0m")
+    elif args.command == "join":
+        for store in stores:
+            store.join()
+            print(f"\033[1;32m[Success] {store.data_file} is a single file again.\033[0m")
+    for store in stores:
+        sizes = store.shard_sizes()
+        print(f"\033[1;34m{store.data_file}: {len(sizes)} shard(s), {sum(sizes.values())} users\033[0m")
+        for path, size in sizes.items():
+            print(f"  {path:<40}{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
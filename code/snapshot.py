@@ -0,0 +1,252 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from array import array
+from contextlib import ExitStack
+
+from file_lock import FileLock, atomic_write
+from metrics import instrumented
+
+# <data file>.snapshot: the live records of a text data file as of some read position, with
+# hash tables over chosen columns, so a starting process maps it and reads only the lines
+# appended since instead of parsing the whole file. Layout after the magic and the u64 offset
+# of the header: the records as "field,field,...\n" lines, one open-addressing table of u64
+# record offsets + 1 (0 = empty) per indexed column, then the JSON header, with a checksum of
+# the records and tables and the source file's identity, read position, size, mtime and a
+# checksum of the bytes just before that position.
+SNAPSHOT_MAGIC = b"VMSNAP01"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = ".snapshot"
+SOURCE_CHECK_BYTES = 4096
+HEADER_OFFSET = struct.Struct("<Q")
+RECORDS_START = len(SNAPSHOT_MAGIC) + HEADER_OFFSET.size
+TABLE_ENTRY = struct.Struct("<Q")
+CHUNK_SIZE = 1 << 20
+
+# Files with fewer live records than this are simply parsed; VERIFY_ME_SNAPSHOT_MIN_RECORDS=0
+# turns snapshots off.
+MIN_RECORDS = int(os.environ.get("VERIFY_ME_SNAPSHOT_MIN_RECORDS", "50000") or 0)
+
+
+def _hash(value):
+    return zlib.crc32(value)
+
+
+def _capacity_for(count):
+    capacity = 1024
+    while capacity < count * 2:
+        capacity *= 2
+    return capacity
+
+
+def _checksum(data, start, end):
+    checksum = 0
+    for offset in range(start, end, 16 * CHUNK_SIZE):
+        checksum = zlib.crc32(data[offset:min(offset + 16 * CHUNK_SIZE, end)], checksum)
+    return checksum
+
+
+def _source_check(file, position):
+    """Checksum of the bytes just before position, which a file rewritten since would not match."""
+    start = max(position - SOURCE_CHECK_BYTES, 0)
+    file.seek(start)
+    data = file.read(position - start)
+    return zlib.crc32(data) if len(data) == position - start else None
+
+
+class IndexSnapshot:
+    """A mapped snapshot file: find() probes a column's table, records() walks every record."""
+
+    def __init__(self, path, data, header):
+        self.path = path
+        self._map = data
+        self.header = header
+        self.count = header["count"]
+        self.cursor = header["cursor"]
+        self.extra = header["extra"]
+        self._records_start = RECORDS_START
+        self._records_end = RECORDS_START + header["records_size"]
+        self._mask = header["capacity"] - 1
+        self._tables = {column: self._records_end + i * header["capacity"] * TABLE_ENTRY.size
+                        for i, column in enumerate(header["columns"])}
+
+    def _line(self, offset):
+        start = self._records_start + offset
+        return self._map[start:self._map.find(b"\n", start)].decode().split(",")
+
+    def find(self, column, key):
+        """Returns the fields of the record whose column equals key, or None."""
+        table = self._tables[column]
+        slot = _hash(key.encode()) & self._mask
+        while True:
+            (entry,) = TABLE_ENTRY.unpack_from(self._map, table + slot * TABLE_ENTRY.size)
+            if entry == 0:
+                return None
+            fields = self._line(entry - 1)
+            if fields[column] == key:
+                return fields
+            slot = (slot + 1) & self._mask
+
+    def records(self):
+        """Yields the fields of every record in the snapshot."""
+        start = self._records_start
+        while start < self._records_end:
+            end = self._map.rfind(b"\n", start, min(start + CHUNK_SIZE, self._records_end)) + 1
+            if end <= start:  # a record longer than a chunk
+                end = self._map.find(b"\n", start, self._records_end) + 1
+            for line in self._map[start:end].decode().splitlines():
+                yield line.split(",")
+            start = end
+
+
+def snapshot_file_for(data_file):
+    return data_file + SNAPSHOT_SUFFIX
+
+
+def load(path, source_path, columns):
+    """Maps the snapshot at path if it is intact and still describes source_path, else returns None.
+
+    The caller holds the source's shared file lock, so the source cannot be replaced meanwhile;
+    it then restores the snapshot's cursor and reads the records appended after it.
+    """
+    try:
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            return None
+        (header_offset,) = HEADER_OFFSET.unpack_from(data, len(SNAPSHOT_MAGIC))
+        header = json.loads(data[header_offset:])
+        if header["version"] != SNAPSHOT_VERSION or header["columns"] != list(columns):
+            return None
+        if _checksum(data, RECORDS_START, header_offset) != header["checksum"]:
+            return None
+
+        with open(source_path, "rb") as source:
+            stat = os.fstat(source.fileno())
+            cursor = header["cursor"]
+            if [stat.st_dev, stat.st_ino] != cursor["identity"] or stat.st_size < cursor["position"]:
+                return None
+            # Unchanged since the snapshot was written, or only appended to: the bytes before the
+            # snapshot's position must still be the ones it was made from.
+            unchanged = stat.st_size == header["source_size"] and stat.st_mtime_ns == header["source_mtime_ns"]
+            if not unchanged and _source_check(source, cursor["position"]) != header["source_check"]:
+                return None
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        data.close()
+        return None
+    return IndexSnapshot(path, data, header)
+
+
+class _SourceReplaced(Exception):
+    pass
+
+
+@instrumented("snapshot_write")
+def write(path, source_path, cursor, records, columns, extra=None):
+    """Writes a snapshot of records (field lists, one per live record) read from source_path up
+    to cursor. Returns False if source_path was replaced since, so the cursor no longer applies.
+
+    The source stays open until the snapshot is in place, so a rewrite cannot hand its inode to
+    a new file meanwhile, and the snapshot is renamed in under the source's shared lock only if
+    the source is still that file. RecordLog.rewrite() and compact() delete the snapshot under
+    the exclusive lock, so no snapshot of a replaced file survives them.
+    """
+    with open(source_path, "rb") as source, ExitStack() as locked:
+        stat = os.fstat(source.fileno())
+        if [stat.st_dev, stat.st_ino] != list(cursor["identity"] or ()):
+            return False
+        source_check = _source_check(source, cursor["position"])
+        try:
+            with atomic_write(path, "wb") as file:
+                file.write(SNAPSHOT_MAGIC + HEADER_OFFSET.pack(0))
+                checksum = 0
+                offsets = array("Q")
+                hashes = [array("L") for _ in columns]
+                size = 0
+                for fields in records:
+                    line = (",".join(fields) + "\n").encode()
+                    file.write(line)
+                    checksum = zlib.crc32(line, checksum)
+                    offsets.append(size + 1)
+                    for column, column_hashes in zip(columns, hashes):
+                        column_hashes.append(_hash(fields[column].encode()))
+                    size += len(line)
+
+                capacity = _capacity_for(len(offsets))
+                mask = capacity - 1
+                for column_hashes in hashes:
+                    table = array("Q", bytes(capacity * TABLE_ENTRY.size))
+                    for value, offset in zip(column_hashes, offsets):
+                        slot = value & mask
+                        while table[slot]:
+                            slot = (slot + 1) & mask
+                        table[slot] = offset
+                    data = table.tobytes()
+                    file.write(data)
+                    checksum = zlib.crc32(data, checksum)
+
+                header_offset = file.tell()
+                file.write(json.dumps({
+                    "version": SNAPSHOT_VERSION,
+                    "columns": list(columns),
+                    "count": len(offsets),
+                    "capacity": capacity,
+                    "records_size": size,
+                    "checksum": checksum,
+                    "cursor": cursor,
+                    "source_size": stat.st_size,
+                    "source_mtime_ns": stat.st_mtime_ns,
+                    "source_check": source_check,
+                    "extra": extra or {},
+                }).encode())
+                file.seek(len(SNAPSHOT_MAGIC))
+                file.write(HEADER_OFFSET.pack(header_offset))
+
+                locked.enter_context(FileLock(source_path).shared())  # released after the rename
+                current = os.stat(source_path)
+                if (current.st_dev, current.st_ino) != (stat.st_dev, stat.st_ino):
+                    raise _SourceReplaced()  # atomic_write removes the temp file
+        except _SourceReplaced:
+            return False
+    return True
+
+
+class SnapshotWriter:
+    """Writes a store's snapshot on a background thread, one at a time.
+
+    The thread is not a daemon, so a short-lived process finishes the snapshot before it exits.
+    """
+
+    def __init__(self, path, source_path, columns):
+        self.path = path
+        self.source_path = source_path
+        self.columns = columns
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, cursor, records, extra=None):
+        """records is iterated on the background thread, so it must not change meanwhile."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(target=self._write, args=(cursor, records, extra))
+            self._thread.start()
+            return True
+
+    def _write(self, cursor, records, extra):
+        try:
+            write(self.path, self.source_path, cursor, records, self.columns, extra)
+        except OSError:
+            pass  # only a missed speed-up; the next process parses the file and tries again
+
+    def join(self):
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            thread.join()
@@ -0,0 +1,321 @@
+import os
+import queue
+import sqlite3
+import sys
+import threading
+from contextlib import contextmanager
+
+from backup_codes import code_digest, get_key, is_digest, key_file_for
+from metrics import instrumented
+from record_log import RecordLog
+from user_store import UserRecord
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    identifier TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    salt_hex TEXT NOT NULL,
+    hashed_password TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username);
+CREATE TABLE IF NOT EXISTS backup_codes (
+    identifier TEXT NOT NULL,
+    code TEXT NOT NULL,
+    PRIMARY KEY (identifier, code)
+) WITHOUT ROWID;
+"""
+
+
+class ConnectionPool:
+    """A small pool of SQLite connections to one database file in WAL mode."""
+
+    def __init__(self, database_file, size=4, timeout=10.0):
+        self.database_file = database_file
+        self.timeout = timeout
+        self._connections = queue.LifoQueue()
+        for _ in range(size):
+            self._connections.put(self._connect())
+        with self.connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database_file, timeout=self.timeout,
+                               check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """Lends out a connection; SQLite errors surface as IOError like the text stores'."""
+        try:
+            conn = self._connections.get(timeout=self.timeout)
+        except queue.Empty:
+            raise IOError("database connection pool exhausted") from None
+        try:
+            yield conn
+        except sqlite3.Error as e:
+            raise IOError(f"SQLite error: {e}") from e
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._connections.put(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Lends out a connection inside BEGIN IMMEDIATE ... COMMIT."""
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+
+    def sync(self):
+        """Copies the WAL into the database file, fsyncing both (commits run with synchronous=NORMAL)."""
+        with self.connection() as conn:
+            conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self):
+        while not self._connections.empty():
+            self._connections.get_nowait().close()
+
+
+class SQLiteUserStore:
+    """UserStore interface over the users table."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def refresh(self):
+        pass  # every query reads the current table
+
+    @instrumented("find_user")
+    def find_user(self, email_or_phone):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT identifier, username, salt_hex, hashed_password FROM users WHERE identifier = ?",
+                (email_or_phone,),
+            ).fetchone()
+        return UserRecord(*row) if row else None
+
+    def find_users(self, identifiers, batch_size=500):
+        """Returns {identifier: UserRecord} for those of identifiers that exist, batch_size per query."""
+        identifiers = list(identifiers)
+        found = {}
+        with self.pool.connection() as conn:
+            for start in range(0, len(identifiers), batch_size):
+                batch = identifiers[start:start + batch_size]
+                rows = conn.execute(
+                    "SELECT identifier, username, salt_hex, hashed_password FROM users WHERE identifier IN "
+                    f"({','.join('?' * len(batch))})", batch,
+                ).fetchall()
+                found.update((row[0], UserRecord(*row)) for row in rows)
+        return found
+
+    def find_by_username(self, username):
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT identifier, username, salt_hex, hashed_password FROM users WHERE username = ?",
+                (username,),
+            ).fetchone()
+        return UserRecord(*row) if row else None
+
+    def identifier_exists(self, email_or_phone):
+        return self.find_user(email_or_phone) is not None
+
+    def username_exists(self, username):
+        return self.find_by_username(username) is not None
+
+    def live_records(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT identifier, username, salt_hex, hashed_password FROM users").fetchall()
+        return [UserRecord(*row) for row in rows]
+
+    def add_user(self, record):
+        return not self.add_users([record])
+
+    @instrumented("add_users")
+    def add_users(self, records):
+        """Inserts many users in one transaction. Returns the records refused as duplicates."""
+        refused = []
+        with self.pool.transaction() as conn:
+            for record in records:
+                taken = conn.execute("SELECT 1 FROM users WHERE identifier = ? OR username = ?",
+                                     (record.identifier, record.username)).fetchone()
+                if taken:
+                    refused.append(record)
+                else:
+                    conn.execute("INSERT INTO users VALUES (?, ?, ?, ?)", tuple(record))
+        return refused
+
+    @instrumented("update_user")
+    def update_user(self, record, expected=None):
+        query = "UPDATE users SET username = ?, salt_hex = ?, hashed_password = ? WHERE identifier = ?"
+        params = (record.username, record.salt_hex, record.hashed_password, record.identifier)
+        if expected is not None:
+            query += " AND username = ? AND salt_hex = ? AND hashed_password = ?"
+            params += (expected.username, expected.salt_hex, expected.hashed_password)
+        with self.pool.connection() as conn:
+            cursor = conn.execute(query, params)
+        return cursor.rowcount == 1
+
+    def sync(self):
+        self.pool.sync()
+
+
+class SQLiteBackupCodeStore:
+    """BackupCodeStore interface over the backup_codes table; codes are stored as keyed digests."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.key = get_key(key_file_for(pool.database_file))
+
+    def refresh(self):
+        pass
+
+    def add_codes(self, email_or_phone, codes):
+        self.add_codes_bulk({email_or_phone: codes})
+
+    def digests(self, email_or_phone, codes):
+        return [code_digest(self.key, email_or_phone, code) for code in codes]
+
+    @instrumented("add_backup_codes")
+    def add_codes_bulk(self, codes_by_identifier):
+        with self.pool.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)",
+                             [(identifier, digest) for identifier, codes in codes_by_identifier.items()
+                              for digest in self.digests(identifier, codes)])
+
+    def _candidates(self, email_or_phone, code):
+        # The digest, or the code itself when it was imported before codes were hashed.
+        digest = code_digest(self.key, email_or_phone, code)
+        return (email_or_phone, digest, code if not is_digest(code) else digest)
+
+    def is_valid(self, email_or_phone, code):
+        return self.stored_code(email_or_phone, code) is not None
+
+    def stored_code(self, email_or_phone, code):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT code FROM backup_codes WHERE identifier = ? AND code IN (?, ?)",
+                               self._candidates(email_or_phone, code)).fetchone()
+        return row[0] if row else None
+
+    def stored_codes(self, email_or_phone):
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT code FROM backup_codes WHERE identifier = ?", (email_or_phone,)).fetchall()
+        return {row[0] for row in rows}
+
+    @instrumented("consume_backup_code")
+    def consume(self, email_or_phone, code):
+        with self.pool.connection() as conn:
+            cursor = conn.execute("DELETE FROM backup_codes WHERE identifier = ? AND code IN (?, ?)",
+                                  self._candidates(email_or_phone, code))
+        return cursor.rowcount >= 1
+
+    @instrumented("replace_backup_codes")
+    def replace_codes(self, email_or_phone, codes, old_codes=None):
+        with self.pool.transaction() as conn:
+            if old_codes is None:
+                conn.execute("DELETE FROM backup_codes WHERE identifier = ?", (email_or_phone,))
+            else:
+                conn.executemany("DELETE FROM backup_codes WHERE identifier = ? AND code = ?",
+                                 [(email_or_phone, code) for code in old_codes])
+            conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)",
+                             [(email_or_phone, code_digest(self.key, email_or_phone, code)) for code in codes])
+
+    @instrumented("replace_backup_codes")
+    def change_codes(self, email_or_phone, add=(), drop=()):
+        with self.pool.transaction() as conn:
+            conn.executemany("DELETE FROM backup_codes WHERE identifier = ? AND code = ?",
+                             [(email_or_phone, code) for code in drop])
+            conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)",
+                             [(email_or_phone, code) for code in add])
+
+    def sync(self):
+        self.pool.sync()
+
+    def compact(self):
+        with self.pool.connection() as conn:
+            conn.execute("VACUUM")
+
+    def plaintext_codes(self):
+        plaintext = {}
+        with self.pool.connection() as conn:
+            for identifier, code in conn.execute("SELECT identifier, code FROM backup_codes WHERE length(code) != 64"):
+                plaintext.setdefault(identifier, []).append(code)
+        return plaintext
+
+    def remaining_count(self, email_or_phone):
+        with self.pool.connection() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM backup_codes WHERE identifier = ?",
+                                    (email_or_phone,)).fetchone()
+        return count
+
+
+def import_text_files(pool, user_data_file, backup_code_file, batch_size=10000):
+    """Bulk-loads database.txt and backup_codes.txt into the tables in one transaction.
+
+    Returns (users, codes) as stored after the import.
+    """
+    users = RecordLog(user_data_file, key_fields=1, min_fields=4)
+    codes = RecordLog(backup_code_file, key_fields=2, min_fields=2)
+
+    with pool.transaction() as conn:
+        batch = []
+        for key, fields in users.read():
+            if fields is None:
+                conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", batch)
+                batch = []
+                conn.execute("DELETE FROM users WHERE identifier = ?", key)
+                continue
+            batch.append(tuple(fields[:4]))
+            if len(batch) >= batch_size:
+                conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)", batch)
+
+        batch = []
+        for key, fields in codes.read():
+            if fields is None:
+                conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)", batch)
+                batch = []
+                conn.execute("DELETE FROM backup_codes WHERE identifier = ? AND code = ?", key)
+                continue
+            batch.append(key)
+            if len(batch) >= batch_size:
+                conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)", batch)
+                batch = []
+        conn.executemany("INSERT OR IGNORE INTO backup_codes VALUES (?, ?)", batch)
+
+    with pool.connection() as conn:
+        (user_count,) = conn.execute("SELECT COUNT(*) FROM users").fetchone()
+        (code_count,) = conn.execute("SELECT COUNT(*) FROM backup_codes").fetchone()
+    return user_count, code_count
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(database_file):
+    """Returns the connection pool shared by every store on the same database file."""
+    key = os.path.abspath(database_file)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(database_file)
+        return pool
+
+
+if __name__ == "__main__":
+    # python code/sqlite_store.py import  -- run from the project folder
+    if sys.argv[1:] != ["import"]:
+        print("Usage: python code/sqlite_store.py import")
+        sys.exit(1)
+    from storage import SQLITE_DATABASE_FILE
+    database_file = os.path.join("Database_txt", SQLITE_DATABASE_FILE)
+    user_count, code_count = import_text_files(
+        get_pool(database_file),
+        os.path.join("Database_txt", "database.txt"),
+        os.path.join("Database_txt", "backup_codes.txt"),
+    )
+    print(f"Imported into {database_file}: {user_count} users, {code_count} backup codes.")
@@ -0,0 +1,86 @@
+import os
+import threading
+
+from binary_store import BinaryUserStore
+from sharding import ShardedBackupCodeStore, ShardedUserStore
+from sqlite_store import SQLiteBackupCodeStore, SQLiteUserStore, get_pool
+from uniqueness import BinaryUserSource, ShardedUserSource, SQLiteUserSource, UniquenessIndex
+
+# Set VERIFY_ME_STORAGE=sqlite to keep users and backup codes in Database_txt/verify_me.db
+# instead of the text files (import them once with: python code/sqlite_store.py import).
+# Set VERIFY_ME_STORAGE=binary to keep users in the fixed-width Database_txt/database.bin
+# (convert once with: python code/binary_store.py to-binary); backup codes stay in text.
+STORAGE = os.environ.get("VERIFY_ME_STORAGE", "text")
+SQLITE_DATABASE_FILE = "verify_me.db"
+
+# Set VERIFY_ME_APPEND_ONLY=1 to write updates as new records instead of rewriting the data files.
+APPEND_ONLY = os.environ.get("VERIFY_ME_APPEND_ONLY", "") == "1"
+
+# Set VERIFY_ME_SHARD_SIZE=N to keep the text files as shards of at most about N users each, split
+# as they fill up. The text files are always reached through their shard manifest, even while there
+# is none, so that python code/sharding.py split can run while the program does.
+SHARD_SIZE = int(os.environ.get("VERIFY_ME_SHARD_SIZE", "0") or 0)
+
+_lock = threading.Lock()
+_user_stores = {}
+_backup_code_stores = {}
+_uniqueness_indexes = {}
+
+
+def _sqlite_pool(data_file):
+    """The SQLite database lives next to the text file it replaces."""
+    return get_pool(os.path.join(os.path.dirname(data_file), SQLITE_DATABASE_FILE))
+
+
+def _binary_file(data_file):
+    """The binary user file replaces database.txt under the same name with a .bin extension."""
+    return os.path.splitext(data_file)[0] + ".bin"
+
+
+def get_user_store(user_data_file):
+    """Returns the UserStore shared by every class working on the same data file."""
+    key = os.path.abspath(user_data_file)
+    with _lock:
+        store = _user_stores.get(key)
+        if store is None:
+            if STORAGE == "sqlite":
+                store = SQLiteUserStore(_sqlite_pool(user_data_file))
+            elif STORAGE == "binary":
+                store = BinaryUserStore(_binary_file(user_data_file))
+            else:
+                store = ShardedUserStore(user_data_file, append_only=APPEND_ONLY, split_size=SHARD_SIZE or None)
+            _user_stores[key] = store
+        return store
+
+
+def get_backup_code_store(backup_code_file):
+    """Returns the BackupCodeStore shared by every class working on the same code file."""
+    key = os.path.abspath(backup_code_file)
+    with _lock:
+        store = _backup_code_stores.get(key)
+        if store is None:
+            if STORAGE == "sqlite":
+                store = SQLiteBackupCodeStore(_sqlite_pool(backup_code_file))
+            else:
+                store = ShardedBackupCodeStore(backup_code_file, append_only=APPEND_ONLY,
+                                               split_size=SHARD_SIZE or None)
+            _backup_code_stores[key] = store
+        return store
+
+
+def get_uniqueness_index(user_data_file):
+    """Returns the UniquenessIndex over the users of a data file; its filter file sits next to the data."""
+    key = os.path.abspath(user_data_file)
+    store = get_user_store(user_data_file)
+    with _lock:
+        index = _uniqueness_indexes.get(key)
+        if index is None:
+            if STORAGE == "sqlite":
+                pool = _sqlite_pool(user_data_file)
+                index = UniquenessIndex(store, SQLiteUserSource(pool), pool.database_file + ".bloom")
+            elif STORAGE == "binary":
+                index = UniquenessIndex(store, BinaryUserSource(store), store.data_file + ".bloom")
+            else:
+                index = UniquenessIndex(store, ShardedUserSource(store), user_data_file + ".bloom")
+            _uniqueness_indexes[key] = index
+        return index
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+
+from file_lock import atomic_write
+from metrics import instrumented
+from record_log import APPENDED, UNCHANGED, RecordLog
+
+FILTER_MAGIC = b"VMBLOOM1"
+COLUMNS = ("identifier", "username")
+SAVE_EVERY = 1000  # unsaved additions before the filter file is rewritten
+MIN_CAPACITY = 1024  # filters are sized for twice the users they start with, and at least this many
+
+
+class BloomFilter:
+    """A fixed-size Bloom filter over strings: no false negatives, about error_rate false positives.
+
+    bits may be any buffer of byte_size() bytes, e.g. an mmap of a saved filter.
+    """
+
+    def __init__(self, capacity, error_rate=0.001, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.byte_size()) if bits is None else bits
+        self.count = 0
+
+    def byte_size(self):
+        return (self.size + 7) // 8
+
+    def _positions(self, value):
+        # Two 64-bit halves of one digest give every probe position (Kirsch-Mitzenmacher).
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return ((first + i * second) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+
+class TextUserSource:
+    """Reads users from database.txt, following appends the way UserStore does."""
+
+    def __init__(self, user_data_file):
+        self.path = user_data_file
+        self.log = RecordLog(user_data_file, key_fields=1, min_fields=4)
+
+    def cursor(self):
+        return self.log.cursor()
+
+    def restore(self, cursor):
+        self.log.restore(cursor)
+
+    def changes(self):
+        """Returns (records, complete): new users since the cursor, or complete=True with every user."""
+        state = self.log.poll()
+        if state == UNCHANGED:
+            return [], False
+        if state == APPENDED:
+            return [fields for _, fields in self.log.read() if fields is not None], False
+        # The file was rewritten: keep only the latest record of each user.
+        latest = {}
+        for key, fields in self.log.read(from_start=True):
+            latest[key] = fields
+        return [fields for fields in latest.values() if fields is not None], True
+
+
+class ShardedUserSource:
+    """Reads users from every shard of a ShardedUserStore; a split or join starts over."""
+
+    def __init__(self, store):
+        self.store = store
+        self.sources = None
+
+    def cursor(self):
+        if self.sources is None:
+            return {}
+        return {"shards": [[bits, value, source.cursor()] for (bits, value), source in sorted(self.sources.items())]}
+
+    def restore(self, cursor):
+        self.sources = None
+        if cursor.get("shards") is not None:
+            self.sources = {}
+            for bits, value, log_cursor in cursor["shards"]:
+                source = self.sources[bits, value] = TextUserSource(self.store.map.path((bits, value)))
+                source.restore(log_cursor)
+
+    def changes(self):
+        with self.store.map.file_lock.shared():
+            self.store.map.refresh()
+            shards = self.store.map.shards
+            if self.sources is not None and set(self.sources) == shards:
+                records = []
+                for source in self.sources.values():
+                    shard_records, complete = source.changes()
+                    if complete:
+                        break
+                    records += shard_records
+                else:
+                    return records, False
+            # A new set of shards, or a rewritten one: every shard is read again.
+            self.sources = {shard: TextUserSource(self.store.map.path(shard)) for shard in shards}
+            records = []
+            for source in self.sources.values():
+                records += source.changes()[0]
+            return records, True
+
+
+class SQLiteUserSource:
+    """Reads users from the users table; new rows are found by rowid, since users are never deleted."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.max_rowid = 0
+        self.stamp = None
+
+    def _stamp(self):
+        # Every commit changes the database or its WAL file, so an unchanged stamp means nothing to read.
+        stamp = []
+        for path in (self.pool.database_file, self.pool.database_file + "-wal"):
+            try:
+                stat = os.stat(path)
+                stamp += [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+            except FileNotFoundError:
+                stamp += [None, None, None]
+        return stamp
+
+    def cursor(self):
+        return {"max_rowid": self.max_rowid}
+
+    def restore(self, cursor):
+        self.max_rowid = cursor.get("max_rowid", 0)
+        self.stamp = None
+
+    def changes(self):
+        stamp = self._stamp()
+        if stamp == self.stamp:
+            return [], False
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT rowid, identifier, username FROM users WHERE rowid > ? ORDER BY rowid",
+                                (self.max_rowid,)).fetchall()
+        self.stamp = stamp
+        if rows:
+            self.max_rowid = rows[-1][0]
+        return [row[1:] for row in rows], False
+
+
+class BinaryUserSource:
+    """Reads users from a BinaryUserStore; new users are the slots past the last count seen."""
+
+    def __init__(self, store):
+        self.store = store
+        self.record_count = 0
+        self.identity = None
+
+    def cursor(self):
+        return {"record_count": self.record_count, "identity": self.identity}
+
+    def restore(self, cursor):
+        self.record_count = cursor.get("record_count", 0)
+        self.identity = cursor.get("identity")
+
+    def changes(self):
+        stat = os.stat(self.store.data_file)
+        identity = [stat.st_dev, stat.st_ino]
+        if identity != self.identity:
+            # A converted or restored file: slot numbers mean nothing any more.
+            self.identity, self.record_count = identity, 0
+            records = self.store.records_from(0)
+            self.record_count = len(records)
+            return [record[:2] for record in records], True
+        records = self.store.records_from(self.record_count)
+        self.record_count += len(records)
+        return [record[:2] for record in records], False
+
+
+class UniquenessIndex:
+    """Answers "is this email/phone or username taken?" without touching the data in the common case.
+
+    One Bloom filter per column says "certainly free" or "maybe taken"; only a
+    maybe is confirmed against the store's exact index. The filters are saved to
+    filter_file with the position in the data they cover, so a restart only reads
+    the users added since; a missing, corrupt or outdated filter file is rebuilt.
+    """
+
+    def __init__(self, store, source, filter_file, error_rate=0.001):
+        self.store = store
+        self.source = source
+        self.filter_file = filter_file
+        self.error_rate = error_rate
+        self._lock = threading.RLock()
+        self._unsaved = 0
+        if not self._load():
+            self._rebuild()
+
+    def _build(self, records):
+        capacity = max(MIN_CAPACITY, 2 * len(records))
+        self.filters = {column: BloomFilter(capacity, self.error_rate) for column in COLUMNS}
+        for fields in records:
+            self._add(fields)
+
+    def _add(self, fields):
+        self.filters["identifier"].add(fields[0])
+        self.filters["username"].add(fields[1])
+
+    def _load(self):
+        try:
+            with open(self.filter_file, "rb") as file:
+                if file.read(len(FILTER_MAGIC)) != FILTER_MAGIC:
+                    return False
+                (header_size,) = struct.unpack("<I", file.read(4))
+                header = json.loads(file.read(header_size))
+                if header["columns"] != list(COLUMNS) or header["error_rate"] != self.error_rate:
+                    return False
+                filters = {}
+                for column in COLUMNS:
+                    bloom = BloomFilter(header["capacity"], self.error_rate, bits=bytearray())
+                    bloom.bits = bytearray(file.read(bloom.byte_size()))
+                    if len(bloom.bits) != bloom.byte_size():
+                        return False
+                    bloom.count = header["count"]
+                    filters[column] = bloom
+        except (OSError, ValueError, KeyError, struct.error):
+            return False
+        self.filters = filters
+        self.source.restore(header["cursor"])
+        return True
+
+    def save(self):
+        """Writes the filters and the data position they cover to filter_file."""
+        with self._lock:
+            bloom = self.filters["identifier"]
+            header = json.dumps({
+                "columns": list(COLUMNS),
+                "capacity": bloom.capacity,
+                "error_rate": self.error_rate,
+                "count": bloom.count,
+                "cursor": self.source.cursor(),
+            }).encode()
+            with atomic_write(self.filter_file, "wb") as file:
+                file.write(FILTER_MAGIC + struct.pack("<I", len(header)) + header)
+                for column in COLUMNS:
+                    file.write(self.filters[column].bits)
+            self._unsaved = 0
+
+    def _rebuild(self):
+        with self._lock:
+            self.source.restore({})
+            self._build(self.source.changes()[0])
+            self.save()
+
+    def sync(self):
+        """Adds the users written since the last call, by this or any other process."""
+        with self._lock:
+            records, complete = self.source.changes()
+            if complete:
+                # A rewritten file (or a new set of shards) lists every user again. Rewrites drop no
+                # one, and a value a Bloom filter holds stays a "maybe" for good, so only values the
+                # filters lack are added; they are only rebuilt once most of what they hold is gone.
+                if 2 * len(records) < self.filters["identifier"].count:
+                    self._build(records)
+                    self.save()
+                    return
+                identifiers, usernames = self.filters["identifier"], self.filters["username"]
+                records = [fields for fields in records if fields[0] not in identifiers or fields[1] not in usernames]
+            for fields in records:
+                self._add(fields)
+            self._unsaved += len(records)
+            # Past capacity the false positive rate climbs; start over with room to grow.
+            outgrown = self.filters["identifier"].count > self.filters["identifier"].capacity
+        if outgrown:
+            self._rebuild()
+        elif self._unsaved >= SAVE_EVERY:
+            self.save()
+
+    @instrumented("uniqueness_check")
+    def identifier_taken(self, email_or_phone):
+        self.sync()
+        return email_or_phone in self.filters["identifier"] and self.store.identifier_exists(email_or_phone)
+
+    @instrumented("uniqueness_check")
+    def username_taken(self, username):
+        self.sync()
+        return username in self.filters["username"] and self.store.username_exists(username)
@@ -0,0 +1,228 @@
+import itertools
+import threading
+from collections import namedtuple
+
+from metrics import instrumented, timed
+from record_log import APPENDED, REPLACED, RecordLog
+from snapshot import MIN_RECORDS, SnapshotWriter, snapshot_file_for
+from snapshot import load as load_snapshot
+
+# One line of database.txt: identifier,username,salt_hex,hashed_password
+UserRecord = namedtuple("UserRecord", ["identifier", "username", "salt_hex", "hashed_password"])
+SNAPSHOT_COLUMNS = (0, 1)  # identifier, username
+_UNSET = object()
+
+
+class UserStore:
+    """Keeps database.txt indexed in memory by identifier and by username.
+
+    With append_only=True an update is written as a new record at the end of the file
+    (the latest record for an identifier wins) and the file is compacted in the
+    background once superseded records pass compact_threshold.
+
+    A large file is also kept as database.txt.snapshot (see snapshot.py): a new
+    process maps it and parses only the lines written after it, so the dicts
+    below then hold just those changes on top of the snapshot (None: deleted).
+    """
+
+    def __init__(self, user_data_file, append_only=False, compact_threshold=0.5):
+        self.user_data_file = user_data_file
+        self.append_only = append_only
+        self._lock = threading.RLock()
+        self._log = RecordLog(user_data_file, key_fields=1, min_fields=4, lock=self._lock,
+                              compact_threshold=compact_threshold)
+        self._snapshot_writer = SnapshotWriter(snapshot_file_for(user_data_file), user_data_file, SNAPSHOT_COLUMNS)
+        self._snapshot = None
+        self._snapshot_due = 0
+        self._by_identifier = {}
+        self._by_username = {}
+        self._count = 0
+
+    def _get(self, identifier):
+        record = self._by_identifier.get(identifier, _UNSET)
+        if record is _UNSET:
+            fields = self._snapshot.find(0, identifier) if self._snapshot is not None else None
+            return UserRecord(*fields[:4]) if fields else None
+        return record
+
+    def _get_by_username(self, username):
+        identifier = self._by_username.get(username)
+        if identifier is None and self._snapshot is not None:
+            fields = self._snapshot.find(1, username)
+            identifier = fields[0] if fields else None
+        record = self._get(identifier) if identifier is not None else None
+        # A snapshot entry may be for a user renamed since.
+        return record if record is not None and record.username == username else None
+
+    def _apply(self, key, fields):
+        identifier = key[0]
+        previous = self._get(identifier)
+        if previous is not None:
+            self._count -= 1
+            if self._by_username.get(previous.username) == identifier:
+                del self._by_username[previous.username]
+        if fields is not None:
+            record = UserRecord(*fields[:4])
+            self._by_identifier[identifier] = record
+            self._by_username[record.username] = identifier
+            self._count += 1
+        elif self._snapshot is not None:
+            self._by_identifier[identifier] = None
+        else:
+            self._by_identifier.pop(identifier, None)
+
+    def _load(self):
+        """Starts over from a current snapshot plus the lines after it, or from the whole file."""
+        self._by_identifier = {}
+        self._by_username = {}
+        self._snapshot = None
+        if MIN_RECORDS:
+            with self._log.file_lock.shared():
+                self._snapshot = load_snapshot(snapshot_file_for(self.user_data_file), self.user_data_file,
+                                               SNAPSHOT_COLUMNS)
+                if self._snapshot is not None:
+                    self._log.restore(self._snapshot.cursor)
+                    self._count = self._snapshot.count
+                    for key, fields in self._log.read():
+                        self._apply(key, fields)
+                    self._snapshot_due = max(MIN_RECORDS, self._count // 4)
+                    return
+        self._snapshot_due = 0
+        self._count = 0
+        for key, fields in self._log.read(from_start=True):
+            self._apply(key, fields)
+
+    def _maybe_snapshot(self):
+        """Writes a new snapshot in the background once enough changed since the last one."""
+        if not MIN_RECORDS or self._count < MIN_RECORDS or len(self._by_identifier) < self._snapshot_due:
+            return
+        snapshot, changes = self._snapshot, dict(self._by_identifier)
+        if snapshot is None:
+            records = list(changes.values())
+        else:
+            records = itertools.chain(
+                (fields[:4] for fields in snapshot.records() if fields[0] not in changes),
+                (record for record in changes.values() if record is not None))
+        if self._snapshot_writer.start(self._log.cursor(), records):
+            self._snapshot_due = len(self._by_identifier) + max(MIN_RECORDS, self._count // 4)
+
+    def refresh(self):
+        """Reloads the indexes only if the file changed since the last load or write.
+
+        Records appended by other writers are read from where we stopped; a replaced
+        file is parsed again from the start.
+        """
+        with self._lock:
+            state = self._log.poll()
+            if state == REPLACED:
+                with timed("user_index_load"):
+                    self._load()
+            elif state == APPENDED:
+                with timed("user_index_tail"):
+                    for key, fields in self._log.read():
+                        self._apply(key, fields)
+            self._maybe_snapshot()
+
+    @instrumented("find_user")
+    def find_user(self, email_or_phone):
+        """Returns the UserRecord for an identifier, or None."""
+        with self._lock:
+            self.refresh()
+            return self._get(email_or_phone)
+
+    def find_users(self, identifiers):
+        """Returns {identifier: UserRecord} for those of identifiers that exist, after a single refresh."""
+        with self._lock:
+            self.refresh()
+            found = {}
+            for identifier in identifiers:
+                record = self._get(identifier)
+                if record is not None:
+                    found[identifier] = record
+            return found
+
+    def find_by_username(self, username):
+        """Returns the UserRecord owning a username, or None."""
+        with self._lock:
+            self.refresh()
+            return self._get_by_username(username)
+
+    def identifier_exists(self, email_or_phone):
+        return self.find_user(email_or_phone) is not None
+
+    def username_exists(self, username):
+        return self.find_by_username(username) is not None
+
+    def _live_records(self):
+        records = [record for record in self._by_identifier.values() if record is not None]
+        if self._snapshot is not None:
+            records += [UserRecord(*fields[:4]) for fields in self._snapshot.records()
+                        if fields[0] not in self._by_identifier]
+        return records
+
+    def live_records(self):
+        """Returns every current record, in no particular order."""
+        with self._lock:
+            self.refresh()
+            return self._live_records()
+
+    def user_count(self):
+        with self._lock:
+            self.refresh()
+            return self._count
+
+    def add_user(self, record):
+        """Appends a new user and indexes it. Returns False if the identifier or username is taken.
+
+        The check is repeated under the exclusive file lock, so two processes
+        registering the same identifier cannot both succeed.
+        """
+        return not self.add_users([record])
+
+    @instrumented("add_users")
+    def add_users(self, records):
+        """Appends many new users in a single write. Returns the records refused as duplicates."""
+        with self._log.exclusive():
+            self.refresh()
+            accepted = []
+            refused = []
+            identifiers = set()
+            usernames = set()
+            for record in records:
+                if (record.identifier in identifiers or record.username in usernames
+                        or self._get(record.identifier) is not None or self._get_by_username(record.username) is not None):
+                    refused.append(record)
+                    continue
+                accepted.append(record)
+                identifiers.add(record.identifier)
+                usernames.add(record.username)
+            if accepted:
+                self._log.append(accepted)
+                for record in accepted:
+                    self._apply((record.identifier,), record)
+            return refused
+
+    def sync(self):
+        """Makes every write so far durable."""
+        with self._lock:
+            self._log.sync()
+
+    @instrumented("update_user")
+    def update_user(self, record, expected=None):
+        """Replaces the stored record for record.identifier. Returns False if the user is unknown,
+        or if expected is given and the stored record no longer equals it."""
+        with self._log.exclusive():
+            self.refresh()
+            current = self._get(record.identifier)
+            if current is None or expected is not None and current != expected:
+                return False
+
+            if self.append_only:
+                self._log.append([record])
+            else:
+                self._log.rewrite((record.identifier,), record)
+            self._apply((record.identifier,), record)
+
+            if self.append_only:
+                self._log.maybe_compact(self._count, self._live_records)
+            return True